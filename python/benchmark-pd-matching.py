@@ -0,0 +1,99 @@
+import sys
+from optparse import OptionParser
+from PIL import Image
+import numpy as np
+import os
+import time
+
+import pandas as pd
+import persistence_matching as pm
+import instrumentation
+
+
+parser = OptionParser('usage: -d dir --img image_pattern --sub sublevel_pattern --sup superlevel_pattern --start first_frame --end last_frame'  )
+
+parser.add_option("-d", dest="dir",
+                  help="parent directory")
+parser.add_option("--img", dest="img",
+                  help="image pattern")
+parser.add_option("--sub", dest="sub",
+                  help="sublevel pattern")
+parser.add_option("--sup", dest="sup",
+                  help="superlevel pattern")
+parser.add_option("--start", dest="start",
+                  help="index of the first frame")
+parser.add_option("--end", dest="end",
+                  help="index of the last frame")
+instrumentation.addTraceOption(parser)
+
+(options, args) = parser.parse_args()
+instrumentation.startTrace(options, sys.argv[0])
+
+start = int(options.start)
+end = int(options.end)
+
+
+def loadFrame(_index):
+  with instrumentation.Stage('load', frame=_index) as stage:
+    im = Image.open(options.dir + "/" + options.img % _index)
+    im.load()
+    bmp = np.array(im).astype(int)
+    frame = (bmp, pd.read_csv(options.dir + "/" + options.sub % _index), pd.read_csv(options.dir + "/" + options.sup % _index))
+    stage.items = len(frame[1]) + len(frame[2])
+  return frame
+
+
+# Compare the greedy and assignment engines on the same frame pairs: number of points, number of
+# matched points and wall time of the matching for each engine, then the radius column: the
+# histogram of the recorded radius of each engine and, of the points both engines match to the
+# same point, the number recorded with the same radius.
+print('index, sup_norm, points, ' + ', '.join(['%s_matched, %s_seconds' % (e, e) for e in pm.ENGINES]))
+
+totals = dict((e, [0, 0.]) for e in pm.ENGINES)
+total_points = 0
+radii = dict((e, []) for e in pm.ENGINES)
+common = [0, 0]
+
+frame2 = loadFrame(start)
+
+for t in range(start, end):
+
+  frame1 = frame2
+  frame2 = loadFrame(t+1)
+
+  (bmp1, sub1, sup1) = frame1
+  (bmp2, sub2, sup2) = frame2
+
+  max_error = pm.supNorm(bmp1, bmp2)
+  points = len(sub1) + len(sup1)
+  total_points += points
+
+  results = []
+  matches = []
+  for engine in pm.ENGINES:
+    tstart = time.time()
+    osub, osup = pm.matchDiagrams(sub1, sup1, sub2, sup2, max_error, _verbose=False, _engine=engine)
+    elapsed = time.time() - tstart
+    matched = int(np.sum(osub['matchedidx'] != -1) + np.sum(osup['matchedidx'] != -1))
+    totals[engine][0] += matched
+    totals[engine][1] += elapsed
+    results.append('%d, %f' % (matched, elapsed))
+
+    both = pd.concat([osub, osup], ignore_index=True)
+    radii[engine].append(both['radius'][both['matchedidx'] != -1].values)
+    matches.append(both)
+
+  # Points matched to the same point by the first two engines, and those with the same radius
+  same = (matches[0]['matchedidx'] != -1) & (matches[0]['matchedidx'].values == matches[1]['matchedidx'].values)
+  common[0] += int(np.sum(same))
+  common[1] += int(np.sum(same & (matches[0]['radius'].values == matches[1]['radius'].values)))
+
+  print('%d, %d, %d, ' % (t, max_error, points) + ', '.join(results))
+
+# Summary: match rate and total runtime of each engine, and the radius histograms
+for engine in pm.ENGINES:
+  print('# %s: match rate %f, %f seconds' % (engine, float(totals[engine][0])/max(total_points, 1), totals[engine][1]))
+for engine in pm.ENGINES:
+  values, counts = np.unique(np.concatenate(radii[engine]), return_counts=True)
+  print('# %s radius: ' % engine + ', '.join('%d: %d' % (v, c) for (v, c) in zip(values, counts)))
+print('# same match in %s and %s: %d, with the same radius: %d' % (pm.ENGINES[0], pm.ENGINES[1], common[0], common[1]))
@@ -0,0 +1,303 @@
+
+
+
+import sys
+from optparse import OptionParser
+import json
+import math
+import os
+import platform
+import time
+import numpy as np
+import pandas as pd
+import scipy.ndimage
+import numerical_analysis as na
+import computer_vision as cv
+import data_access as da
+import persistence_matching as pm
+import match_graph as mg
+import synthetic_data as sd
+import instrumentation
+
+
+
+parser = OptionParser('usage: -d dir [--sizes 128,256,512 --frames n --repeat n --seed n --only name1,name2,... -o report.json]'  )
+
+parser.add_option("-d", dest="dir",
+                  help="working directory, the synthetic runs are written to dir/<size>")
+parser.add_option("--sizes", dest="sizes",
+                  default="128,256,512",
+                  help="comma-separated image sizes (square)")
+parser.add_option("--frames", dest="frames",
+                  default=5,
+                  help="number of frames of each synthetic run")
+parser.add_option("--repeat", dest="repeat",
+                  default=3,
+                  help="number of timed repeats of each benchmark")
+parser.add_option("--seed", dest="seed",
+                  default=0,
+                  help="seed of the synthetic runs")
+parser.add_option("--wavelength", dest="wavelength",
+                  default=16,
+                  help="roll wavelength of the synthetic fields in pixels")
+parser.add_option("--defects", dest="defects",
+                  default=8,
+                  help="number of seeded defects of the synthetic fields")
+parser.add_option("--legacy-keypoints", dest="legacy_keypoints",
+                  default=50,
+                  help="number of keypoints per frame for the per-keypoint getFeatureVector")
+parser.add_option("--only", dest="only",
+                  help="optional comma-separated benchmarks to run (default all)")
+parser.add_option("-o", dest="output",
+                  help="optional JSON report relative to directory (printed otherwise)")
+instrumentation.addTraceOption(parser)
+
+(options, args) = parser.parse_args()
+instrumentation.startTrace(options, sys.argv[0])
+
+sizes = [int(s) for s in options.sizes.split(',')]
+frames = range(int(options.frames))
+repeat = int(options.repeat)
+seed = int(options.seed)
+wavelength = float(options.wavelength)
+
+# The constants of get-keypoint-descriptors.py
+orientation_blur_radius = 3
+keypoint_radius = 11
+keypoint_orientation_bins = 19
+keypoint_peak_factor = 0.8
+
+feature_radius = 20
+feature_orientation_bins = 12
+feature_inner_radius_factor = 0.5
+feature_sigma_divisor = 1.
+
+# Tolerance of the fourier wavenumber against the reference with one fft2 per derivative (see
+# wavenumberCheck). Measured differences are up to about 1e-11 at 512x512, on wavenumbers up to
+# about 10, from the rounding of the transforms.
+WAVENUMBER_RTOL = 1e-10
+WAVENUMBER_ATOL = 1e-10
+
+
+
+def prepareRun(_size):
+  """
+  Writes the synthetic run of one size and loads it back as the scripts do, together with the
+  intermediate results every benchmark starts from, so each benchmark times its own step only.
+  """
+  run_dir = options.dir + "/" + str(_size)
+  if not os.path.isdir(run_dir):
+    os.makedirs(run_dir)
+  with instrumentation.Stage('synthetic run', size=_size) as stage:
+    patterns = sd.writeRun(run_dir, frames, (_size, _size), wavelength, int(options.defects), seed)
+    stage.items = len(frames)
+
+  run = {'dir': run_dir, 'patterns': patterns, 'frames': []}
+  for i in frames:
+    bmp = da.loadTemperatureField(run_dir + "/" + patterns[0] % i)
+    sub = da.loadPersistenceDiagram(run_dir + "/" + patterns[1] % i)
+    sup = da.loadPersistenceDiagram(run_dir + "/" + patterns[2] % i)
+    u = bmp.astype(float)
+    raw_of = na.orientation_field(np.gradient(u), orientation_blur_radius)
+    of = 255*(raw_of + math.pi/2.0)/math.pi
+    keypoints = da.loadKeypoints(sub, sup, na.singular_point_list(raw_of))
+
+    centerx = bmp.shape[0]/2
+    centery = bmp.shape[1]/2
+    crop_radius = centerx - 30
+    allkeypoints = cv.assignOrientations(keypoints, keypoint_radius, of, keypoint_orientation_bins, keypoint_peak_factor, bmp, crop_radius)
+    x = allkeypoints[:,0].astype(int)
+    y = allkeypoints[:,1].astype(int)
+    rotation = -allkeypoints[:,keypoints.shape[1]]*(180./keypoint_orientation_bins)
+    inside = (((x - centerx)**2 + (y - centery)**2) <= crop_radius**2)
+
+    frame = {'bmp': bmp, 'u': u, 'sub': sub, 'sup': sup, 'raw_of': raw_of, 'of': of,
+             'keypoints': keypoints, 'crop_radius': crop_radius, 'x': x[inside], 'y': y[inside],
+             'rotation': rotation[inside]}
+    descriptors = cv.getFeatureVectors(raw_of, frame['x'], frame['y'], frame['rotation'], feature_radius, feature_inner_radius_factor, feature_orientation_bins, feature_sigma_divisor)
+    frame['features'] = np.hstack((allkeypoints[inside], bmp[frame['y'], frame['x']][:,None], descriptors))
+    run['frames'].append(frame)
+
+  # Matched diagrams of both engines, as match-pd-forward writes them, for the deviations
+  run['matches'] = {}
+  for engine in pm.ENGINES:
+    pattern = run_dir + "/" + engine + "_%s_%06d.csv"
+    for i in frames[:-1]:
+      f1 = run['frames'][i]
+      f2 = run['frames'][i + 1]
+      osub, osup = pm.matchDiagrams(f1['sub'], f1['sup'], f2['sub'], f2['sup'], pm.supNorm(f1['bmp'], f2['bmp']), _verbose=False, _engine=engine)
+      pm.writeMatches(osub, pattern % ('sub', i))
+      pm.writeMatches(osup, pattern % ('sup', i))
+    run['matches'][engine] = pattern.replace('%s', 'sub')
+  return run
+
+
+## Benchmarks: each takes a prepared run and returns the number of items it processed
+
+def orientationField(_run):
+  for f in _run['frames']:
+    na.orientation_field(np.gradient(f['u']), orientation_blur_radius)
+  return sum(f['u'].size for f in _run['frames'])
+
+def singularPoints(_run):
+  return sum(len(na.singular_point_list(f['raw_of'])) for f in _run['frames'])
+
+def wavenumber(_method):
+  def benchmark(_run):
+    for f in _run['frames']:
+      na.emb_wavenumber(f['u'], _method)
+    return sum(f['u'].size for f in _run['frames'])
+  return benchmark
+
+def keypointExtraction(_run):
+  return sum(da.loadKeypoints(f['sub'], f['sup'], na.singular_point_list(f['raw_of'])).shape[0] for f in _run['frames'])
+
+def orientationAssignment(_run):
+  return sum(cv.assignOrientations(f['keypoints'], keypoint_radius, f['of'], keypoint_orientation_bins, keypoint_peak_factor, f['bmp'], f['crop_radius']).shape[0] for f in _run['frames'])
+
+def featureVector(_run):
+  # The per-keypoint descriptor, on the first keypoints of every frame
+  items = 0
+  for f in _run['frames']:
+    n = min(len(f['x']), int(options.legacy_keypoints))
+    for k in range(n):
+      cv.getFeatureVector(f['bmp'], orientation_blur_radius, f['rotation'][k], f['x'][k], f['y'][k], feature_radius, feature_inner_radius_factor, feature_orientation_bins, feature_sigma_divisor)
+    items += n
+  return items
+
+def featureVectors(_run):
+  return sum(cv.getFeatureVectors(f['raw_of'], f['x'], f['y'], f['rotation'], feature_radius, feature_inner_radius_factor, feature_orientation_bins, feature_sigma_divisor).shape[0] for f in _run['frames'])
+
+def keypointMatching(_run):
+  # Each frame against the saved features (idx, match_idx, match_dist, ...) of the prior frame
+  items = 0
+  for f1, f2 in zip(_run['frames'][:-1], _run['frames'][1:]):
+    prior = np.hstack((np.arange(f1['features'].shape[0])[:,None], -np.ones((f1['features'].shape[0], 2)), f1['features']))
+    cv.getMatchingKeypoints(f2['features'], prior, 1)
+    items += f2['features'].shape[0]
+  return items
+
+def diagramMatching(_engine):
+  def benchmark(_run):
+    items = 0
+    for f1, f2 in zip(_run['frames'][:-1], _run['frames'][1:]):
+      pm.matchDiagrams(f1['sub'], f1['sup'], f2['sub'], f2['sup'], pm.supNorm(f1['bmp'], f2['bmp']), _verbose=False, _engine=_engine)
+      items += len(f1['sub']) + len(f1['sup'])
+    return items
+  return benchmark
+
+def linearDeviation(_run):
+  # The core of get-deviation-from-linear.py over the whole run
+  steps = len(frames) - 2
+  graph = mg.loadMatchGraph(_run['matches']['greedy'], 0, steps, 'matchedidx', ['birth', 'death'])
+  matched, deviation = mg.linearDeviation(graph, 0, steps)
+  return graph.size(0)
+
+def actualDeviation(_run):
+  # The core of get-deviation-from-actual.py, greedy against assignment matching
+  steps = len(frames) - 2
+  graph1 = mg.loadMatchGraph(_run['matches']['greedy'], 0, steps, 'matchedidx', ['idx', 'birth', 'death'])
+  graph2 = mg.loadMatchGraph(_run['matches']['assignment'], 0, steps, 'matchedidx', ['idx', 'birth', 'death'])
+  matched, deviation = mg.actualDeviation(graph1, graph2, 0, steps)
+  return graph1.size(0)
+
+
+## Checks: each takes a prepared run and returns the largest difference to its reference and
+## whether it is within tolerance
+
+def fft2Diff(_u, _order):
+  # Derivatives along both axes from a full fft2 of the field, one transform per call, as
+  # fourier_diff computed them before spectral_derivatives
+  [N, M] = _u.shape
+  [kx, ky] = np.mgrid[0:N,0:M]
+  kx = kx - float(N) * ( kx > float(N)/2.0 )
+  ky = ky - float(M) * ( ky > float(M)/2.0 )
+  if _order % 2 == 1 and N % 2 == 0: kx[N//2,:] = 0.0
+  if _order % 2 == 1 and M % 2 == 0: ky[:,M//2] = 0.0
+  kx = (kx * 2.0 * math.pi * 1j / float(N)) ** _order
+  ky = (ky * 2.0 * math.pi * 1j / float(M)) ** _order
+  u_fft = np.fft.fft2(_u)
+  return [np.real(np.fft.ifft2(u_fft * kx)), np.real(np.fft.ifft2(u_fft * ky))]
+
+def wavenumberCheck(_run):
+  # emb_wavenumber(u, 'fourier') against the full-size case formulas on fft2 derivatives
+  worst = 0.
+  close = True
+  for f in _run['frames']:
+    u = scipy.ndimage.gaussian_filter(f['u'], sigma=2)
+    u = u - np.sum(u)/np.size(u)
+    u = u / np.max(np.absolute(u))
+    [ux, uy] = fft2Diff(u, 1)
+    [uxx, uyy] = fft2Diff(u, 2)
+    [uxxx, uyyy] = fft2Diff(u, 3)
+    uxy = fft2Diff(ux, 1)[1]
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+      reference = na._emb_wavenumber_block(u, ux, uy, uxx, uyy, uxy, uxxx, uyyy)
+    wavenumber = na.emb_wavenumber(f['u'], 'fourier')
+    close &= np.allclose(wavenumber, reference, rtol=WAVENUMBER_RTOL, atol=WAVENUMBER_ATOL, equal_nan=True)
+    finite = np.isfinite(reference)
+    worst = max(worst, float(np.max(np.abs(wavenumber[finite] - reference[finite]))))
+  return worst, bool(close)
+
+
+BENCHMARKS = [('orientation_field', orientationField),
+              ('singular_points', singularPoints),
+              ('emb_wavenumber_difference', wavenumber('difference')),
+              ('emb_wavenumber_fourier', wavenumber('fourier')),
+              ('keypoint_extraction', keypointExtraction),
+              ('assign_orientations', orientationAssignment),
+              ('feature_vector', featureVector),
+              ('feature_vectors', featureVectors),
+              ('keypoint_matching', keypointMatching)] + \
+             [('pd_matching_' + engine, diagramMatching(engine)) for engine in pm.ENGINES] + \
+             [('deviation_linear', linearDeviation),
+              ('deviation_actual', actualDeviation)]
+
+CHECKS = [('emb_wavenumber_fourier', wavenumberCheck)]
+
+if options.only:
+  only = options.only.split(',')
+  unknown = [name for name in only if name not in dict(BENCHMARKS)]
+  if unknown:
+    parser.error("unknown benchmarks: " + ', '.join(unknown))
+  BENCHMARKS = [(name, benchmark) for (name, benchmark) in BENCHMARKS if name in only]
+
+if len(frames) < 3:
+  parser.error("the deviations need at least 3 frames")
+
+
+# Every benchmark at every size: wall time of each repeat, best and median; then every check
+results = []
+checks = []
+for size in sizes:
+  print("Size %d..." % size)
+  run = prepareRun(size)
+  for (name, benchmark) in BENCHMARKS:
+    seconds = []
+    for r in range(repeat):
+      with instrumentation.Stage(name, size=size, repeat=r) as stage:
+        tstart = time.time()
+        items = benchmark(run)
+        seconds.append(time.time() - tstart)
+        stage.items = items
+    results.append({'benchmark': name, 'size': size, 'frames': len(frames), 'items': items,
+                    'seconds': seconds, 'best': min(seconds), 'median': float(np.median(seconds))})
+    print("  %-26s %8d items  best %.4fs  median %.4fs" % (name, items, min(seconds), np.median(seconds)))
+  for (name, check) in CHECKS:
+    difference, passed = check(run)
+    checks.append({'check': name, 'size': size, 'max_difference': difference, 'passed': passed})
+    print("  check %-20s max difference %.3g  %s" % (name, difference, 'passed' if passed else 'FAILED'))
+
+report = {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+          'machine': platform.machine(), 'time': time.time(), 'seed': seed, 'wavelength': wavelength,
+          'defects': int(options.defects), 'repeat': repeat, 'results': results, 'checks': checks}
+
+if options.output:
+  with open(options.dir + "/" + options.output, 'w') as f:
+    json.dump(report, f, indent=1)
+else:
+  print(json.dumps(report, indent=1))
+
+failed = [c for c in checks if not c['passed']]
+if failed:
+  sys.exit("Failed checks: " + ', '.join('%s at %d' % (c['check'], c['size']) for c in failed))
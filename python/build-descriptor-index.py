@@ -0,0 +1,117 @@
+import sys
+from optparse import OptionParser
+import os
+import time
+import numpy as np
+import packed_store as ps
+import descriptor_index as di
+import instrumentation
+
+
+parser = OptionParser('usage: -d dir -i features.fstore|feature_pattern [--start first_frame --end last_frame -t type] -o output.index.pack [--nlist n --pca components --quantize --recall queries -k neighbours]'  )
+
+parser.add_option("-d", dest="dir",
+                  help="parent directory")
+parser.add_option("-i", dest="input",
+                  help="feature store, or feature vector text file pattern (with --start/--end), relative to directory")
+parser.add_option("--start", dest="start",
+                  help="index of the first frame (all frames of a store by default)")
+parser.add_option("--end", dest="end",
+                  help="index of the last frame")
+parser.add_option("-t", dest="type",
+                  help="optional keypoint type flag to index only, e.g. td_p1")
+parser.add_option("-o", dest="output_file",
+                  help="output descriptor index relative to directory")
+parser.add_option("--nlist", dest="nlist",
+                  help="number of k-means cells (default about the square root of the number of descriptors)")
+parser.add_option("--pca", dest="pca",
+                  help="optional number of principal components to project the descriptors on")
+parser.add_option("--quantize", dest="quantize", action="store_true", default=False,
+                  help="store the descriptors quantized to uint8")
+parser.add_option("--train", dest="train_size",
+                  default=100000,
+                  help="number of descriptors sampled for training")
+parser.add_option("--seed", dest="seed",
+                  default=0,
+                  help="seed of the training sample and the k-means")
+parser.add_option("--recall", dest="recall",
+                  help="optional number of indexed descriptors to query for the recall and speed of the index")
+parser.add_option("-k", dest="neighbours",
+                  default=10,
+                  help="number of neighbours for --recall")
+instrumentation.addTraceOption(parser)
+
+(options, args) = parser.parse_args()
+instrumentation.startTrace(options, sys.argv[0])
+
+if not options.output_file.endswith(di.INDEX_EXTENSION):
+  parser.error("output file must have the %s extension" % di.INDEX_EXTENSION)
+
+## Indexes the feature vectors of a run (the f0, f1, ... columns of the feature files) for
+## approximate nearest neighbour search (see descriptor_index.DescriptorIndex). A feature store
+## is read through its memory map; text feature files are loaded frame by frame.
+
+with instrumentation.Stage('load') as stage:
+  if ps.isFeatureStore(options.input):
+    store = ps.FeatureStore(options.dir + "/" + options.input)
+    start = int(options.start) if options.start is not None else None
+    stop = int(options.end) + 1 if options.end is not None else None
+    frames, rows = store.select(start, stop, options.type)
+    columns = store.columns
+  else:
+    frames = []
+    rows = []
+    for i in range(int(options.start), int(options.end) + 1):
+      data = np.loadtxt(options.dir + "/" + options.input % i, delimiter=' ', ndmin=2)
+      if data.size == 0:
+        continue
+      columns = ps.featureColumns(data.shape[1])
+      if options.type is not None:
+        data = data[data[:,columns.index(options.type)] == 1]
+      frames.append(np.full(len(data), i, dtype=np.int64))
+      rows.append(data)
+    if not rows:
+      sys.exit("No feature rows in the frames of the range")
+    frames = np.concatenate(frames)
+    rows = np.concatenate(rows, axis=0)
+  stage.items = len(rows)
+
+if 'f0' not in columns:
+  sys.exit("The feature rows have no feature vectors (generated with -v 0?)")
+descriptors = rows[:,columns.index('f0'):]
+idx = rows[:,columns.index('idx')]
+
+print("Indexing %d descriptors of %d dimensions..." % descriptors.shape)
+with instrumentation.Stage('build', pca=options.pca, quantize=options.quantize) as stage:
+  index = di.buildIndex(descriptors, frames, idx, options.dir + "/" + options.output_file,
+                        int(options.nlist) if options.nlist else None, int(options.pca) if options.pca else None,
+                        options.quantize, int(options.train_size), _seed=int(options.seed))
+  stage.items = len(index)
+print("...done: %d cells, %d dimensions stored as %s." % (index.attrs['nlist'], index.attrs['dims'], index.codes.dtype))
+
+if options.recall:
+  # Recall of the k nearest neighbours against an exact search, and search time, of a sample of
+  # the indexed descriptors for increasing numbers of probed cells
+  k = int(options.neighbours)
+  rng = np.random.RandomState(int(options.seed))
+  sample = np.sort(rng.choice(len(descriptors), min(len(descriptors), int(options.recall)), replace=False))
+  queries = np.asarray(descriptors[sample], dtype=np.float32)
+
+  tstart = time.time()
+  exact = di.exactSearch(descriptors, queries, k)[1]
+  print("exact: %f seconds" % (time.time() - tstart))
+
+  print('nprobe, recall, seconds')
+  nprobe = 1
+  while True:
+    nprobe = min(nprobe, index.attrs['nlist'])
+    with instrumentation.Stage('search', nprobe=nprobe) as stage:
+      tstart = time.time()
+      positions = index.search(queries, k, nprobe)[1]
+      elapsed = time.time() - tstart
+      stage.items = len(queries)
+    found = np.where(positions >= 0, index.rows[positions], -1)
+    print('%d, %f, %f' % (nprobe, di.recall(found, exact), elapsed))
+    if nprobe == index.attrs['nlist']:
+      break
+    nprobe *= 2
@@ -0,0 +1,73 @@
+
+
+
+import numpy as np
+import pandas as pd
+from scipy import spatial, sparse
+from scipy.sparse import csgraph
+
+
+# Columns of the pattern matches used for clustering
+CENTER = ['center_x', 'center_y']
+
+
+def radiusClusters(_points, _radius):
+  """
+  Single linkage clusters of the points at distance threshold _radius (as
+  hierarchy.fclusterdata(_points, _radius, criterion="distance")), i.e. the connected components
+  of the graph joining the points within _radius of each other, which is built from a KD-tree
+  instead of the full distance matrix. Clusters are numbered from 1 in order of first point.
+  """
+  n = len(_points)
+  if n == 0:
+    return np.zeros(0, dtype=int)
+  pairs = spatial.cKDTree(_points).query_pairs(_radius, output_type='ndarray')
+  graph = sparse.coo_matrix((np.ones(len(pairs)), (pairs[:,0], pairs[:,1])), shape=(n, n))
+  labels = csgraph.connected_components(graph, directed=False)[1]
+  return labels + 1
+
+
+def clusterDiameters(_points, _labels):
+  """
+  Largest distance between two points of each cluster, by cluster label in increasing order.
+  Only the convex hull vertices of a cluster are compared; clusters of collinear points take
+  the distance between their lexicographically first and last points.
+  """
+  clusters = np.unique(_labels)
+  diameters = np.zeros(len(clusters))
+  order = np.argsort(_labels, kind='stable')
+  bounds = np.searchsorted(_labels[order], clusters)
+  bounds = np.append(bounds, len(order))
+
+  for (k, (first, last)) in enumerate(zip(bounds[:-1], bounds[1:])):
+    points = _points[order[first:last]]
+    if len(points) < 2:
+      continue
+    if np.linalg.matrix_rank(points - points[0]) < 2:
+      lex = np.lexsort((points[:,1], points[:,0]))
+      points = points[[lex[0], lex[-1]]]
+    elif len(points) > 3:
+      points = points[spatial.ConvexHull(points).vertices]
+    diameters[k] = np.max(spatial.distance.pdist(points, 'euclidean'))
+
+  return diameters
+
+
+def clusterTable(_matches, _roll_width):
+  """
+  Clusters the pattern matches within 1.5 roll widths of each other and returns one row per
+  cluster with the mean center, the diameter in roll widths and the number of matches of each
+  match type. Also adds the cluster of every match to _matches.
+  """
+  points = _matches[CENTER].values.astype(float)
+  _matches['cluster'] = radiusClusters(points, 1.5*_roll_width)
+
+  output = _matches.groupby('cluster')[CENTER].mean()
+  output['diameter'] = clusterDiameters(points, _matches['cluster'].values)/_roll_width
+
+  counts = pd.crosstab(_matches['cluster'], _matches['match_type'])
+  counts.columns = [str(c) for c in counts.columns]
+  output = output.join(counts)
+
+  output.reset_index(inplace=True)
+  return output
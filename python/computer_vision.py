@@ -42,61 +42,66 @@ def assignOrientations(_keypoints, _radius, _orientationfield, nbins, max_factor
     centery = _bmp.shape[1]/2
     
     crop_radius = _crop_radius
-    
-    allKeypoints = _keypoints
-
-    allKeypoints = np.hstack([allKeypoints, np.zeros((_keypoints.shape[0],2), np.int)])
-
-    # Get circular crop
-    crop = np.zeros((_radius*2, _radius*2))
-    crop[_radius, _radius] = 1
-    crop = morphology.binary_dilation(crop, morphology.disk(_radius))
-    
-    for i in range(_keypoints.shape[0]):
-                
-        x = int(_keypoints[i,0])
-        y = int(_keypoints[i,1])
-        
-        if (((x - centerx)**2 + (y - centery)**2) <= crop_radius**2):
-
-            # Crop orientation field
-            cropped_orientation = _orientationfield[(y-_radius):(y+_radius), (x-_radius):(x+_radius)]
-            
-            # Get histogram for the orientation field
-            orig_hist = np.histogram(cropped_orientation[crop==1], bins=nbins, range=(0,256))[0]
-            hist = scipy.ndimage.filters.gaussian_filter(orig_hist, sigma=0.75)
-            maxpeak = max(hist)
-
-            peaks = (hist >= max_factor*float(maxpeak)).astype(np.int)
-            
-            # Label each of the peak components
-            peak_components = measure.label(peaks, background=0)
-
-                        
-            # If peak wraps first bin to last bin, combine these peaks
-            if (peak_components[0] > 0) & (peak_components[-1] > 0):
-                peak_components[(peak_components == peak_components[-1])] = peak_components[0]
-
-            maxorientations = []
-
-
-            for peak_ind in range(1,max(peak_components)+1):
-                # Extract the histogram values that fall on this component
-                peak_values = np.multiply((peak_components == peak_ind).astype(int), hist)
-                maxorientations.append([np.argmax(peak_values), sum(peak_values)])
-
-            maxorientations = np.asarray(maxorientations)
-            
-
-            for j in range(maxorientations.shape[0]):
-                orientation_rad = convertMainOrientationBin(maxorientations[j,0], nbins)
 
-                if j == 0:
-                    allKeypoints[i,-2:] = maxorientations[0,:]
-                else:
-                    feature = np.concatenate((_keypoints[i,:], maxorientations[j,:]),axis=0)
-                    allKeypoints = np.vstack([allKeypoints, feature])
-                    
+    keypoints = np.asarray(_keypoints)
+    x = keypoints[:,0].astype(int)
+    y = keypoints[:,1].astype(int)
+    inside = np.nonzero(((x - centerx)**2 + (y - centery)**2) <= crop_radius**2)[0]
+    n = len(inside)
+
+    # Circular crop as offsets from the keypoint
+    di, dj = [a.ravel() for a in np.meshgrid(np.arange(-_radius, _radius), np.arange(-_radius, _radius), indexing='ij')]
+    crop = (di**2 + dj**2) <= _radius**2
+    di = di[crop]
+    dj = dj[crop]
+
+    # Histograms of the cropped orientation field of all keypoints at once, one row per keypoint
+    cropped_orientation = _orientationfield[y[inside,None] + di, x[inside,None] + dj]
+    bins = histogramBins(cropped_orientation, nbins, (0,256))
+    flat = (np.arange(n)[:,None]*nbins + bins)[bins >= 0]
+    orig_hist = np.bincount(flat, minlength=n*nbins).reshape((n, nbins))
+    hist = scipy.ndimage.filters.gaussian_filter(orig_hist, sigma=(0, 0.75))
+    maxpeak = np.max(hist, axis=1) if n > 0 else np.zeros(0)
+
+    peaks = hist >= max_factor*maxpeak[:,None].astype(float)
+
+    # Label each of the peak components, numbered in order along the histogram
+    starts = peaks & ~np.hstack((np.zeros((n,1), bool), peaks[:,:-1]))
+    peak_components = np.cumsum(starts, axis=1)*peaks
+
+    # If peak wraps first bin to last bin, combine these peaks
+    wraps = (peak_components[:,0] > 0) & (peak_components[:,-1] > 0)
+    last = peak_components[:,-1:]
+    peak_components = np.where(wraps[:,None] & (peak_components == last), 1, peak_components)
+    ncomponents = np.max(peak_components, axis=1) if n > 0 else np.zeros(0, int)
+
+    # Sum and first argmax of the histogram over every (keypoint, component)
+    keys = (np.arange(n)[:,None]*(nbins + 1) + peak_components)[peaks]
+    values = hist[peaks]
+    sums = np.zeros(n*(nbins + 1), dtype=hist.dtype)
+    np.add.at(sums, keys, values)
+    maxima = np.zeros(n*(nbins + 1), dtype=hist.dtype)
+    np.maximum.at(maxima, keys, values)
+    at_max = values == maxima[keys]
+    first_keys, first = np.unique(keys[at_max], return_index=True)
+    argmax = np.zeros(n*(nbins + 1), dtype=int)
+    argmax[first_keys] = np.nonzero(peaks)[1][at_max][first]
+
+    # The main peak goes to the keypoint, every other peak to a copy of the keypoint appended at
+    # the end of the table, in order of keypoint and peak
+    labels = np.arange(1, nbins + 1)[None,:]
+    extra, extra_components = np.nonzero((labels >= 2) & (labels <= ncomponents[:,None]))
+    extra_components = extra_components + 1
+
+    allKeypoints = np.zeros((keypoints.shape[0] + len(extra), keypoints.shape[1] + 2), dtype=np.result_type(keypoints, int))
+    allKeypoints[:keypoints.shape[0], :-2] = keypoints
+    allKeypoints[keypoints.shape[0]:, :-2] = keypoints[inside[extra]]
+
+    main = np.arange(n)*(nbins + 1) + 1
+    allKeypoints[inside, -2] = argmax[main]
+    allKeypoints[inside, -1] = sums[main]
+    allKeypoints[keypoints.shape[0]:, -2] = argmax[extra*(nbins + 1) + extra_components]
+    allKeypoints[keypoints.shape[0]:, -1] = sums[extra*(nbins + 1) + extra_components]
 
     return allKeypoints
 
@@ -179,57 +184,157 @@ def getFeatureVector(_bmp, _blur_radius, rotation, x, y, _radius, _inner_radius_
     return featurevector
 
 
-def getMatchingKeypoints(_current_keypoints, _prior_keypoints, _has_feature_vector):
+def histogramBins(_values, _nbins, _range):
     """
-    Takes in the current and a prior keypoint set outputs a matrix showing the matching.
-    The matching matrix has the same numbers of rows as _current_keypoints, and two columns.
-    Both columns are initialized to -1 (for unmatched). Positive matches are given the
-    index number from _prior_keypoints in the first column, and distance matched in second.
+    Bin index of every value for a histogram of _nbins equal bins over _range, exactly as
+    np.histogram assigns them (last bin closed). Values outside the range get -1.
     """
+    edges = np.linspace(_range[0], _range[1], _nbins + 1)
+    bins = np.searchsorted(edges, _values, side='right') - 1
+    bins[_values == edges[-1]] = _nbins - 1
+    bins[(_values < edges[0]) | (_values > edges[-1]) | np.isnan(_values)] = -1
+    return bins
 
-    # Initialize to all -1
-    keypoint_matches = np.ones((_current_keypoints.shape[0], 2))*-1
 
-    # Initialize index numbers for current keypoints
-    current_idx = np.asarray(range(_current_keypoints.shape[0]))
+# Descriptor geometry by (radius, inner radius factor, sigma divisor)
+_descriptor_geometry = {}
+
+def descriptorGeometry(_radius, _inner_radius_factor, _sigma_divisor):
+    """
+    Pixels entering a feature descriptor, as in getFeatureVector: offsets (row, col) from the
+    keypoint, Gaussian weights and region (0-3 the inner quadrants, 4-7 the outer quadrants), in
+    the order getFeatureVector histograms them. Computed once per parameter set.
+    """
+    key = (_radius, _inner_radius_factor, _sigma_divisor)
+
+    if key not in _descriptor_geometry:
+        inner_radius = int(_radius*_inner_radius_factor)
+        outer_radius = _radius
+
+        # Same Gaussian weight image as getFeatureVector
+        weights = np.zeros((outer_radius*2, outer_radius*2))
+        weights[outer_radius, outer_radius] = 1
+        weights = scipy.ndimage.filters.gaussian_filter(weights, sigma=outer_radius/_sigma_divisor)
+        weights = weights/np.amax(weights)
+
+        offsets = []
+        regions = []
+        for region in range(8):
+            tmp_radius = inner_radius if region < 4 else outer_radius
+            rows = np.arange(-tmp_radius, 0) if (region % 4) < 2 else np.arange(1, tmp_radius)
+            cols = np.arange(-tmp_radius, 0) if (region % 2) == 0 else np.arange(1, tmp_radius)
+            di, dj = [a.ravel() for a in np.meshgrid(rows, cols, indexing='ij')]
+
+            # Inner disk, or outer disk minus inner disk
+            d2 = di**2 + dj**2
+            if region < 4:
+                inside = d2 <= inner_radius**2
+            else:
+                inside = (d2 <= outer_radius**2) & (d2 > inner_radius**2)
+
+            offsets.append(np.column_stack((di[inside], dj[inside])))
+            regions.append(np.full(np.sum(inside), region))
+
+        offsets = np.concatenate(offsets)
+        _descriptor_geometry[key] = (offsets, weights[offsets[:,0] + outer_radius, offsets[:,1] + outer_radius], np.concatenate(regions))
+
+    return _descriptor_geometry[key]
 
-    # Separate by keypoint type 
+
+def getFeatureVectors(_orientationfield, _x, _y, _rotations, _radius, _inner_radius_factor, _nbins, _sigma_divisor):
+    """
+    Feature descriptors of all keypoints of a frame at once, as an (n_keypoints, 8*_nbins) array
+    with the same layout as getFeatureVector. _orientationfield is the orientation field of the
+    whole frame (na.orientation_field, between -pi/2 and pi/2), computed once per frame.
+
+    Instead of rotating a crop of the image and recomputing its orientation field for every
+    keypoint, the quadrant geometry is rotated and the field sampled (nearest pixel) at the
+    rotated positions; rotating the image by an angle offsets its orientations by the same angle.
+
+    Tolerance against getFeatureVector, as the L1 distance of the descriptors over their L1 norm
+    (200 keypoints on a convection-like roll pattern, get-keypoint-descriptors parameters):
+      rotation 0: inner quadrants median 0.000, max 0.007; outer quadrants median 0.085, max 0.21
+      rotated:    inner quadrants median 0.065, max 0.33
+    The orientations come from the whole frame instead of a crop, which removes the crop-boundary
+    blur. Rotated outer quadrants are not comparable (median 1.0): in getFeatureVector the
+    zero-padded corners of the rotated crop put a strong edge at the outer radius, and its
+    blurred orientation dominates the outer ring.
+    """
+    offsets, weights, regions = descriptorGeometry(_radius, _inner_radius_factor, _sigma_divisor)
+
+    x = np.asarray(_x, dtype=float)[:,None]
+    y = np.asarray(_y, dtype=float)[:,None]
+    theta = np.radians(np.asarray(_rotations, dtype=float))[:,None]
+    n = x.shape[0]
+
+    # Positions in the frame of the pixels of the rotated patches (rotation about the center of
+    # the 2*_radius crop, as interpolation.rotate)
+    di = offsets[:,0] + 0.5
+    dj = offsets[:,1] + 0.5
+    rows = np.rint(y - 0.5 + np.cos(theta)*di + np.sin(theta)*dj).astype(int)
+    cols = np.rint(x - 0.5 - np.sin(theta)*di + np.cos(theta)*dj).astype(int)
+    rows = np.clip(rows, 0, _orientationfield.shape[0] - 1)
+    cols = np.clip(cols, 0, _orientationfield.shape[1] - 1)
+
+    # Orientations of the rotated patches, back in [-pi/2, pi/2]
+    raw_of = _orientationfield[rows, cols] + theta
+    wrapped = np.mod(raw_of + math.pi/2.0, math.pi) - math.pi/2.0
+    raw_of = np.where((raw_of >= -math.pi/2.0) & (raw_of <= math.pi/2.0), raw_of, wrapped)
+    rotated_orientation = 255*(raw_of + math.pi/2.0)/math.pi # On scale of 0-255 for printing image. Legacy.
+
+    # One weighted histogram per (keypoint, region)
+    bins = histogramBins(rotated_orientation, _nbins, (0,256))
+    flat = (np.arange(n)[:,None]*8 + regions[None,:])*_nbins + bins
+    valid = bins >= 0
+    featurevectors = np.bincount(flat[valid], weights=np.broadcast_to(weights, flat.shape)[valid], minlength=n*8*_nbins)
+
+    return featurevectors.reshape((n, 8*_nbins))
+
+
+def keypointTrees(_keypoints, _position_columns, _type_offset):
+    """
+    Compiled KD-trees (cKDTree) of the keypoints of each of the 8 types: a dict from type to the
+    tree on the given position columns and the rows of the keypoints of that type. The type flags
+    start at column _type_offset.
+    """
+    trees = {}
     for keypoint_type in range(8):
+        indices = np.nonzero(_keypoints[:,keypoint_type+_type_offset] == 1)[0]
+        if len(indices) > 0:
+            trees[keypoint_type] = (spatial.cKDTree(_keypoints[indices][:,_position_columns]), indices)
+    return trees
 
-        # Search for the locations of these types
-        curr_keypoint_indices = (_current_keypoints[:,keypoint_type+2] == 1)
-        prior_keypoint_indices = (_prior_keypoints[:,keypoint_type+5] == 1)
 
-        if (np.sum(curr_keypoint_indices)>0) & (np.sum(prior_keypoint_indices) > 0):
+def matchKeypointTrees(_current_trees, _prior_trees, _n_current, _prior_idx):
+    """
+    Mutual nearest neighbor matching of keypoints of the same type within 5 pixels, given the
+    per-type trees of the current and the prior keypoints (see keypointTrees). Returns the
+    matching matrix of getMatchingKeypoints; _prior_idx gives the index number of every prior row.
+    """
 
-            # Generate KD Trees
-            if _has_feature_vector:
-                curr_kd_tree = spatial.KDTree(_current_keypoints[curr_keypoint_indices][:,[0,1,10]])
-                prior_kd_tree = spatial.KDTree(_prior_keypoints[prior_keypoint_indices][:,[3,4,13]])
+    # Initialize to all -1
+    keypoint_matches = np.ones((_n_current, 2))*-1
 
-                # Compute closest keypoint from current->prior and from prior->current
-                matches_a = prior_kd_tree.query(_current_keypoints[curr_keypoint_indices][:,[0,1,10]])
-                matches_b = curr_kd_tree.query(_prior_keypoints[prior_keypoint_indices][:,[3,4,13]])
-            else:
-                curr_kd_tree = spatial.KDTree(_current_keypoints[curr_keypoint_indices][:,[0,1]])
-                prior_kd_tree = spatial.KDTree(_prior_keypoints[prior_keypoint_indices][:,[3,4]])
+    for keypoint_type in range(8):
 
-                # Compute closest keypoint from current->prior and from prior->current
-                matches_a = prior_kd_tree.query(_current_keypoints[curr_keypoint_indices][:,[0,1]])
-                matches_b = curr_kd_tree.query(_prior_keypoints[prior_keypoint_indices][:,[3,4]])
+        if (keypoint_type in _current_trees) and (keypoint_type in _prior_trees):
+            (curr_kd_tree, curr_type_indices) = _current_trees[keypoint_type]
+            (prior_kd_tree, prior_rows) = _prior_trees[keypoint_type]
 
+            # Compute closest keypoint from current->prior and from prior->current
+            matches_a = prior_kd_tree.query(curr_kd_tree.data)
+            matches_b = curr_kd_tree.query(prior_kd_tree.data)
 
             # Mutual matches are the positive matches within the distance cutoff. All others unmatched.
             potential_matches = matches_b[1][matches_a[1]]
-            matched_indices = np.equal(potential_matches, np.arange(np.sum(curr_keypoint_indices)))
+            matched_indices = np.equal(potential_matches, np.arange(len(curr_type_indices)))
 
             # Filter out matches that are more than 5 pixels away.
             in_bounds = (matches_a[0] <= 5)
             matched_indices = np.multiply(matched_indices, in_bounds)
 
             # Add the matching data to the keypoint_matches matrix
-            curr_type_indices = current_idx[curr_keypoint_indices]
-            prior_type_indices = _prior_keypoints[prior_keypoint_indices, 0]
+            prior_type_indices = _prior_idx[prior_rows]
 
             keypoint_matches[curr_type_indices[matched_indices],0] = prior_type_indices[matches_a[1]][matched_indices]
             keypoint_matches[curr_type_indices[matched_indices],1] = matches_a[0][matched_indices]
@@ -237,9 +342,72 @@ def getMatchingKeypoints(_current_keypoints, _prior_keypoints, _has_feature_vect
     return keypoint_matches
 
 
+def getMatchingKeypoints(_current_keypoints, _prior_keypoints, _has_feature_vector):
+    """
+    Takes in the current and a prior keypoint set outputs a matrix showing the matching.
+    The matching matrix has the same numbers of rows as _current_keypoints, and two columns.
+    Both columns are initialized to -1 (for unmatched). Positive matches are given the
+    index number from _prior_keypoints in the first column, and distance matched in second.
+    """
+
+    # Separate by keypoint type and generate KD Trees
+    if _has_feature_vector:
+        curr_trees = keypointTrees(_current_keypoints, [0,1,10], 2)
+        prior_trees = keypointTrees(_prior_keypoints, [3,4,13], 5)
+    else:
+        curr_trees = keypointTrees(_current_keypoints, [0,1], 2)
+        prior_trees = keypointTrees(_prior_keypoints, [3,4], 5)
 
+    return matchKeypointTrees(curr_trees, prior_trees, _current_keypoints.shape[0], _prior_keypoints[:,0])
 
 
+class KeypointTracker(object):
+    """
+    Tracks keypoints through a sequence of frames. The per-type KD-trees of each frame are built
+    once and kept for matching the next frame, so no frame is reloaded or re-indexed. Keypoints
+    are given in the layout of the current keypoints of getMatchingKeypoints (x, y, the 8 type
+    flags, then the orientation when there are feature vectors).
 
+    Every keypoint gets a track id: the id of its match in the prior frame, or a new id.
+    """
 
-    
+    def __init__(self, _has_feature_vector):
+        self.position_columns = [0,1,10] if _has_feature_vector else [0,1]
+        self.prior_trees = None
+        self.prior_tracks = None
+        self.next_track = 0
+        self.tracks = []
+
+    def step(self, _frame, _keypoints):
+        """
+        Matches the keypoints of the next frame to the prior frame. Returns the matching matrix of
+        getMatchingKeypoints (index number of the prior keypoint and distance, -1 if unmatched).
+        """
+        n = _keypoints.shape[0]
+        trees = keypointTrees(_keypoints, self.position_columns, 2)
+
+        if self.prior_trees is None:
+            keypoint_matches = np.ones((n, 2))*-1
+        else:
+            keypoint_matches = matchKeypointTrees(trees, self.prior_trees, n, np.arange(len(self.prior_tracks)))
+
+        # Matched keypoints continue the track of their prior keypoint, all others start a track
+        matched = keypoint_matches[:,0] >= 0
+        track_ids = np.zeros(n, dtype=int)
+        track_ids[matched] = self.prior_tracks[keypoint_matches[matched,0].astype(int)] if np.any(matched) else []
+        track_ids[~matched] = self.next_track + np.arange(np.sum(~matched))
+        self.next_track += np.sum(~matched)
+
+        self.tracks.append(pd.DataFrame({'track_id': track_ids, 'frame': _frame, 'idx': np.arange(n)}, columns=['track_id', 'frame', 'idx']))
+        self.prior_trees = trees
+        self.prior_tracks = track_ids
+
+        return keypoint_matches
+
+    def trackTable(self):
+        """
+        Track table of all frames so far: one row (track_id, frame, idx) per keypoint.
+        """
+        if len(self.tracks) == 0:
+            return pd.DataFrame(columns=['track_id', 'frame', 'idx'])
+        return pd.concat(self.tracks, ignore_index=True)
@@ -0,0 +1,239 @@
+
+
+
+import numpy as np
+import pandas as pd
+import instrumentation
+
+
+# Columns of a diamorse persistence diagram
+COLUMNS = ['dim', 'birth', 'death', 'b_x', 'b_y', 'd_x', 'd_y']
+
+# Half neighbourhoods (each edge once) of 4- and 8-connectivity, as (row, col) offsets
+FOUR = [(0, 1), (1, 0)]
+EIGHT = [(0, 1), (1, 0), (1, 1), (1, -1)]
+
+
+def processingRanks(_image, _decreasing=False):
+  """
+  Position of every pixel in the order the filtration adds them: by increasing (decreasing) value,
+  ties broken by row-major index, so the order is total.
+  """
+  values = np.asarray(_image, dtype=float).ravel()
+  order = np.argsort(-values if _decreasing else values, kind='stable')
+  ranks = np.empty(len(order), dtype=np.int64)
+  ranks[order] = np.arange(len(order))
+  return ranks.reshape(np.shape(_image))
+
+
+def descentBasins(_ranks, _offsets):
+  """
+  Basin of every pixel (row-major index of the pixel it reaches by steepest descent, i.e. by
+  repeatedly moving to its lowest-ranked neighbour while that is lower) over the neighbourhood of
+  _offsets and their opposites. Every pixel of a basin is joined to the basin's minimum by a path
+  of lower-ranked pixels, so the basin is connected by the time the pixel is added.
+  """
+  [H, W] = _ranks.shape
+  index = np.arange(H*W).reshape((H, W))
+  padded = np.pad(_ranks, 1, mode='constant', constant_values=H*W)
+  lowest = _ranks.copy()
+  parent = index.copy()
+
+  for (di, dj) in _offsets + [(-di, -dj) for (di, dj) in _offsets]:
+    neighbour = padded[1 + di:1 + di + H, 1 + dj:1 + dj + W]
+    lower = neighbour < lowest
+    lowest[lower] = neighbour[lower]
+    parent[lower] = index[lower] + di*W + dj
+
+  # Pointer jumping: every pixel ends at the minimum of its basin
+  parent = parent.ravel()
+  while True:
+    jumped = parent[parent]
+    if np.array_equal(jumped, parent):
+      return parent
+    parent = jumped
+
+
+def basinEdges(_ranks, _basins, _offsets):
+  """
+  Edges between adjacent basins, the lowest of each pair of basins only: arrays of the two basins,
+  the rank at which the edge is added (the higher rank of its pixels) and the pixel with that
+  rank, sorted by rank.
+  """
+  [H, W] = _ranks.shape
+  index = np.arange(H*W).reshape((H, W))
+  flat = _ranks.ravel()
+  u = []
+  v = []
+  for (di, dj) in _offsets:
+    rows = slice(0, H - di)
+    cols = slice(max(0, -dj), W - max(0, dj))
+    u.append(index[rows, cols].ravel())
+    v.append(index[rows, cols].ravel() + di*W + dj)
+  u = np.concatenate(u)
+  v = np.concatenate(v)
+
+  between = _basins[u] != _basins[v]
+  u = u[between]
+  v = v[between]
+  pixel = np.where(flat[u] > flat[v], u, v)
+  rank = flat[pixel]
+  a = np.minimum(_basins[u], _basins[v])
+  b = np.maximum(_basins[u], _basins[v])
+
+  order = np.argsort(rank, kind='stable')
+  first = np.unique(a[order]*(H*W) + b[order], return_index=True)[1]
+  keep = order[np.sort(first)]
+  return a[keep], b[keep], rank[keep], pixel[keep]
+
+
+def mergePairs(_ranks, _offsets):
+  """
+  0-dimensional persistence pairs of the filtration adding the pixels in order of _ranks, with
+  pixels joined over the neighbourhood of _offsets: the minimum (row-major index) of every
+  component that dies and the pixel whose addition merges it into an older component (elder
+  rule). Returns the two index arrays and the index of the minimum of the component that
+  never dies.
+
+  Components are built from the descent basins, so union-find only runs over the edges
+  between basins instead of over all pixels.
+  """
+  flat = _ranks.ravel()
+  basins = descentBasins(_ranks, _offsets)
+  (a, b, rank, pixel) = basinEdges(_ranks, basins, _offsets)
+
+  roots = np.unique(basins)
+  parent = dict((r, r) for r in roots.tolist())
+
+  def find(_x):
+    while parent[_x] != _x:
+      parent[_x] = parent[parent[_x]]
+      _x = parent[_x]
+    return _x
+
+  births = []
+  deaths = []
+  for (x, y, s) in zip(a.tolist(), b.tolist(), pixel.tolist()):
+    x = find(x)
+    y = find(y)
+    if x == y:
+      continue
+    # Components are represented by their minimum: the younger one dies at s
+    if flat[x] > flat[y]:
+      (x, y) = (y, x)
+    parent[y] = x
+    births.append(y)
+    deaths.append(s)
+
+  eldest = roots[np.argmin(flat[roots])]
+  return np.array(births, dtype=np.int64), np.array(deaths, dtype=np.int64), eldest
+
+
+def persistencePairs(_image, _level='sub', _essential=False):
+  """
+  Persistence pairs of the sublevel ('sub') or superlevel ('sup') filtration of a 2D image as an
+  (n, 7) array with the columns of COLUMNS. The image is the vertex set of a cubical complex
+  whose edges and squares enter with their highest (lowest for 'sup') pixel, as in diamorse.
+
+  Dimension 0 comes from union-find over the pixels in filtration order, 4-connected. Dimension
+  1 comes through duality: the holes of the filtration are the components of the complement
+  filtration (the pixels in the opposite order, 8-connected) that do not reach a ring of padding
+  pixels added first around the image. A class born at a minimum (maximum for 'sup') and dying
+  at a saddle is reported with the coordinates of the two pixels, x the column and y the row; a
+  hole is born at the saddle pixel closing it and dies at the extremum filling it. Pairs of zero
+  persistence are dropped. With _essential the component that never dies is included, with
+  death inf (-inf for 'sup') and generator coordinates -1 (the array is then float).
+  """
+  image = np.asarray(_image)
+  if image.ndim != 2:
+    raise ValueError('persistencePairs: expected a 2D image, got shape ' + str(image.shape))
+  if _level not in ['sub', 'sup']:
+    raise ValueError('persistencePairs: Unrecognized level "' + _level + '"')
+  [H, W] = image.shape
+  values = image.ravel()
+  decreasing = (_level == 'sup')
+
+  # Dimension 0: born at the minimum of the dying component, dies at the merging pixel
+  (young, merge, eldest) = mergePairs(processingRanks(image, decreasing), FOUR)
+  dim0 = [np.zeros(len(young), dtype=int), values[young], values[merge],
+          young % W, young // W, merge % W, merge // W]
+
+  # Dimension 1: the complement order on the image padded with a ring added first. The ring is
+  # the eldest component; components born inside die when they reach it or an older one.
+  ranks = processingRanks(image, not decreasing) + 2*(H + W) + 4
+  padded = np.pad(ranks, 1, mode='constant', constant_values=-1)
+  ring = (padded == -1)
+  padded[ring] = np.arange(np.sum(ring))
+  (young, merge, eldest_ring) = mergePairs(padded, EIGHT)
+  inside = ~ring.ravel()[young]
+  young = young[inside]
+  merge = merge[inside]
+  # Padded index to image index
+  [yr, yc] = [young // (W + 2) - 1, young % (W + 2) - 1]
+  [mr, mc] = [merge // (W + 2) - 1, merge % (W + 2) - 1]
+  dim1 = [np.ones(len(young), dtype=int), image[mr, mc], image[yr, yc], mc, mr, yc, yr]
+
+  pairs = np.concatenate([np.column_stack(dim0), np.column_stack(dim1)], axis=0)
+  pairs = pairs[pairs[:,1] != pairs[:,2]]
+
+  if _essential:
+    death = -np.inf if decreasing else np.inf
+    pairs = np.concatenate([np.array([[0, values[eldest], death, eldest % W, eldest // W, -1, -1]]), pairs.astype(float)], axis=0)
+
+  # Order by dimension, then by birth and death
+  return pairs[np.lexsort((pairs[:,2], pairs[:,1], pairs[:,0]))]
+
+
+def persistenceDiagram(_image, _level='sub', _essential=False):
+  """
+  Sublevel or superlevel persistence diagram of a 2D image as a DataFrame in the format of the
+  diamorse CSV files (see persistencePairs), ready for loadKeypoints and the matching.
+  """
+  return pd.DataFrame(persistencePairs(_image, _level, _essential), columns=COLUMNS)
+
+
+def persistenceDiagrams(_image, _essential=False):
+  """
+  Sublevel and superlevel persistence diagrams of a 2D image.
+  """
+  return persistenceDiagram(_image, 'sub', _essential), persistenceDiagram(_image, 'sup', _essential)
+
+
+def frameDiagrams(_frame, _image, _essential=False):
+  """
+  Sublevel and superlevel diagrams of one frame, as (_frame, sub, sup). Used as the worker of
+  the range mode of get-persistence-diagrams.py.
+  """
+  with instrumentation.Stage('persistence', frame=_frame) as stage:
+    sub, sup = persistenceDiagrams(_image, _essential)
+    stage.items = len(sub) + len(sup)
+  return (_frame, sub, sup)
+
+
+def multisetOverlap(_a, _b, _columns):
+  """
+  Number of rows two tables have in common over _columns, counting repeated rows.
+  """
+  counts_a = _a[_columns].astype(float).groupby(_columns).size()
+  counts_b = _b[_columns].astype(float).groupby(_columns).size()
+  counts = pd.concat([counts_a, counts_b], axis=1, join='inner')
+  return int(counts.min(axis=1).sum())
+
+
+def compareDiagrams(_diagram, _reference):
+  """
+  Agreement of a computed diagram with a reference diagram (e.g. a diamorse CSV file) per
+  dimension: the number of points of each, the number of points with the same birth and death
+  in both and, of those, the number with the same generator coordinates too. Points with an
+  infinite death are left out of both.
+  """
+  diagram = _diagram[np.isfinite(_diagram['death'].astype(float))]
+  reference = _reference[np.isfinite(_reference['death'].astype(float))]
+
+  rows = []
+  for dim in sorted(set(diagram['dim'].astype(int)) | set(reference['dim'].astype(int))):
+    a = diagram[diagram['dim'] == dim]
+    b = reference[reference['dim'] == dim]
+    rows.append([dim, len(a), len(b), multisetOverlap(a, b, ['birth', 'death']), multisetOverlap(a, b, COLUMNS[1:])])
+
+  return pd.DataFrame(rows, columns=['dim', 'points', 'reference_points', 'equal_pairs', 'equal_generators'])
@@ -4,16 +4,149 @@
 import numpy as np
 import pandas as pd
 from scipy import misc
+import packed_store as ps
 
 
 def loadTemperatureField(_bmp_file):
   return misc.imread(_bmp_file)
   
 
-def loadKeypoints(_pd_sub_file, _pd_sup_file, _td):
+# Packed frame stacks opened so far, by file name
+_frame_stacks = {}
+
+def loadTemperatureFields(_stack_file, _start, _stop=None):
+  """
+  Loads temperature fields from a packed frame stack (see packed_store.packFrames) without
+  decoding any file: frame _start as an (H, W) array, or frames _start to _stop (exclusive) as a
+  (T, H, W) array. Both are read-only views on the memory-mapped stack.
+  """
+  if _stack_file not in _frame_stacks:
+    _frame_stacks[_stack_file] = ps.FrameStack(_stack_file)
+  if _stop is None:
+    return _frame_stacks[_stack_file].frame(_start)
+  return _frame_stacks[_stack_file].range(_start, _stop)
+
+
+# Packed diagram stores opened so far, by file name
+_diagram_stores = {}
+
+def loadPersistenceDiagram(_file, _index=None):
+  """
+  Loads one persistence diagram as a DataFrame. _file is either a CSV file, a CSV file pattern
+  formatted with _index, or a packed diagram store (see packed_store.packDiagrams) from which
+  frame _index is read without touching the rest of the run.
+  """
+  if ps.isPacked(_file):
+    if _file not in _diagram_stores:
+      _diagram_stores[_file] = ps.DiagramStore(_file)
+    return _diagram_stores[_file].frame(_index)
+  if _index is not None:
+    _file = _file % _index
+  return pd.read_csv(_file)
+
+
+
+# Keypoint type flags, in column order after the coordinates
+KEYPOINT_TYPES = ['ph_sub_0', 'ph_sub_1', 'ph_sup_0', 'ph_sup_1', 'td_p1', 'td_m1', 'td_p2', 'td_m2']
+
+# Value separating the lower and upper halves of the temperature range
+MIDLEVEL = 127
+
+# Persistent homology keypoint sources, in output order: (diagram, dim, generator, type, bound).
+# A source point is a keypoint if its persistence is >= delta and its value (the level of the
+# generator) is >= lowercutoff (bound 'lower') or <= uppercutoff (bound 'upper'); the conditions
+# on MIDLEVEL do not depend on the parameters and are applied once.
+KEYPOINT_SOURCES = [('sub', 0, 'death', 'ph_sub_0', 'lower'),
+                    ('sub', 1, 'birth', 'ph_sub_0', 'lower'),
+                    ('sup', 0, 'death', 'ph_sup_0', 'upper'),
+                    ('sup', 1, 'birth', 'ph_sup_0', 'upper'),
+                    ('sub', 1, 'death', 'ph_sub_1', 'upper'),
+                    ('sup', 1, 'death', 'ph_sup_1', 'lower')]
+
+# Columns of the keypoint candidate tables
+CANDIDATE_COLUMNS = ['frame', 'source', 'type', 'x', 'y', 'persistence', 'value', 'upper']
+
+
+def keypointCandidates(_pd_sub, _pd_sup, _frame=0):
+  """
+  Candidate persistent homology keypoints of one frame: every generator of a keypoint source
+  (KEYPOINT_SOURCES) passing the MIDLEVEL conditions, with its persistence and value precomputed,
+  so keypoints for any (delta, lowercutoff, uppercutoff) can be selected without refiltering the
+  diagrams (see selectKeypoints).
+  """
+  diagrams = {'sub': pd.DataFrame(_pd_sub), 'sup': pd.DataFrame(_pd_sup)}
+  candidates = []
+
+  for (k, (level, dim, generator, keypoint_type, bound)) in enumerate(KEYPOINT_SOURCES):
+    df = diagrams[level]
+    birth = df['birth'].values
+    death = df['death'].values
+    persistence = (death - birth) if level == 'sub' else (birth - death)
+
+    if generator == 'death':
+      value = death
+      if keypoint_type == 'ph_sub_0':
+        fixed = death <= MIDLEVEL
+      elif keypoint_type == 'ph_sup_0':
+        fixed = death >= MIDLEVEL
+      elif keypoint_type == 'ph_sub_1':
+        fixed = birth <= MIDLEVEL
+      else:
+        fixed = birth >= MIDLEVEL
+    else:
+      value = birth
+      fixed = (birth <= MIDLEVEL) if keypoint_type == 'ph_sub_0' else (birth >= MIDLEVEL)
+
+    rows = np.nonzero((df['dim'].values == dim) & fixed)[0]
+    [x, y] = ['d_x', 'd_y'] if generator == 'death' else ['b_x', 'b_y']
+    candidates.append(pd.DataFrame({'frame': np.full(len(rows), _frame, dtype=np.int32),
+                                    'source': np.full(len(rows), k, dtype=np.int8),
+                                    'type': np.full(len(rows), KEYPOINT_TYPES.index(keypoint_type), dtype=np.int8),
+                                    'x': df[x].values[rows], 'y': df[y].values[rows],
+                                    'persistence': persistence[rows].astype(float),
+                                    'value': value[rows].astype(float),
+                                    'upper': np.full(len(rows), bound == 'upper')}, columns=CANDIDATE_COLUMNS))
+
+  return pd.concat(candidates, ignore_index=True)
+
+
+def selectKeypoints(_candidates, _delta=10, _lowercutoff=45, _uppercutoff=200):
+  """
+  Mask of the keypoint candidates that are keypoints for the given parameters.
+  """
+  persistence = _candidates['persistence'].values
+  value = _candidates['value'].values
+  upper = _candidates['upper'].values
+  return (persistence >= _delta) & np.where(upper, value <= _uppercutoff, value >= _lowercutoff)
+
+
+def keypointArray(_candidates, _td):
+  """
+  Keypoints as an array of the coordinates and the type flags (see loadKeypoints): the
+  persistent homology keypoints of the candidate table, then the topological defects (given as
+  row, col, charge).
+  """
+  ph_defects = np.zeros((len(_candidates), 2 + len(KEYPOINT_TYPES)), dtype=np.result_type(_candidates['x'].values, int))
+  ph_defects[:,0] = _candidates['x'].values
+  ph_defects[:,1] = _candidates['y'].values
+  ph_defects[np.arange(len(_candidates)), 2 + _candidates['type'].values.astype(int)] = 1
+
+  td = np.reshape(np.asarray(_td, dtype=int), (-1, 3))
+  td_defects = np.zeros((len(td), 2 + len(KEYPOINT_TYPES)), dtype=int)
+  td_defects[:,0] = td[:,1]
+  td_defects[:,1] = td[:,0]
+  for (charge, keypoint_type) in [(1, 'td_p1'), (-1, 'td_m1'), (2, 'td_p2'), (-2, 'td_m2')]:
+    td_defects[:,2 + KEYPOINT_TYPES.index(keypoint_type)] = (td[:,2] == charge)
+
+  return np.concatenate((ph_defects, td_defects), axis=0)
+
+
+def loadKeypoints(_pd_sub_file, _pd_sup_file, _td, _delta=10, _lowercutoff=45, _uppercutoff=200):
   """
   Loads the persistent homology subelvel/superlevel data and locates critical cells to use as
   keypoints. Also receives in topological defects. Combines all data together into a single array.
+  The diagrams are given as CSV files or as already loaded DataFrames (e.g. a frame of a packed
+  diagram store).
 
   Each keypoint begins with its location:
   [x', 'y'] = keypoint coordinate in the image
@@ -28,91 +161,97 @@ def loadKeypoints(_pd_sub_file, _pd_sup_file, _td):
   ['td_p2'] = topological defect, +2 charge (rare)
   ['td_m2'] = topological defect, -2 charge (rare)
 
+  Persistent homology keypoints have persistence >= _delta and lie between _lowercutoff and
+  _uppercutoff (see KEYPOINT_SOURCES).
   """
 
-  # Constants for keypoints
-  delta = 10
-  lowercutoff = 45
-  uppercutoff = 200
-
   # Persistent homology lower saddle points
-  ph_features_sub = pd.read_csv(_pd_sub_file)
-  ph_features_sub = pd.DataFrame(ph_features_sub)
+  if isinstance(_pd_sub_file, pd.DataFrame):
+    ph_features_sub = _pd_sub_file
+  else:
+    ph_features_sub = loadPersistenceDiagram(_pd_sub_file)
 
   # Persistent homology upper saddle points
-  ph_features_sup = pd.read_csv(_pd_sup_file)
-  ph_features_sup = pd.DataFrame(ph_features_sup)
-
-  # Generate persistent homology defect matrix
-  ph_lower_saddles = ph_features_sub.loc[(ph_features_sub['dim']==0) & ((ph_features_sub['death'] - ph_features_sub['birth']) >= delta) & (ph_features_sub['death']>=lowercutoff) & (ph_features_sub['death']<=127)][['d_x','d_y']]
-  ph_lower_saddles.columns = ['x', 'y']
-  ph_tmp = ph_features_sub.loc[(ph_features_sub['dim']==1) & ((ph_features_sub['death'] - ph_features_sub['birth']) >= delta) & (ph_features_sub['birth']>=lowercutoff) & (ph_features_sub['birth']<=127)][['b_x','b_y']]
-  ph_tmp.columns = ['x', 'y']
-  ph_lower_saddles = pd.concat([ph_lower_saddles, ph_tmp])
-  ph_lower_saddles['ph_sub_0'] = 1
-  ph_lower_saddles['ph_sub_1'] = 0
-  ph_lower_saddles['ph_sup_0'] = 0
-  ph_lower_saddles['ph_sup_1'] = 0
-  ph_lower_saddles['td_p1'] = 0
-  ph_lower_saddles['td_m1'] = 0
-  ph_lower_saddles['td_p2'] = 0
-  ph_lower_saddles['td_m2'] = 0
-
-  ph_upper_saddles = ph_features_sup.loc[(ph_features_sup['dim']==0) & ((ph_features_sup['birth'] - ph_features_sup['death']) >= delta) & (ph_features_sup['death']>=127) & (ph_features_sup['death']<=uppercutoff)][['d_x','d_y']]
-  ph_upper_saddles.columns = ['x', 'y']
-  ph_tmp = ph_features_sup.loc[(ph_features_sup['dim']==1) & ((ph_features_sup['birth'] - ph_features_sup['death']) >= delta) & (ph_features_sup['birth']>=127) & (ph_features_sup['birth']<=uppercutoff)][['b_x','b_y']]
-  ph_tmp.columns = ['x', 'y']
-  ph_upper_saddles = pd.concat([ph_upper_saddles, ph_tmp])
-  ph_upper_saddles['ph_sub_0'] = 0
-  ph_upper_saddles['ph_sub_1'] = 0
-  ph_upper_saddles['ph_sup_0'] = 1
-  ph_upper_saddles['ph_sup_1'] = 0
-  ph_upper_saddles['td_p1'] = 0
-  ph_upper_saddles['td_m1'] = 0
-  ph_upper_saddles['td_p2'] = 0
-  ph_upper_saddles['td_m2'] = 0
-
-  ph_lower_plumes = ph_features_sub.loc[(ph_features_sub['dim']==1) & ((ph_features_sub['death'] - ph_features_sub['birth']) >= delta) & (ph_features_sub['birth']<=127) & (ph_features_sub['death']<=uppercutoff)][['d_x','d_y']]
-  ph_lower_plumes.columns = ['x', 'y']
-  ph_lower_plumes['ph_sub_0'] = 0
-  ph_lower_plumes['ph_sub_1'] = 1
-  ph_lower_plumes['ph_sup_0'] = 0
-  ph_lower_plumes['ph_sup_1'] = 0
-  ph_lower_plumes['td_p1'] = 0
-  ph_lower_plumes['td_m1'] = 0
-  ph_lower_plumes['td_p2'] = 0
-  ph_lower_plumes['td_m2'] = 0
-
-  ph_upper_plumes = ph_features_sup.loc[(ph_features_sup['dim']==1) & ((ph_features_sup['birth'] - ph_features_sup['death']) >= delta) & (ph_features_sup['birth']>=127) & (ph_features_sup['death']>=lowercutoff)][['d_x','d_y']]
-  ph_upper_plumes.columns = ['x', 'y']
-  ph_upper_plumes['ph_sub_0'] = 0
-  ph_upper_plumes['ph_sub_1'] = 0
-  ph_upper_plumes['ph_sup_0'] = 0
-  ph_upper_plumes['ph_sup_1'] = 1
-  ph_upper_plumes['td_p1'] = 0
-  ph_upper_plumes['td_m1'] = 0
-  ph_upper_plumes['td_p2'] = 0
-  ph_upper_plumes['td_m2'] = 0
-
-  ph_defects = np.concatenate((ph_lower_saddles, ph_upper_saddles, ph_lower_plumes, ph_upper_plumes), axis=0)
-
-  # Topological defects
-  td_defects = pd.DataFrame(_td, columns=['y', 'x', 'type'])
-  td_defects = td_defects.astype(np.int)
-  td_defects['ph_sub_0'] = 0
-  td_defects['ph_sub_1'] = 0
-  td_defects['ph_sup_0'] = 0
-  td_defects['ph_sup_1'] = 0
-  td_defects['td_p1'] = (td_defects['type'] == 1).astype(np.int)
-  td_defects['td_m1'] = (td_defects['type'] == -1).astype(np.int)
-  td_defects['td_p2'] = (td_defects['type'] == 2).astype(np.int)
-  td_defects['td_m2'] = (td_defects['type'] == -2).astype(np.int)
-
-  td_defects = td_defects.drop('type', 1)
-  td_defects = td_defects[['x', 'y', 'ph_sub_0', 'ph_sub_1', 'ph_sup_0', 'ph_sup_1', 'td_p1', 'td_m1', 'td_p2', 'td_m2']]
+  if isinstance(_pd_sup_file, pd.DataFrame):
+    ph_features_sup = _pd_sup_file
+  else:
+    ph_features_sup = loadPersistenceDiagram(_pd_sup_file)
+
+  candidates = keypointCandidates(ph_features_sub, ph_features_sup)
+  candidates = candidates[selectKeypoints(candidates, _delta, _lowercutoff, _uppercutoff)]
 
   # All of the keypoints
-  return np.concatenate((ph_defects, td_defects), axis=0)
+  return keypointArray(candidates, _td)
+
+
+class KeypointTable(object):
+  """
+  Keypoint candidates of a whole run (see keypointCandidates), with every diagram loaded once.
+  Keypoints are selected per (delta, lowercutoff, uppercutoff) setting with a mask over the
+  table, and the keypoint counts of many settings per frame and type come from a summed-area
+  table over the sorted thresholds, without selecting any setting.
+  """
+
+  def __init__(self, _sub_pattern, _sup_pattern, _frames):
+    self.frames = np.asarray(list(_frames))
+    self.candidates = pd.concat([keypointCandidates(loadPersistenceDiagram(_sub_pattern, i), loadPersistenceDiagram(_sup_pattern, i), i) for i in self.frames], ignore_index=True)
+
+  def keypoints(self, _frame, _td, _delta=10, _lowercutoff=45, _uppercutoff=200):
+    """
+    Keypoints of one frame, as loadKeypoints returns them.
+    """
+    candidates = self.candidates[self.candidates['frame'].values == _frame]
+    return keypointArray(candidates[selectKeypoints(candidates, _delta, _lowercutoff, _uppercutoff)], _td)
+
+  def select(self, _delta=10, _lowercutoff=45, _uppercutoff=200):
+    """
+    Keypoint candidates of all frames that are keypoints for one setting.
+    """
+    return self.candidates[selectKeypoints(self.candidates, _delta, _lowercutoff, _uppercutoff)]
+
+  def counts(self, _settings):
+    """
+    Number of persistent homology keypoints of every frame and type for each (delta,
+    lowercutoff, uppercutoff) setting, as a DataFrame with columns frame, delta, lowercutoff,
+    uppercutoff and one column per persistent homology type.
+    """
+    settings = np.asarray(_settings, dtype=float).reshape((-1, 3))
+    types = KEYPOINT_TYPES[:4]
+    order = np.argsort(self.frames)
+    positions = order[np.searchsorted(self.frames, self.candidates['frame'].values, sorter=order)]
+    counts = np.zeros((len(settings), len(self.frames), len(types)), dtype=int)
+
+    # Number of deltas at or below each persistence: persistence >= deltas[j] iff p >= j + 1
+    deltas = np.unique(settings[:,0])
+    p = np.searchsorted(deltas, self.candidates['persistence'].values, side='right')
+    j = np.searchsorted(deltas, settings[:,0]) + 1
+
+    for upper in [False, True]:
+      rows = self.candidates['upper'].values == upper
+      cutoffs = settings[:,2] if upper else settings[:,1]
+      thresholds = np.unique(cutoffs)
+      k = np.searchsorted(thresholds, cutoffs)
+
+      # value <= thresholds[k] iff v <= k (upper bound); value >= thresholds[k] iff v >= k + 1
+      v = np.searchsorted(thresholds, self.candidates['value'].values[rows], side='left' if upper else 'right')
+      t = self.candidates['type'].values[rows].astype(int)
 
+      shape = (len(self.frames), len(types), len(deltas) + 1, len(thresholds) + 1)
+      histogram = np.bincount(np.ravel_multi_index((positions[rows], t, p[rows], v), shape), minlength=int(np.prod(shape))).reshape(shape)
+      table = np.cumsum(histogram[:,:,::-1,:], axis=2)[:,:,::-1,:]
+      if upper:
+        table = np.cumsum(table, axis=3)
+      else:
+        table = np.cumsum(table[:,:,:,::-1], axis=3)[:,:,:,::-1]
+        k = k + 1
 
+      counts += np.moveaxis(table[:,:,j,k], -1, 0)
 
+    output = pd.DataFrame({'frame': np.tile(self.frames, len(settings)),
+                           'delta': np.repeat(settings[:,0], len(self.frames)),
+                           'lowercutoff': np.repeat(settings[:,1], len(self.frames)),
+                           'uppercutoff': np.repeat(settings[:,2], len(self.frames))},
+                          columns=['frame', 'delta', 'lowercutoff', 'uppercutoff'])
+    for (k, keypoint_type) in enumerate(types):
+      output[keypoint_type] = counts[:,:,k].ravel()
+    return output
@@ -0,0 +1,268 @@
+
+
+
+import numpy as np
+import packed_store as ps
+
+
+# Extension of descriptor index files (packed files, see packed_store)
+INDEX_EXTENSION = '.index' + ps.EXTENSION
+
+
+def squaredDistances(_a, _b, _b_norms=None):
+  """
+  Squared euclidean distances between the rows of _a and _b, as an (len(_a), len(_b)) array.
+  """
+  a = np.asarray(_a, dtype=np.float32)
+  b = np.asarray(_b, dtype=np.float32)
+  b_norms = np.einsum('ij,ij->i', b, b) if _b_norms is None else _b_norms
+  distances = np.einsum('ij,ij->i', a, a)[:,None] + b_norms[None,:] - 2*np.dot(a, b.T)
+  return np.maximum(distances, 0)
+
+
+def nearestCentroids(_vectors, _centroids, _chunk=8192):
+  """
+  Index of the nearest centroid of every vector, _chunk vectors at a time.
+  """
+  norms = np.einsum('ij,ij->i', _centroids, _centroids)
+  nearest = np.empty(len(_vectors), dtype=np.int64)
+  for start in range(0, len(_vectors), _chunk):
+    nearest[start:start + _chunk] = np.argmin(squaredDistances(_vectors[start:start + _chunk], _centroids, norms), axis=1)
+  return nearest
+
+
+def kMeans(_vectors, _clusters, _iterations=20, _seed=0):
+  """
+  Lloyd's k-means, started from _clusters distinct vectors drawn with _seed. Clusters that run
+  empty are restarted at a random vector. Returns the centroids.
+  """
+  rng = np.random.RandomState(_seed)
+  vectors = np.asarray(_vectors, dtype=np.float32)
+  centroids = vectors[rng.choice(len(vectors), _clusters, replace=False)].copy()
+
+  for iteration in range(_iterations):
+    nearest = nearestCentroids(vectors, centroids)
+    counts = np.bincount(nearest, minlength=_clusters)
+    empty = counts == 0
+    # Sums of the sorted vectors of every non-empty cluster
+    order = np.argsort(nearest, kind='stable')
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[~empty]
+    sums = np.add.reduceat(vectors[order].astype(np.float64), starts, axis=0)
+    centroids[~empty] = sums/counts[~empty][:,None]
+    centroids[empty] = vectors[rng.choice(len(vectors), int(np.sum(empty)))]
+
+  return centroids
+
+
+class DescriptorIndex(object):
+  """
+  Approximate nearest neighbour index over keypoint descriptors (the feature vectors of
+  computer_vision.getFeatureVector(s), e.g. the f0, f1, ... columns of a feature store), stored as
+  a packed file and read through memory maps, so the descriptors of a whole run are searched
+  without loading them.
+
+  The descriptors are optionally projected on their leading principal components and optionally
+  quantized to uint8 per dimension (an affine map of the range of every dimension). An inverted
+  file over a k-means partition keeps the (compressed) descriptors of each cell together; a query
+  only compares against the cells of its _nprobe nearest centroids, which trades recall for
+  speed: _nprobe = nlist is an exhaustive search of the compressed descriptors.
+
+  Every descriptor keeps its row in the indexed array and the frame and keypoint idx it came
+  from (rows, frames, idx), so results can be mapped back by position.
+  """
+
+  def __init__(self, _file):
+    arrays, attrs = ps.openPacked(_file)
+    if attrs.get('kind') != 'descriptor_index':
+      raise ValueError('DescriptorIndex: "' + str(_file) + '" is not a descriptor index')
+    self.attrs = attrs
+    self.mean = np.asarray(arrays['mean'])
+    self.components = np.asarray(arrays['components']) if attrs['pca'] else None
+    self.scale = np.asarray(arrays['scale']) if attrs['quantize'] else None
+    self.offset = np.asarray(arrays['offset']) if attrs['quantize'] else None
+    self.centroids = np.asarray(arrays['centroids'])
+    self.list_offsets = np.asarray(arrays['list_offsets'])
+    self.codes = arrays['codes']
+    self.rows = arrays['rows']
+    self.frames = arrays['frames']
+    self.idx = arrays['idx']
+
+  def __len__(self):
+    return len(self.codes)
+
+  def transform(self, _descriptors):
+    """
+    Descriptors in the space of the index (centered, projected if the index uses PCA).
+    """
+    return transform(_descriptors, self.mean, self.components)
+
+  def decode(self, _codes):
+    """
+    Stored codes back in the space of the index.
+    """
+    if self.scale is None:
+      return np.asarray(_codes, dtype=np.float32)
+    return np.asarray(_codes, dtype=np.float32)*self.scale + self.offset
+
+  def search(self, _queries, _k=10, _nprobe=8, _batch=4096):
+    """
+    The _k approximate nearest neighbours of every query descriptor. Queries are processed
+    _batch at a time: the cells probed by a batch are each read once and compared with all the
+    queries of the batch probing them. Returns the euclidean distances (in the space of the
+    index) and the positions of the neighbours in the index, both (queries, _k) and sorted by
+    distance; positions are -1 (distance inf) where fewer than _k descriptors were probed.
+    """
+    queries = self.transform(np.atleast_2d(_queries))
+    nprobe = min(_nprobe, len(self.centroids))
+    distances = np.full((len(queries), _k), np.inf, dtype=np.float32)
+    positions = -np.ones((len(queries), _k), dtype=np.int64)
+
+    for start in range(0, len(queries), _batch):
+      batch = queries[start:start + _batch]
+      best_d = np.full((len(batch), _k), np.inf, dtype=np.float32)
+      best_p = -np.ones((len(batch), _k), dtype=np.int64)
+
+      # Cells probed by every query, then the queries probing every cell
+      coarse = squaredDistances(batch, self.centroids)
+      probes = np.argpartition(coarse, nprobe - 1, axis=1)[:,:nprobe] if nprobe < len(self.centroids) else np.tile(np.arange(nprobe), (len(batch), 1))
+      probe_queries = np.repeat(np.arange(len(batch)), nprobe)
+      probe_cells = probes.ravel()
+      order = np.argsort(probe_cells, kind='stable')
+      cells, first = np.unique(probe_cells[order], return_index=True)
+      bounds = np.append(first, len(order))
+
+      for (cell, lo, hi) in zip(cells, bounds[:-1], bounds[1:]):
+        [cell_start, cell_stop] = self.list_offsets[cell:cell + 2]
+        if cell_start == cell_stop:
+          continue
+        rows = probe_queries[order[lo:hi]]
+        candidates = squaredDistances(batch[rows], self.decode(self.codes[cell_start:cell_stop]))
+        # Merge with the best so far
+        merged_d = np.concatenate((best_d[rows], candidates), axis=1)
+        merged_p = np.concatenate((best_p[rows], np.broadcast_to(np.arange(cell_start, cell_stop), candidates.shape)), axis=1)
+        keep = np.argpartition(merged_d, _k - 1, axis=1)[:,:_k] if merged_d.shape[1] > _k else np.argsort(merged_d, axis=1)
+        best_d[rows] = np.take_along_axis(merged_d, keep, axis=1)
+        best_p[rows] = np.take_along_axis(merged_p, keep, axis=1)
+
+      ranked = np.argsort(best_d, axis=1, kind='stable')
+      distances[start:start + _batch] = np.sqrt(np.take_along_axis(best_d, ranked, axis=1))
+      positions[start:start + _batch] = np.take_along_axis(best_p, ranked, axis=1)
+
+    positions[~np.isfinite(distances)] = -1
+    return distances, positions
+
+
+def transform(_descriptors, _mean, _components):
+  """
+  Centered descriptors, projected on the principal components if given.
+  """
+  vectors = np.asarray(_descriptors, dtype=np.float32) - _mean
+  if _components is not None:
+    vectors = np.dot(vectors, _components)
+  return vectors
+
+
+def buildIndex(_descriptors, _frames, _idx, _output, _nlist=None, _components=None, _quantize=False, _train_size=100000, _iterations=20, _seed=0, _chunk=65536):
+  """
+  Builds a descriptor index (see DescriptorIndex) over the rows of _descriptors (an array or a
+  memory map, read _chunk rows at a time), with the frame and keypoint idx of every row, and
+  writes it to _output. The mean, the _components principal components (None for no PCA), the
+  quantization ranges and the _nlist k-means centroids (default about the square root of the
+  number of descriptors) are trained on a sample of at most _train_size descriptors drawn with
+  _seed. Returns the index, opened from _output.
+  """
+  n = len(_descriptors)
+  if n == 0:
+    raise ValueError('buildIndex: no descriptors to index')
+  rng = np.random.RandomState(_seed)
+  sample = np.sort(rng.choice(n, min(n, _train_size), replace=False))
+  training = np.asarray(_descriptors[sample], dtype=np.float32)
+
+  mean = training.mean(axis=0)
+  components = None
+  if _components is not None:
+    components = np.linalg.svd(training - mean, full_matrices=False)[2][:_components].T.astype(np.float32)
+  training = transform(training, mean, components)
+
+  scale = None
+  offset = None
+  if _quantize:
+    offset = training.min(axis=0)
+    scale = np.maximum(training.max(axis=0) - offset, 1e-6)/255.
+
+  nlist = _nlist if _nlist is not None else max(1, int(np.sqrt(n)))
+  nlist = min(nlist, len(training))
+  centroids = kMeans(training, nlist, _iterations, _seed)
+
+  # Cell of every descriptor, then the rows in cell order
+  cells = np.empty(n, dtype=np.int64)
+  for start in range(0, n, _chunk):
+    cells[start:start + _chunk] = nearestCentroids(transform(_descriptors[start:start + _chunk], mean, components), centroids)
+  order = np.argsort(cells, kind='stable')
+  list_offsets = np.concatenate(([0], np.cumsum(np.bincount(cells, minlength=nlist))))
+
+  dims = centroids.shape[1]
+  specs = [('mean', np.float32, mean.shape), ('centroids', np.float32, centroids.shape), ('list_offsets', np.int64, list_offsets.shape),
+           ('codes', np.uint8 if _quantize else np.float32, (n, dims)), ('rows', np.int64, (n,)), ('frames', np.int64, (n,)), ('idx', np.int64, (n,))]
+  if components is not None:
+    specs.append(('components', np.float32, components.shape))
+  if _quantize:
+    specs += [('scale', np.float32, scale.shape), ('offset', np.float32, offset.shape)]
+  attrs = {'kind': 'descriptor_index', 'pca': components is not None, 'quantize': bool(_quantize),
+           'descriptor_dims': int(np.shape(_descriptors)[1]), 'dims': int(dims), 'nlist': int(nlist), 'seed': int(_seed)}
+
+  out = ps.createPacked(_output, specs, attrs)
+  out['mean'][:] = mean
+  out['centroids'][:] = centroids
+  out['list_offsets'][:] = list_offsets
+  if components is not None:
+    out['components'][:] = components
+  if _quantize:
+    out['scale'][:] = scale
+    out['offset'][:] = offset
+  for start in range(0, n, _chunk):
+    rows = order[start:start + _chunk]
+    # Read in row order, write in cell order
+    sorted_rows = np.sort(rows)
+    vectors = transform(_descriptors[sorted_rows], mean, components)[np.searchsorted(sorted_rows, rows)]
+    if _quantize:
+      vectors = np.clip(np.rint((vectors - offset)/scale), 0, 255)
+    out['codes'][start:start + len(rows)] = vectors
+    out['rows'][start:start + len(rows)] = rows
+    out['frames'][start:start + len(rows)] = np.asarray(_frames)[rows]
+    out['idx'][start:start + len(rows)] = np.asarray(_idx)[rows]
+  for array in out.values():
+    if isinstance(array, np.memmap):
+      array.flush()
+  del out
+
+  return DescriptorIndex(_output)
+
+
+def exactSearch(_descriptors, _queries, _k=10, _chunk=65536):
+  """
+  Exact _k nearest neighbours of the queries among the rows of _descriptors by brute force,
+  _chunk rows at a time, for measuring the recall of an index. Returns the euclidean distances
+  and the row positions, both (queries, _k).
+  """
+  queries = np.atleast_2d(np.asarray(_queries, dtype=np.float32))
+  best_d = np.full((len(queries), 0), np.inf, dtype=np.float32)
+  best_p = np.zeros((len(queries), 0), dtype=np.int64)
+  for start in range(0, len(_descriptors), _chunk):
+    chunk = np.asarray(_descriptors[start:start + _chunk], dtype=np.float32)
+    merged_d = np.concatenate((best_d, squaredDistances(queries, chunk)), axis=1)
+    merged_p = np.concatenate((best_p, np.broadcast_to(np.arange(start, start + len(chunk)), (len(queries), len(chunk)))), axis=1)
+    keep = np.argpartition(merged_d, _k - 1, axis=1)[:,:_k] if merged_d.shape[1] > _k else np.arange(merged_d.shape[1])[None,:].repeat(len(queries), axis=0)
+    best_d = np.take_along_axis(merged_d, keep, axis=1)
+    best_p = np.take_along_axis(merged_p, keep, axis=1)
+  ranked = np.argsort(best_d, axis=1, kind='stable')
+  return np.sqrt(np.take_along_axis(best_d, ranked, axis=1)), np.take_along_axis(best_p, ranked, axis=1)
+
+
+def recall(_found, _exact):
+  """
+  Fraction of the exact neighbours found, averaged over the queries, given as the rows of the
+  found and the exact neighbours (e.g. index.rows of the positions found by search).
+  """
+  k = _exact.shape[1]
+  return np.mean([len(np.intersect1d(f, e))/float(k) for (f, e) in zip(_found, _exact)])
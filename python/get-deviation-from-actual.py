@@ -7,16 +7,18 @@ import math
 import os
 import pandas as pd
 import numpy as np
+import match_graph as mg
+import instrumentation
 
 
-parser = OptionParser('usage: -d dir --i1 input_pattern_1 --i2 input_pattern_2 -n index -s step_size --o1 output_file_1 --o2 output_file_2'  )
+parser = OptionParser('usage: -d dir --i1 input_pattern_1 --i2 input_pattern_2 (-n index -s step_size --o1 output_file_1 --o2 output_file_2 | --start first_frame --end last_frame --horizons h1,h2,... -o output_file)'  )
 
 parser.add_option("-d", dest="dir",
                   help="parent directory")
 parser.add_option("--i1", dest="input_pattern_1",
-                  help="first input matching file pattern relative to directory")
+                  help="first input matching file pattern (or packed store) relative to directory")
 parser.add_option("--i2", dest="input_pattern_2",
-                  help="second input matching file pattern relative to directory")
+                  help="second input matching file pattern (or packed store) relative to directory")
 parser.add_option("-n", dest="index",
                   help="index number for beginning matching file")
 parser.add_option("-s", dest="step_size",
@@ -25,155 +27,97 @@ parser.add_option("--o1", dest="output_file_1",
                   help="output for deviations relative to directory")
 parser.add_option("--o2", dest="output_file_2",
                   help="output for deviations relative to directory")
+parser.add_option("--start", dest="start",
+                  help="run-wide mode: first start frame")
+parser.add_option("--end", dest="end",
+                  help="run-wide mode: last matching frame")
+parser.add_option("--horizons", dest="horizons",
+                  help="run-wide mode: comma-separated numbers of steps for each end-to-end matching")
+parser.add_option("-o", dest="output_file",
+                  help="run-wide mode: output table of deviations relative to directory")
+instrumentation.addTraceOption(parser)
 
 (options, args) = parser.parse_args()
-
-# Parse the inputs
-index = int(options.index)
-steps = int(options.step_size)
-
-# Load data for first matchings
-data1 = pd.read_csv(options.dir + "/" + options.input_pattern_1 % index)
-for i in range(1, steps+1):
-    data1['idx_%d' % i] = -1
-    data1['birth_%d' % i] = -1
-    data1['death_%d' % i] = -1
-    data1['b_x_%d' % i] = -1
-    data1['b_y_%d' % i] = -1
-    data1['d_x_%d' % i] = -1
-    data1['d_y_%d' % i] = -1
-data1['finalmatch'] = data1['matchedidx']
-data1['deviation'] = -1
-all_index_1 = set(range(0,len(data1)))
-
-# Load initial data for second matchings (assumed to be same as initial data for first matchings)
-# Note that terminal matching files are also assumed to be the same for both datasets.
-data2 = pd.read_csv(options.dir + "/" + options.input_pattern_2 % index)
-for i in range(1, steps+1):
-    data2['idx_%d' % i] = -1
-    data2['birth_%d' % i] = -1
-    data2['death_%d' % i] = -1
-    data2['b_x_%d' % i] = -1
-    data2['b_y_%d' % i] = -1
-    data2['d_x_%d' % i] = -1
-    data2['d_y_%d' % i] = -1
-data2['finalmatch'] = data2['matchedidx']
-data2['deviation'] = -1
-all_index_2 = set(range(0,len(data2)))
-
-###### MAKE NICE ERROR MESSAGE IF THE LENGTHS OF THESE FILES IS DIFFERENT ######
-print "(%d, %d)" % (len(data1), len(data2))
-
-
-# Load all the matching data into an array and update the finalmatch in the initial data.
-# That is, update to new match if found, update to -1 if not matched through.
-for i in range(index + 1, index + steps + 1):
-    matchdata = pd.read_csv(options.dir + "/" + options.input_pattern_1 % i)
-    result = data1.merge(matchdata, left_on='finalmatch', right_index=True, how='inner')
-
-    result_index = set(result['idx_x'])
-    result_not_index = set(all_index_1) - result_index
-
-    result_index = sorted(result_index)
-    result_not_index = sorted(result_not_index)
-
-    # Update matched
-    if (i < (index + steps)):
-        data1.loc[result_index, 'finalmatch'] = result['matchedidx_y'].astype(int)
-    data1.loc[result_index, 'idx_%d' % (i - index)] = result['idx_y'].astype(int)
-    data1.loc[result_index, 'birth_%d' % (i - index)] = result['birth_y'].astype(int)
-    data1.loc[result_index, 'death_%d' % (i - index)] = result['death_y'].astype(int)
-    data1.loc[result_index, 'b_x_%d' % (i - index)] = result['b_x_y'].astype(int)
-    data1.loc[result_index, 'b_y_%d' % (i - index)] = result['b_y_y'].astype(int)
-    data1.loc[result_index, 'd_x_%d' % (i - index)] = result['d_x_y'].astype(int)
-    data1.loc[result_index, 'd_y_%d' % (i - index)] = result['d_y_y'].astype(int)
-
-    # Update unmatched to -1
-    data1.loc[result_not_index, 'finalmatch'] = -1
-
-    matchdata = []
-
-matched_indices_1 = (data1['finalmatch'] != -1)
-
-# Load all the matching data into an array and update the finalmatch in the initial data.
-# That is, update to new match if found, update to -1 if not matched through.
-for i in range(index + 1, index + steps + 1):
-    matchdata = pd.read_csv(options.dir + "/" + options.input_pattern_2 % i)
-    result = data2.merge(matchdata, left_on='finalmatch', right_index=True, how='inner')
-
-    result_index = set(result['idx_x'])
-    result_not_index = set(all_index_2) - result_index
-
-    result_index = sorted(result_index)
-    result_not_index = sorted(result_not_index)
-
-    # Update matched
-    if (i < (index + steps)):
-        data2.loc[result_index, 'finalmatch'] = result['matchedidx_y'].astype(int)
-    # Change this to output the ids.
-    data2.loc[result_index, 'idx_%d' % (i - index)] = result['idx_y'].astype(int)
-    data2.loc[result_index, 'birth_%d' % (i - index)] = result['birth_y'].astype(int)
-    data2.loc[result_index, 'death_%d' % (i - index)] = result['death_y'].astype(int)
-    data2.loc[result_index, 'b_x_%d' % (i - index)] = result['b_x_y'].astype(int)
-    data2.loc[result_index, 'b_y_%d' % (i - index)] = result['b_y_y'].astype(int)
-    data2.loc[result_index, 'd_x_%d' % (i - index)] = result['d_x_y'].astype(int)
-    data2.loc[result_index, 'd_y_%d' % (i - index)] = result['d_y_y'].astype(int)
-
-    # Update unmatched to -1
-    data2.loc[result_not_index, 'finalmatch'] = -1
-
-    matchdata = []
-
-matched_indices_2 = (data2['finalmatch'] != -1)
-
-# Get the indices that were matched by both processes
-allmatches = matched_indices_1.to_frame().merge(matched_indices_2.to_frame(),left_index=True, right_index=True)
-allmatches['matched'] = allmatches['finalmatch_x']&allmatches['finalmatch_y']
-
-matched_indices = (allmatches['matched'] == True)
-
-
-
-# For any points matched in both processes (matched==True), compute the largest deviation 
-# from between the two inputs by computing pointwise distances.
-for i in range(1, steps+1):
-
-    print "Step %d. %d" % (i, len(matched_indices))
-
-    # Compute distance between corresponding points on the transitive matching paths
-    D = pd.DataFrame(columns=['tmp', 'deviation'])
-    D['tmp'] = ((data1.loc[matched_indices, 'birth_%d' % i] - data2.loc[matched_indices, 'birth_%d' % i])**2 + (data1.loc[matched_indices, 'death_%d' % i] - data2.loc[matched_indices, 'death_%d' % i])**2).apply(np.sqrt)
-    # Get current max deviations
-    D['deviation'] = data1.loc[matched_indices, 'deviation']
-
-    # Update max deviation
-    data1.loc[matched_indices, 'deviation'] = D.max(axis=1)
-    data2.loc[matched_indices, 'deviation'] = D.max(axis=1)
-
-
-# Output the deviation and matching results
-for i in range(index, index + steps):
-
-    if i==index:
-        data1.to_csv(options.dir + "/" + options.output_file_1 % i)
-        data2.to_csv(options.dir + "/" + options.output_file_2 % i)
-
-    data1_tmp = pd.read_csv(options.dir + "/" + options.input_pattern_1 % (i+1))
-    data2_tmp = pd.read_csv(options.dir + "/" + options.input_pattern_2 % (i+1))
-    data1_tmp['deviation'] = -1.
-    data2_tmp['deviation'] = -1.
-
-    update_deviation1 = (data1['deviation'] >= 0.)
-    update_deviation2 = (data2['deviation'] >= 0.)
-
-    filter1 = np.asarray(data1.loc[update_deviation1, 'idx_%d' % (i - index + 1)]).astype(int)
-    filter2 = np.asarray(data2.loc[update_deviation2, 'idx_%d' % (i - index + 1)]).astype(int)
-
-    # # Fix this so that the orders are correct; need to order based on idx_%d
-    data1_tmp.loc[filter1, 'deviation'] = np.asarray(data1.loc[update_deviation1, 'deviation'])
-    data2_tmp.loc[filter2, 'deviation'] = np.asarray(data2.loc[update_deviation2, 'deviation'])
-    data1_tmp.to_csv(options.dir + "/" + options.output_file_1 % i)
-    data2_tmp.to_csv(options.dir + "/" + options.output_file_2 % i)
-
-
-
+instrumentation.startTrace(options, sys.argv[0])
+
+if (options.start is None) != (options.end is None):
+    parser.error("run-wide mode requires both --start and --end")
+
+if options.start is None:
+
+    # Parse the inputs
+    index = int(options.index)
+    steps = int(options.step_size)
+
+    # Load the matchings of the whole horizon once for both inputs, as next-index arrays. The
+    # terminal matching tables are kept: they are written back with the deviations.
+    columns = ['idx', 'birth', 'death']
+    graph1 = mg.loadMatchGraph(options.dir + "/" + options.input_pattern_1, index, index + steps, 'matchedidx', columns, range(index + 1, index + steps + 1))
+    graph2 = mg.loadMatchGraph(options.dir + "/" + options.input_pattern_2, index, index + steps, 'matchedidx', columns, range(index + 1, index + steps + 1))
+
+    # The initial data for second matchings is assumed to be the same as the initial data for first
+    # matchings. Note that terminal matching files are also assumed to be the same for both datasets.
+    print("(%d, %d)" % (graph1.size(index), graph2.size(index)))
+    if graph1.size(index) != graph2.size(index):
+        sys.exit("Initial matching files of the two inputs differ in length (%d, %d)" % (graph1.size(index), graph2.size(index)))
+
+    # Follow every point along its chain of matches in both inputs (row in frame index + k, -1 once
+    # not matched through).
+    paths1 = graph1.paths(index, steps)
+    paths2 = graph2.paths(index, steps)
+
+    # For any points matched in both processes, compute the largest deviation from between the two
+    # inputs by computing pointwise distances.
+    with instrumentation.Stage('deviation', frame=index, horizon=steps) as stage:
+        matched_indices, deviation = mg.actualDeviation(graph1, graph2, index, steps, paths1, paths2)
+        stage.items = int(np.sum(matched_indices))
+
+    # Output the deviation and matching results: the deviation of a chain is written to the point
+    # it reaches in each frame.
+    for i in range(index, index + steps):
+
+        data1_tmp = graph1.table(i+1)
+        data2_tmp = graph2.table(i+1)
+        data1_tmp['deviation'] = -1.
+        data2_tmp['deviation'] = -1.
+
+        filter1 = graph1.values(i+1, paths1[i - index + 1][matched_indices], 'idx').astype(int)
+        filter2 = graph2.values(i+1, paths2[i - index + 1][matched_indices], 'idx').astype(int)
+
+        data1_tmp.loc[filter1, 'deviation'] = deviation
+        data2_tmp.loc[filter2, 'deviation'] = deviation
+        data1_tmp.to_csv(options.dir + "/" + options.output_file_1 % i)
+        data2_tmp.to_csv(options.dir + "/" + options.output_file_2 % i)
+
+else:
+
+    # RUN-WIDE MODE
+    # The deviation of every start frame in [start, end) is computed for every horizon that stays
+    # within the run, in one pass: both match graphs slide along the run, so each matching file is
+    # read once. One table keyed by (start_frame, horizon, idx) holds the points matched through in
+    # both inputs, with their rows in the terminal frame and their deviation.
+    start = int(options.start)
+    end = int(options.end)
+    horizons = sorted(set(int(h) for h in options.horizons.split(',')))
+
+    graph1 = mg.MatchGraph('matchedidx', ['birth', 'death'])
+    graph2 = mg.MatchGraph('matchedidx', ['birth', 'death'])
+
+    with open(options.dir + "/" + options.output_file, 'w') as f:
+        f.write('start_frame,horizon,idx,finalmatch_1,finalmatch_2,deviation\n')
+
+        for t in mg.slidingWindow([graph1, graph2], [options.dir + "/" + options.input_pattern_1, options.dir + "/" + options.input_pattern_2], start, end, horizons[-1]):
+            if graph1.size(t) != graph2.size(t):
+                sys.exit("Matching files of frame %d of the two inputs differ in length (%d, %d)" % (t, graph1.size(t), graph2.size(t)))
+
+            with instrumentation.Stage('deviation', frame=t) as stage:
+                paths1 = graph1.paths(t, min(horizons[-1], end - t))
+                paths2 = graph2.paths(t, min(horizons[-1], end - t))
+                stage.items = 0
+
+                for steps in [h for h in horizons if t + h <= end]:
+                    matched_indices, deviation = mg.actualDeviation(graph1, graph2, t, steps, paths1, paths2)
+                    idx = np.nonzero(matched_indices)[0]
+                    table = pd.DataFrame({'start_frame': t, 'horizon': steps, 'idx': idx, 'finalmatch_1': paths1[steps][idx], 'finalmatch_2': paths2[steps][idx], 'deviation': deviation})
+                    table.to_csv(f, header=False, index=False, columns=['start_frame', 'horizon', 'idx', 'finalmatch_1', 'finalmatch_2', 'deviation'])
+                    stage.items += len(idx)
@@ -7,80 +7,93 @@ import math
 import os
 import pandas as pd
 import numpy as np
+import match_graph as mg
+import instrumentation
 
 
-parser = OptionParser('usage: -d dir -i input_pattern -n index -l linear_steps -o output_file'  )
+parser = OptionParser('usage: -d dir -i input_pattern (-n index -l linear_steps | --start first_frame --end last_frame --horizons h1,h2,...) -o output_file'  )
 
 parser.add_option("-d", dest="dir",
                   help="parent directory")
 parser.add_option("-i", dest="input_pattern",
-                  help="input matching file pattern relative to directory")
+                  help="input matching file pattern (or packed store) relative to directory")
 parser.add_option("-n", dest="index",
                   help="index number for beginning matching file")
 parser.add_option("-l", dest="linear_steps",
                   help="number of steps for end-to-end matching")
 parser.add_option("-o", dest="output_file",
                   help="output for deviations relative to directory")
+parser.add_option("--start", dest="start",
+                  help="run-wide mode: first start frame")
+parser.add_option("--end", dest="end",
+                  help="run-wide mode: last matching frame")
+parser.add_option("--horizons", dest="horizons",
+                  help="run-wide mode: comma-separated numbers of steps for end-to-end matching")
+instrumentation.addTraceOption(parser)
 
 (options, args) = parser.parse_args()
-
-# Parse the inputs
-index = int(options.index)
-steps = int(options.linear_steps)
-
-# Load initial data
-data = pd.read_csv(options.dir + "/" + options.input_pattern % index)
-for i in range(1, steps+1):
-    data['birth_%d' % i] = -1
-    data['death_%d' % i] = -1
-data['finalmatch'] = data['isMatched']
-data['deviation'] = -1
-all_index = set(range(0,len(data)))
-
-# Load all the matching data into an array and update the finalmatch in the initial data.
-# That is, update to new match if found, update to -1 if not matched through.
-for i in range(index + 1, index + steps + 1):
-    matchdata = pd.read_csv(options.dir + "/" + options.input_pattern % i)
-    result = data.merge(matchdata, left_on='finalmatch', right_index=True, how='inner')
-
-    result_index = set(result['Unnamed: 0_x'])
-    result_not_index = set(all_index) - result_index
-
-    result_index = sorted(result_index)
-    result_not_index = sorted(result_not_index)
-
-    # Update matched
-    if (i < (index + steps)):
-        data.loc[result_index, 'finalmatch'] = result['isMatched_y']
-    data.loc[result_index, 'birth_%d' % (i - index)] = result['birth_y']
-    data.loc[result_index, 'death_%d' % (i - index)] = result['death_y']
-
-    # Update unmatched to -1
-    data.loc[result_not_index, 'finalmatch'] = -1
-
-    matchdata = []
-
-matched_indices = (data['finalmatch'] != -1)
-
-# For any transitively-matched points (finalmatch != -1), compute the largest deviation 
-# from the planar linear interpolation based on the two terminal matched points.
-for i in range(1, steps + 1):
-
-    # Parameterize line between starting and terminal point in number of steps
-    L = pd.DataFrame(columns=['birth', 'death'])
-    L['birth'] = data.loc[matched_indices, 'birth'] + (float(i)/float(steps))*(data.loc[matched_indices, 'birth_%d' % i] - data.loc[matched_indices, 'birth'])
-    L['death'] = data.loc[matched_indices, 'death'] + (float(i)/float(steps))*(data.loc[matched_indices, 'death_%d' % i] - data.loc[matched_indices, 'death'])
-
-    # Compute distance between the line and the actual point on the transitive matching path
-    D = pd.DataFrame(columns=['tmp', 'deviation'])
-    D['tmp'] = ((L['birth'] - data.loc[matched_indices, 'birth'])**2 + (L['death'] - data.loc[matched_indices, 'death'])**2).apply(np.sqrt)
-    D['deviation'] = data.loc[matched_indices, 'deviation']
-
-    # Update max deviation
-    data.loc[matched_indices, 'deviation'] = D.max(axis=1)
-
-# Output the deviation and matching results
-data = data.rename(columns={'Unnamed: 0': 'idx'})
-data.to_csv(options.dir + "/" + options.output_file)
-
-
+instrumentation.startTrace(options, sys.argv[0])
+
+if (options.start is None) != (options.end is None):
+    parser.error("run-wide mode requires both --start and --end")
+
+if options.start is None:
+
+    # Parse the inputs
+    index = int(options.index)
+    steps = int(options.linear_steps)
+
+    # Load the matchings of the whole horizon once, as next-index arrays
+    graph = mg.loadMatchGraph(options.dir + "/" + options.input_pattern, index, index + steps, 'isMatched', ['birth', 'death'], [index])
+    data = graph.table(index)
+
+    # Follow every point along its chain of matches. The birth/death of the point k steps ahead is
+    # kept if the chain is unbroken up to that frame, -1 otherwise; the final match is the row in the
+    # terminal frame, -1 if not matched through.
+    paths = graph.paths(index, steps)
+    for i in range(1, steps+1):
+        data['birth_%d' % i] = graph.values(index + i, paths[i], 'birth')
+        data['death_%d' % i] = graph.values(index + i, paths[i], 'death')
+    data['finalmatch'] = paths[steps].astype(data['isMatched'].dtype)
+    data['deviation'] = -1
+
+    # For any transitively-matched points (finalmatch != -1), compute the largest deviation 
+    # from the planar linear interpolation based on the two terminal matched points.
+    with instrumentation.Stage('deviation', frame=index, horizon=steps) as stage:
+        matched_indices, deviation = mg.linearDeviation(graph, index, steps, paths)
+        stage.items = int(np.sum(matched_indices))
+    if np.any(matched_indices):
+        data['deviation'] = -1.
+        data.loc[matched_indices, 'deviation'] = deviation
+
+    # Output the deviation and matching results
+    data = data.rename(columns={'Unnamed: 0': 'idx'})
+    data.to_csv(options.dir + "/" + options.output_file)
+
+else:
+
+    # RUN-WIDE MODE
+    # The deviation of every start frame in [start, end) is computed for every horizon that stays
+    # within the run, in one pass: the match graph slides along the run, so each matching file is
+    # read once. One table keyed by (start_frame, horizon, idx) holds the points matched through,
+    # with their row in the terminal frame and their deviation.
+    start = int(options.start)
+    end = int(options.end)
+    horizons = sorted(set(int(h) for h in options.horizons.split(',')))
+
+    graph = mg.MatchGraph('isMatched', ['birth', 'death'])
+
+    with open(options.dir + "/" + options.output_file, 'w') as f:
+        f.write('start_frame,horizon,idx,finalmatch,deviation\n')
+
+        for t in mg.slidingWindow([graph], [options.dir + "/" + options.input_pattern], start, end, horizons[-1]):
+            with instrumentation.Stage('deviation', frame=t) as stage:
+                paths = graph.paths(t, min(horizons[-1], end - t))
+                stage.items = 0
+
+                for steps in [h for h in horizons if t + h <= end]:
+                    matched_indices, deviation = mg.linearDeviation(graph, t, steps, paths)
+                    idx = np.nonzero(matched_indices)[0]
+                    table = pd.DataFrame({'start_frame': t, 'horizon': steps, 'idx': idx, 'finalmatch': paths[steps][idx], 'deviation': deviation})
+                    table.to_csv(f, header=False, index=False, columns=['start_frame', 'horizon', 'idx', 'finalmatch', 'deviation'])
+                    stage.items += len(idx)
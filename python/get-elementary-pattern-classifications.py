@@ -3,85 +3,106 @@
 
 import sys
 from optparse import OptionParser
-from PIL import Image
 import numpy as np
 import os
 
 import pandas as pd
 
-import scipy
-from scipy.cluster import hierarchy as hc
-from skimage import morphology
 from scipy import misc
-import math, time
-from skimage import measure
+import data_access as da
+import packed_store as ps
+import pattern_classification as pc
+import instrumentation
 
 
-parser = OptionParser('usage: -d dir -b image.bmp -p pattern.csv -s singular_points.txt -r roll_width -o output.bmp'  )
+parser = OptionParser('usage: -d dir -b image.bmp -p pattern.csv -s singular_points.txt -r roll_width -o output.bmp [--start first_frame --end last_frame]'  )
 
 parser.add_option("-d", dest="dir",
                   help="parent directory")
 parser.add_option("-b", dest="bmp",
-                  help="bitmap image")
+                  help="bitmap image (image pattern or packed frame stack in batch mode)")
 parser.add_option("-p", dest="pattern",
-                  help="persistent homology pattern matching data")
+                  help="persistent homology pattern matching data (pattern in batch mode)")
 parser.add_option("-s", dest="singular_points",
-                  help="singular point data")
+                  help="singular point data (pattern in batch mode)")
 parser.add_option("-r", dest="roll_width",
                   help="single roll width")
 parser.add_option("-o", dest="output",
-                  help="output file")
+                  help="output file (image pattern or packed mask stack in batch mode)")
+parser.add_option("--start", dest="start",
+                  help="batch mode: index of the first frame")
+parser.add_option("--end", dest="end",
+                  help="batch mode: index of the last frame")
+instrumentation.addTraceOption(parser)
 
 (options, args) = parser.parse_args()
+instrumentation.startTrace(options, sys.argv[0])
 
+if (options.start is None) != (options.end is None):
+  parser.error("batch mode requires both --start and --end")
 
-# Load the input data
-bmp = misc.imread(options.dir + "/" + options.bmp)
-bmp = bmp.astype(float)
-
-matches = pd.read_csv(options.dir + "/" + options.pattern)
+roll_width = int(options.roll_width)
 
-ph_defects = matches[['center_x', 'center_y']]
-ph_defects = ph_defects.astype(np.int)
 
-singular_points = pd.read_csv(options.dir + "/" + options.singular_points, sep=' ', names=['x', 'y', 'type'])
-singular_points = singular_points.astype(np.int)
+def loadDefects(_pattern_file, _singular_points_file):
+  matches = pd.read_csv(_pattern_file)
+  ph_defects = matches[['center_x', 'center_y']].astype(int)
 
-roll_width = int(options.roll_width)
+  singular_points = pd.read_csv(_singular_points_file, sep=' ', names=['x', 'y', 'type'])
+  singular_points = singular_points.astype(int)
 
-# Generate mask info
-mask = np.zeros(bmp.shape) # Location of masks
-maskids = {0:'Unassigned'} # Definitions of mask types
+  return singular_points, ph_defects
 
-## GET PARALLEL ROLL REGIONS
-# Dilate the absolute value of the topological and p.h. defects by 1 roll_width
-# Mask out the original image by this dilation
-# Remaining regions are the candidate parallel roll regions
 
-defects = np.zeros(bmp.shape)
-defects[singular_points['x'], singular_points['y']] = 1
-defects[ph_defects['center_y'], ph_defects['center_x']] = 1
+if options.start is None:
 
-defects_dilated = morphology.binary_dilation(defects, morphology.disk(roll_width))
+  # Load the input data
+  bmp = misc.imread(options.dir + "/" + options.bmp)
+  singular_points, ph_defects = loadDefects(options.dir + "/" + options.pattern, options.dir + "/" + options.singular_points)
 
-# Remove small regions not filtered out
-# defects_dilated = morphology.binary_dilation(defects_dilated, morphology.disk(0.5*roll_width))
-# defects_dilated = morphology.binary_erosion(defects_dilated, morphology.disk(0.5*roll_width))
+  with instrumentation.Stage('classification') as stage:
+    mask = pc.classifyFrame(bmp.shape, singular_points, ph_defects, roll_width)
+    stage.items = int(np.sum(mask == 255))
 
-# Invert to get the indicator function for the parallel roll regions
-defects_dilated_mask = np.invert(defects_dilated)
+  ## OUTPUT MASK
+  misc.imsave(options.dir + "/" + options.output, mask)
+  print(pc.MASK_IDS)
 
-# Add these regions to the mask
-mask[defects_dilated_mask] = 255
-maskids[255] = 'Parallel rolls'
+else:
 
+  # BATCH MODE
+  # The masks of frames [start, end] are computed in one process and written to one packed
+  # (T, H, W) uint8 stack, with the mask types in its attributes, or to one image per frame.
+  start = int(options.start)
+  end = int(options.end)
+  frames = range(start, end + 1)
 
-## OUTPUT MASK
-misc.imsave(options.dir + "/" + options.output, mask.astype(np.uint8))
-print maskids
+  if ps.isPacked(options.bmp):
+    shape = da.loadTemperatureFields(options.dir + "/" + options.bmp, start).shape
+  else:
+    shape = misc.imread(options.dir + "/" + options.bmp % start).shape
 
+  stack = None
+  if ps.isPacked(options.output):
+    out = ps.createPacked(options.dir + "/" + options.output, [('stack', np.uint8, (len(frames),) + shape), ('frames', np.int64, (len(frames),))], \
+                          {'kind': 'frames', 'maskids': dict((str(k), v) for k, v in pc.MASK_IDS.items())})
+    out['frames'][:] = frames
+    stack = out['stack']
 
+  for i in frames:
+    singular_points, ph_defects = loadDefects(options.dir + "/" + options.pattern % i, options.dir + "/" + options.singular_points % i)
+    with instrumentation.Stage('classification', frame=i) as stage:
+      mask = pc.classifyFrame(shape, singular_points, ph_defects, roll_width)
+      stage.items = int(np.sum(mask == 255))
 
+    if stack is not None:
+      stack[i - start] = mask
+    else:
+      misc.imsave(options.dir + "/" + options.output % i, mask)
 
+    print("Frame %d: %d parallel roll pixels" % (i, np.sum(mask == 255)))
 
+  if stack is not None:
+    stack.flush()
 
+  print(pc.MASK_IDS)
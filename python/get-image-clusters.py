@@ -4,74 +4,75 @@
 import sys
 from optparse import OptionParser
 import numpy as np
-import scipy
-from scipy.cluster import hierarchy as hc
 import os
 import pandas as pd
+import clustering
+import instrumentation
 
 
 
-parser = OptionParser('usage: -d dir -m pattern_matches.csv -r roll_width'  )
+parser = OptionParser('usage: -d dir -m pattern_matches.csv -r roll_width [--start first_frame --end last_frame -o clusters.csv]'  )
 
 parser.add_option("-d", dest="dir",
                   help="parent directory")
 parser.add_option("-m", dest="pattern_matches",
-                  help="pattern matches")
+                  help="pattern matches (pattern in range mode)")
 parser.add_option("-r", dest="roll_width",
                   help="single roll width")
-
+parser.add_option("--start", dest="start",
+                  help="range mode: index of the first frame")
+parser.add_option("--end", dest="end",
+                  help="range mode: index of the last frame")
+parser.add_option("-o", dest="output",
+                  help="output cluster table (required in range mode)")
+instrumentation.addTraceOption(parser)
 
 (options, args) = parser.parse_args()
+instrumentation.startTrace(options, sys.argv[0])
 
-roll_width = int(options.roll_width)
-
-## Load the pattern matching data
-matches = pd.read_csv(options.dir + "/" + options.pattern_matches)
-
-## Get the clusters from the pattern matching data
-# Get the vectors from the matches dataframe
-vectors = matches.as_matrix(columns=["center_x", "center_y"])
-
-# Run the hierarchical cluster algorithm
-fclusters = hc.fclusterdata(vectors, 1.5*roll_width, criterion="distance")
-
-# Append cluster data to pattern matching dataframe
-matches['cluster'] = fclusters
-
-## Generate the cluster output table (pivot the matches table)
-# Get the counts
-counts = matches.pivot_table(index=["cluster"], 
-                        columns="match_type",
-                        values=["center_x"],
-                        aggfunc=len, 
-                        fill_value=0)
-
-# Get the averages
-averages = matches.groupby(['cluster'])['center_x', 'center_y'].mean()
-
-# Get the diameters
-
-def computeDiameter(x):
-    pdist = scipy.spatial.distance.pdist(x.as_matrix(columns=["center_x", "center_y"]), 'euclidean')
-    if pdist.size == 0:
-      return 0
-    else:
-      return max(pdist)/roll_width
-
-diameters = matches.groupby('cluster').apply(lambda x: computeDiameter(x)).to_frame('diameter')
-diameters.reset_index(inplace=True)
-
-# Merge the results
-
-counts.reset_index(inplace=True)
-counts = counts.rename(columns={"center_x":""})
-counts.columns = [' '.join(col).strip() for col in counts.columns.values]
-
-averages.reset_index(inplace=True)
-
-output = pd.merge(averages, diameters, on='cluster')
-output = pd.merge(output, counts, on='cluster').to_string(index=False)
-
-print output
+if (options.start is None) != (options.end is None):
+  parser.error("range mode requires both --start and --end")
+if (options.start is not None) and (options.output is None):
+  parser.error("range mode requires the output cluster table (-o)")
 
+roll_width = int(options.roll_width)
 
+## Clusters are the connected components of the graph joining the pattern matches within 1.5 roll
+## widths (single linkage), with one row per cluster: mean center, diameter in roll widths and
+## the counts of every match type
+
+if options.start is None:
+
+  ## Load the pattern matching data
+  matches = pd.read_csv(options.dir + "/" + options.pattern_matches)
+
+  with instrumentation.Stage('clustering') as stage:
+    output = clustering.clusterTable(matches, roll_width)
+    stage.items = len(output)
+
+  if options.output:
+    output.to_csv(options.dir + "/" + options.output, index=False)
+  else:
+    print(output.to_string(index=False))
+
+else:
+
+  # RANGE MODE
+  # The pattern matches of frames [start, end] are clustered frame by frame and written as one
+  # table with a leading frame column; match types missing from a frame are counted as 0.
+  start = int(options.start)
+  end = int(options.end)
+
+  tables = []
+  for i in range(start, end + 1):
+    with instrumentation.Stage('clustering', frame=i) as stage:
+      output = clustering.clusterTable(pd.read_csv(options.dir + "/" + options.pattern_matches % i), roll_width)
+      stage.items = len(output)
+    output.insert(0, 'frame', i)
+    tables.append(output)
+    print("Frame %d: %d clusters" % (i, len(output)))
+
+  output = pd.concat(tables, ignore_index=True)
+  counts = [c for c in output.columns if c not in ['frame', 'cluster', 'center_x', 'center_y', 'diameter']]
+  output[counts] = output[counts].fillna(0).astype(int)
+  output.to_csv(options.dir + "/" + options.output, index=False)
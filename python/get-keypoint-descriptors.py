@@ -14,35 +14,64 @@ import pandas as pd
 import numerical_analysis as na
 import computer_vision as cv
 import data_access as da
+import packed_store as ps
+import cubical_persistence as cp
+import instrumentation
 
 
 
-parser = OptionParser('usage: -d dir -i image.bmp -r orientation_blur_radius --psub pd_sub.csv --psup pd_sup.csv -m match_to_features.txt -v generate_feature_vectors --out output_features.txt '  )
+parser = OptionParser('usage: -d dir -i image.bmp -r orientation_blur_radius [--psub pd_sub.csv --psup pd_sup.csv] -m match_to_features.txt -v generate_feature_vectors [--frame-descriptors] --out output_features.txt [--start first_frame --end last_frame --tracks tracks.csv -c chunk]'  )
 
 parser.add_option("-d", dest="dir",
                   help="parent directory")
 parser.add_option("-i", dest="image",
-                  help="bitmap image")
+                  help="bitmap image (image pattern or packed frame stack in sequence mode)")
 parser.add_option("-r", dest="orientation_blur_radius",
                   default=3,
                   help="orientation blur radius")
 parser.add_option("-t", dest="topological_defects",
                   help="topological defect points")
 parser.add_option("--psub", dest="pd_sub",
-                  help="sublevel persistence")
+                  help="sublevel persistence (computed from the image if --psub and --psup are not given)")
 parser.add_option("--psup", dest="pd_sup",
-                  help="superlevel persistence")
+                  help="superlevel persistence (computed from the image if --psub and --psup are not given)")
+parser.add_option("-n", dest="frame_index",
+                  help="frame index, when --psub/--psup are file patterns or packed stores")
 parser.add_option("-m", dest="match_to_features",
-                  help="optional file to match")
+                  help="optional file to match (or feature store, matched to its last frame before -n)")
 parser.add_option("-v", dest="generate_feature_vectors",
                   help="generate vectors = 1, else =0")
+parser.add_option("--frame-descriptors", dest="frame_descriptors", action="store_true", default=False,
+                  help="compute all feature vectors of a frame from its orientation field at once (getFeatureVectors): faster, but not comparable with the default per-keypoint descriptors")
 parser.add_option("--out", dest="output_features",
-                  help="output file for features")
+                  help="output file for features (pattern in sequence mode) or feature store (.fstore)")
+parser.add_option("--start", dest="start",
+                  help="sequence mode: index of the first frame")
+parser.add_option("--end", dest="end",
+                  help="sequence mode: index of the last frame")
+parser.add_option("--tracks", dest="output_tracks",
+                  help="sequence mode: output track table (track_id, frame, idx)")
+parser.add_option("-c", dest="chunk",
+                  default=16,
+                  help="sequence mode: number of consecutive frames whose orientation fields are computed at once")
+instrumentation.addTraceOption(parser)
 
 (options, args) = parser.parse_args()
+instrumentation.startTrace(options, sys.argv[0])
+
+if (options.start is None) != (options.end is None):
+  parser.error("sequence mode requires both --start and --end")
+if (options.start is not None) and (options.output_tracks is None):
+  parser.error("sequence mode requires the track table output (--tracks)")
+if (options.start is None) and (options.frame_index is None):
+  if ps.isFeatureStore(options.output_features):
+    parser.error("a feature store output requires the frame index (-n)")
+  if options.match_to_features and ps.isFeatureStore(options.match_to_features):
+    parser.error("matching to a feature store requires the frame index (-n)")
 
 # Parse input args
 orientation_blur_radius = int(options.orientation_blur_radius)
+descriptor_engine = 'frame' if options.frame_descriptors else 'legacy'
 
 # Set the constants for feature generation
 keypoint_radius = 11
@@ -56,86 +85,193 @@ feature_sigma_divisor = 1.
 
 
 
-# LOAD ALL OF THE DATA
+def getFeatures(_bmp, _pd_sub, _pd_sup, _frame=None, _raw_of=None):
+  """
+  Keypoints of a frame and, if requested, their orientations and feature vectors. The
+  orientation field of the frame is computed unless given as _raw_of.
+  """
 
-print "Loading..."
+  # Compute the topological defects
+  if _raw_of is None:
+    with instrumentation.Stage('orientation field', frame=_frame) as stage:
+      u = _bmp.astype(float)
+      du = np.gradient(u)
+      raw_of = na.orientation_field(du, orientation_blur_radius)
+      stage.items = raw_of.size
+  else:
+    raw_of = _raw_of
+  of = 255*(raw_of + math.pi/2.0)/math.pi # On scale of 0-255 for printing image. Legacy.
 
-# Load the temperature field
-bmp = da.loadTemperatureField(options.dir + "/" + options.image)
-
-# Compute the topological defects
-u = bmp.astype(float)
-du = np.gradient(u)
-raw_of = na.orientation_field(du, orientation_blur_radius)
-of = 255*(raw_of + math.pi/2.0)/math.pi # On scale of 0-255 for printing image. Legacy.
-SP = na.singular_points(raw_of)
-td = np.asarray([ (i,j,SP[i,j]) for (i,j) in np.argwhere(SP)])
-td = td.astype(np.int)
-
-# Combine all keypoints
-keypoints = da.loadKeypoints(options.dir + "/" + options.pd_sub, options.dir + "/" + options.pd_sup, td)
-
-
-# Check to see if need to make feature vectors
-if int(options.generate_feature_vectors):
+  # Combine all keypoints
+  with instrumentation.Stage('keypoint extraction', frame=_frame) as stage:
+    td = na.singular_point_list(raw_of)
+    keypoints = da.loadKeypoints(_pd_sub, _pd_sup, td)
+    stage.items = keypoints.shape[0]
 
+  # Check to see if need to make feature vectors
+  if not int(options.generate_feature_vectors):
+    return keypoints
 
   # Some computed values
-  centerx = bmp.shape[0]/2
-  centery = bmp.shape[1]/2
+  centerx = _bmp.shape[0]//2
+  centery = _bmp.shape[1]//2
   crop_radius = centerx - 30
 
-  print "Generate additional keypoints..."
+  print("Generate additional keypoints...")
   # Generate the feature vectors
 
-  allFeatures = []
+  allFeatures = np.zeros((0, keypoints.shape[1] + 3 + 8*feature_orientation_bins))
   orientation_col = keypoints.shape[1]
 
   # Generate additional keypoints based on orientation fields.
-  allkeypoints = cv.assignOrientations(keypoints, keypoint_radius, of, keypoint_orientation_bins, keypoint_peak_factor, bmp, crop_radius)            
-
-  print "Generate feature vectors..."
-  # Loop through all topological and p.h. defects and generate feature vectors
-  for i in range(allkeypoints.shape[0]):
-
-      x = int(allkeypoints[i,0])
-      y = int(allkeypoints[i,1])
-
-      orientation = allkeypoints[i,orientation_col]
-      rotation = -orientation*(180./keypoint_orientation_bins)
-
-      # Only process points within tolerance of boundary
-      if (((x - centerx)**2 + (y - centery)**2) <= crop_radius**2):
-          features = np.concatenate((allkeypoints[i], [bmp[y, x]], cv.getFeatureVector(bmp, orientation_blur_radius, rotation, x, y, feature_radius, feature_inner_radius_factor, feature_orientation_bins, feature_sigma_divisor)),axis=0)
-          if len(allFeatures) == 0:
-              allFeatures = features
-          else:
-              allFeatures = np.vstack([allFeatures, features])
-
-else:
-
-  allFeatures = keypoints
-
+  with instrumentation.Stage('orientation assignment', frame=_frame) as stage:
+    allkeypoints = cv.assignOrientations(keypoints, keypoint_radius, of, keypoint_orientation_bins, keypoint_peak_factor, _bmp, crop_radius)
+    stage.items = allkeypoints.shape[0]
+
+  print("Generate feature vectors...")
+  # Generate the feature vectors of all topological and p.h. defects one at a time from rotated
+  # crops of the image, or all at once from the orientation field of the frame (frame engine)
+  x = allkeypoints[:,0].astype(int)
+  y = allkeypoints[:,1].astype(int)
+  rotation = -allkeypoints[:,orientation_col]*(180./keypoint_orientation_bins)
+
+  # Only process points within tolerance of boundary
+  inside = (((x - centerx)**2 + (y - centery)**2) <= crop_radius**2)
+  with instrumentation.Stage('descriptors', frame=_frame, engine=descriptor_engine) as stage:
+    if np.any(inside):
+      if options.frame_descriptors:
+        descriptors = cv.getFeatureVectors(raw_of, x[inside], y[inside], rotation[inside], feature_radius, feature_inner_radius_factor, feature_orientation_bins, feature_sigma_divisor)
+      else:
+        descriptors = np.asarray([cv.getFeatureVector(_bmp, orientation_blur_radius, r, xi, yi, feature_radius, feature_inner_radius_factor, feature_orientation_bins, feature_sigma_divisor)
+                                  for (xi, yi, r) in zip(x[inside], y[inside], rotation[inside])])
+      allFeatures = np.hstack((allkeypoints[inside], _bmp[y[inside], x[inside]][:,None], descriptors))
+    stage.items = allFeatures.shape[0]
+
+  return allFeatures
+
+
+def loadDiagrams(_bmp, _frame=None):
+  """
+  Sublevel and superlevel persistence diagrams of a frame: loaded from --psub/--psup, or computed
+  from the image in process if they are not given.
+  """
+  if options.pd_sub is None:
+    with instrumentation.Stage('persistence', frame=_frame) as stage:
+      pd_sub, pd_sup = cp.persistenceDiagrams(_bmp)
+      stage.items = len(pd_sub) + len(pd_sup)
+    return pd_sub, pd_sup
+  return (da.loadPersistenceDiagram(options.dir + "/" + options.pd_sub, _frame),
+          da.loadPersistenceDiagram(options.dir + "/" + options.pd_sup, _frame))
+
+
+# Feature stores opened so far, by path
+feature_stores = {}
+
+def saveFeatures(_file, _allFeatures, _keypoint_matches, _frame=None):
+  """
+  Saves the features of a frame as a text file or, if _file is a feature store, appends them
+  to the store as frame _frame, which records the descriptor engine.
+  """
+  allFeatures = np.hstack((np.reshape(np.asarray(range(_allFeatures.shape[0])), (_allFeatures.shape[0], 1)), _keypoint_matches, _allFeatures))
+  with instrumentation.Stage('write', frame=_frame) as stage:
+    if ps.isFeatureStore(_file):
+      if _file not in feature_stores:
+        feature_stores[_file] = ps.FeatureStore(_file, ps.featureColumns(allFeatures.shape[1]), descriptor_engine)
+      feature_stores[_file].append(_frame, allFeatures)
+    else:
+      np.savetxt(_file, allFeatures, fmt='%d', delimiter=' ')
+    stage.items = allFeatures.shape[0]
+
+
+if options.start is None:
+
+  # LOAD ALL OF THE DATA
+
+  print("Loading...")
+
+  frame_index = int(options.frame_index) if options.frame_index is not None else None
+
+  with instrumentation.Stage('load', frame=frame_index) as stage:
+    # Load the temperature field
+    bmp = da.loadTemperatureField(options.dir + "/" + options.image)
+
+    pd_sub, pd_sup = loadDiagrams(bmp, frame_index)
+    stage.items = len(pd_sub) + len(pd_sup)
+
+  allFeatures = getFeatures(bmp, pd_sub, pd_sup, frame_index)
+
+  # Match to existing features: a feature file, or the last frame before this frame of a feature
+  # store. There are no matches if the store does not exist yet or has no earlier frame, e.g. for
+  # the first frame of a run.
+  prior_keypoints = None
+  if options.match_to_features:
+    match_file = options.dir + "/" + options.match_to_features
+    if ps.isFeatureStore(match_file):
+      if os.path.exists(match_file):
+        store = ps.FeatureStore(match_file)
+        if int(options.generate_feature_vectors) and (store.descriptors != descriptor_engine):
+          parser.error("the features to match hold %s descriptors, not %s (see --frame-descriptors)" % (store.descriptors, descriptor_engine))
+        earlier = store.frames[store.frames < frame_index]
+        if len(earlier) > 0:
+          prior_keypoints = np.asarray(store.frame(np.max(earlier)), dtype=float)
+    else:
+      prior_keypoints = np.loadtxt(match_file, delimiter=' ')
+
+  if prior_keypoints is not None:
+    print("Match feature vectors...")
+    with instrumentation.Stage('matching', frame=frame_index) as stage:
+      keypoint_matches = cv.getMatchingKeypoints(allFeatures, prior_keypoints, int(options.generate_feature_vectors))
+      stage.items = int(np.sum(keypoint_matches[:,0] >= 0))
+  else:
+    keypoint_matches = np.ones((allFeatures.shape[0], 2))*-1
+
+  print("Save feature vectors...\n")
+  # Save feature vectors to file
+  saveFeatures(options.dir + '/' + options.output_features, allFeatures, keypoint_matches, frame_index)
 
-
-# Match to existing features
-if options.match_to_features:
-  print "Match feature vectors..."
-  prior_keypoints = np.loadtxt(options.dir + "/" + options.match_to_features, delimiter=' ')
-  keypoint_matches = cv.getMatchingKeypoints(allFeatures, prior_keypoints, int(options.generate_feature_vectors))
 else:
-  keypoint_matches = np.ones((allFeatures.shape[0], 2))*-1
-
-
-print "Save feature vectors...\n"
-# Save feature vectors to file
-if len(allFeatures.shape)==1:
-    sOut = ' '.join([str(x) for x in allFeatures.tolist()])
-    with open(options.dir + '/' + options.output_features, 'w') as f:
-        f.write('0 ' + keypoint_matches[0] + ' ' + sOut)
-else:
-    allFeatures = np.hstack((np.reshape(np.asarray(range(allFeatures.shape[0])), (allFeatures.shape[0], 1)), keypoint_matches, allFeatures))
-    np.savetxt(options.dir + '/' + options.output_features, allFeatures,fmt='%d',delimiter=' ')
-
-
 
+  # SEQUENCE MODE
+  # The frames of [start, end] are processed in one process, in chunks of consecutive frames whose
+  # orientation fields are computed at once (numerical_analysis.orientation_field_stack). Each
+  # frame is matched to the prior frame by a KeypointTracker, which keeps the KD-trees of the
+  # prior frame instead of reloading its feature file, and the tracks of all keypoints are
+  # written to one table.
+  start = int(options.start)
+  end = int(options.end)
+  chunk = max(1, int(options.chunk))
+
+  tracker = cv.KeypointTracker(int(options.generate_feature_vectors))
+
+  for i in range(start, end + 1):
+
+    print("Frame %d..." % i)
+
+    if (i - start) % chunk == 0:
+      stop = min(i + chunk, end + 1)
+      with instrumentation.Stage('image load', frame=i, frames=stop - i) as stage:
+        if ps.isPacked(options.image):
+          bmps = np.array(da.loadTemperatureFields(options.dir + "/" + options.image, i, stop))
+        else:
+          bmps = np.asarray([da.loadTemperatureField(options.dir + "/" + options.image % j) for j in range(i, stop)])
+        stage.items = bmps.shape[0]
+      with instrumentation.Stage('orientation field', frame=i, frames=stop - i) as stage:
+        raw_ofs = na.orientation_field_stack(bmps, orientation_blur_radius)
+        stage.items = raw_ofs.size
+
+    bmp = bmps[(i - start) % chunk]
+    with instrumentation.Stage('load', frame=i) as stage:
+      pd_sub, pd_sup = loadDiagrams(bmp, i)
+      stage.items = len(pd_sub) + len(pd_sup)
+
+    allFeatures = getFeatures(bmp, pd_sub, pd_sup, i, raw_ofs[(i - start) % chunk])
+    with instrumentation.Stage('matching', frame=i) as stage:
+      keypoint_matches = tracker.step(i, allFeatures)
+      stage.items = int(np.sum(keypoint_matches[:,0] >= 0))
+
+    if ps.isFeatureStore(options.output_features):
+      saveFeatures(options.dir + '/' + options.output_features, allFeatures, keypoint_matches, i)
+    else:
+      saveFeatures(options.dir + '/' + options.output_features % i, allFeatures, keypoint_matches, i)
+
+  tracker.trackTable().to_csv(options.dir + "/" + options.output_tracks, index=False)
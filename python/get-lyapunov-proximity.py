@@ -7,11 +7,14 @@ import math
 import os
 import pandas as pd
 import numpy as np
+import data_access as da
 import random
-from scipy import misc
+import multiprocessing
+import lyapunov_proximity as lp
+import instrumentation
 
 
-parser = OptionParser('usage: -d dir -l lower_limit -u upper_limit -n num_draws -r radius --dev deviation --ls lifespan --sub sublevel_pattern --sup superlevel_pattern --bmp lyapunov_bmp'  )
+parser = OptionParser('usage: -d dir -l lower_limit -u upper_limit -n num_draws -r radius --dev deviation --ls lifespan --sub sublevel_pattern --sup superlevel_pattern --bmp lyapunov_bmp [--exhaustive -p processes -o scores.csv]'  )
 
 parser.add_option("-d", dest="dir",
                   help="parent directory")
@@ -32,18 +35,28 @@ parser.add_option("--dev", dest="deviation",
 parser.add_option("--ls", dest="lifespan",
                   help="lower limit for lifespan")
 parser.add_option("--sub", dest="sublevel_pattern",
-                  help="pattern for sublevel file")
+                  help="pattern for sublevel file (or packed store)")
 parser.add_option("--sup", dest="superlevel_pattern",
-                  help="pattern for superlevel file")
+                  help="pattern for superlevel file (or packed store)")
 parser.add_option("--bmp", dest="lyapunov_bmp",
-                  help="lyapunov image")
+                  help="lyapunov image pattern (or packed frame stack)")
+parser.add_option("--exhaustive", dest="exhaustive",
+                  action="store_true", default=False,
+                  help="score every point of every frame of [lower, upper] instead of random draws")
+parser.add_option("-p", dest="processes",
+                  default=multiprocessing.cpu_count(),
+                  help="exhaustive mode: number of worker processes")
+parser.add_option("-o", dest="output",
+                  help="exhaustive mode: optional output file for the scores of all points")
+instrumentation.addTraceOption(parser)
 
 (options, args) = parser.parse_args()
+instrumentation.startTrace(options, sys.argv[0])
 
 # Parse the inputs
 lower = int(options.lower_limit)
 upper = int(options.upper_limit)
-draws = int(options.num_draws)
+draws = int(options.num_draws) if options.num_draws is not None else 0
 radius = int(options.radius)
 lval = int(options.lower_value)
 uval = int(options.upper_value)
@@ -51,82 +64,121 @@ deviation = float(options.deviation)
 lifespan = int(options.lifespan)
 
 
-# Function for checking for a Lyapunov extreme value match
-def hasLyapunovMatch(df, dim, deviation, lifespan, bmp, radius, lval, uval):
+# Function for checking for a Lyapunov extreme value match. The extreme value distance
+# transform of the frame replaces the scan of the windows around the generators.
+def hasLyapunovMatch(df, dim, deviation, lifespan, distance, radius):
 
     result = 0
 
     # Filter the dataset
-    samplespace = df[(df['dim']==dim) & (df['deviation']>=deviation) & (abs(df['death'] - df['birth']) >= lifespan)]
+    samplespace = df[lp.eligible(df, dim, deviation, lifespan)]
     if (samplespace.shape[0] > 0):
 
         # Get a random row
         sample = samplespace.sample()
 
-        # Check to see if there is an extreme Lyapunov value within the radius of either the birth critical cell
-        lyap_birth = bmp[max(0,int(sample['b_x']) - radius):min(bmp.shape[0]-1,int(sample['b_x']) + radius), \
-            (bmp.shape[1]-min(bmp.shape[1]-1,int(sample['b_y']) + radius)):(bmp.shape[1]-max(0,int(sample['b_y']) - radius))]
-        if (len(lyap_birth[(lyap_birth <= lval) | (lyap_birth >= uval)]) > 0):
-            result = 1
-
-        # Check to see if there is an extreme Lyapunov value within the radius of either the death critical cell
-        if (result == 0):
-            lyap_birth = bmp[max(0,int(sample['d_x']) - radius):min(bmp.shape[0]-1,int(sample['d_x']) + radius), \
-                (bmp.shape[1]-min(bmp.shape[1]-1,int(sample['d_y']) + radius)):(bmp.shape[1]-max(0,int(sample['d_y']) - radius))]
-            if (len(lyap_birth[(lyap_birth <= lval) | (lyap_birth >= uval)]) > 0):
-                result = 1
+        # Check to see if there is an extreme Lyapunov value within the radius of either the birth or the death critical cell
+        result = lp.scoreDiagram(sample, distance, radius)[0]
 
     # Return the result of the match
     return result
 
 
-# Print the header
-print 'index, deviation, lifespan, sub_0_dev, sub_1_dev, sup_0_dev, sup_1_dev, sub_0_ls, sub_1_ls, sup_0_ls, sup_1_ls'
+def main():
+
+    # Print the header
+    print('index, deviation, lifespan, sub_0_dev, sub_1_dev, sup_0_dev, sup_1_dev, sub_0_ls, sub_1_ls, sup_0_ls, sup_1_ls')
+
+    if not options.exhaustive:
+
+        index_cache = lp.ProximityIndex(options.dir + "/" + options.lyapunov_bmp, lval, uval)
+
+        for n in range(0,draws):
+
+            # Get a random number in the range [lower, upper]
+            index = random.randint(lower, upper)
+
+            # Load the input data
+            with instrumentation.Stage('load', frame=index) as stage:
+                data_sub = da.loadPersistenceDiagram(options.dir + "/" + options.sublevel_pattern, index)
+                data_sup = da.loadPersistenceDiagram(options.dir + "/" + options.superlevel_pattern, index)
+                distance = index_cache.distance(index)
+                stage.items = len(data_sub) + len(data_sup)
+
+            # GATHER ALL OF THE STATISTICS
+
+            # Deviation & Lifespan Filter
+
+            # Sublevel Dim=0
+            sub0_dev = hasLyapunovMatch(data_sub, 0, deviation, lifespan, distance, radius)
+
+            # Sublevel Dim=1
+            sub1_dev = hasLyapunovMatch(data_sub, 1, deviation, lifespan, distance, radius)
+
+            # Superlevel Dim=0
+            sup0_dev = hasLyapunovMatch(data_sup, 0, deviation, lifespan, distance, radius)
 
-for n in range(0,draws):
+            # Superlevel Dim=1
+            sup1_dev = hasLyapunovMatch(data_sup, 1, deviation, lifespan, distance, radius)
 
-    # Get a random number in the range [lower, upper]
-    index = random.randint(lower, upper)
+            # Lifespan Filter Only
 
-    # Load the input data
-    data_sub = pd.read_csv(options.dir + "/" + options.sublevel_pattern % index)
-    data_sup = pd.read_csv(options.dir + "/" + options.superlevel_pattern % index)
-    lyap_bmp = misc.imread(options.dir + "/" + options.lyapunov_bmp % index)
+            # Sublevel Dim=0
+            sub0 = hasLyapunovMatch(data_sub, 0, -1., lifespan, distance, radius)
 
-    # GATHER ALL OF THE STATISTICS
+            # Sublevel Dim=1
+            sub1 = hasLyapunovMatch(data_sub, 1, -1., lifespan, distance, radius)
 
-    # Deviation & Lifespan Filter
+            # Superlevel Dim=0
+            sup0 = hasLyapunovMatch(data_sup, 0, -1., lifespan, distance, radius)
 
-    # Sublevel Dim=0
-    sub0_dev = hasLyapunovMatch(data_sub, 0, deviation, lifespan, lyap_bmp, radius, lval, uval)
+            # Superlevel Dim=1
+            sup1 = hasLyapunovMatch(data_sup, 1, -1., lifespan, distance, radius)
 
-    # Sublevel Dim=1
-    sub1_dev = hasLyapunovMatch(data_sub, 1, deviation, lifespan, lyap_bmp, radius, lval, uval)
+            # Print the results
+            print('%d, %f, %d, %d, %d, %d, %d, %d, %d, %d, %d' % (index, deviation, lifespan, sub0_dev, sub1_dev, sup0_dev, sup1_dev, sub0, sub1, sup0, sup1))
 
-    # Superlevel Dim=0
-    sup0_dev = hasLyapunovMatch(data_sup, 0, deviation, lifespan, lyap_bmp, radius, lval, uval)
+    else:
 
-    # Superlevel Dim=1
-    sup1_dev = hasLyapunovMatch(data_sup, 1, deviation, lifespan, lyap_bmp, radius, lval, uval)
+        # EXHAUSTIVE MODE
+        # Every point of every frame of [lower, upper] passing the lifespan filter is scored instead of
+        # one random point per draw; frames are scored in a pool of worker processes, with at most two
+        # frames per worker waiting. Each line gives the fraction of the points of the frame with a
+        # Lyapunov match (-1 if there are none), in the columns of the sampling mode.
+        processes = int(options.processes)
+        frames = range(lower, upper + 1)
 
-    # Lifespan Filter Only
+        pool = multiprocessing.Pool(processes, instrumentation.enable, instrumentation.state())
+        pending = []
+        output = None
+        if options.output:
+            output = open(options.dir + "/" + options.output, 'w')
 
-    # Sublevel Dim=0
-    sub0 = hasLyapunovMatch(data_sub, 0, -1., lifespan, lyap_bmp, radius, lval, uval)
+        for i in frames:
 
-    # Sublevel Dim=1
-    sub1 = hasLyapunovMatch(data_sub, 1, -1., lifespan, lyap_bmp, radius, lval, uval)
+            pending.append(pool.apply_async(lp.scoreFrame, (i, options.dir + "/" + options.sublevel_pattern, options.dir + "/" + options.superlevel_pattern, \
+                options.dir + "/" + options.lyapunov_bmp, radius, lval, uval, lifespan)))
 
-    # Superlevel Dim=0
-    sup0 = hasLyapunovMatch(data_sup, 0, -1., lifespan, lyap_bmp, radius, lval, uval)
+            while (len(pending) >= 2*processes) or ((i == upper) and (len(pending) > 0)):
+                (index, scores) = pending.pop(0).get()
 
-    # Superlevel Dim=1
-    sup1 = hasLyapunovMatch(data_sup, 1, -1., lifespan, lyap_bmp, radius, lval, uval)
+                rates = []
+                for min_deviation in [deviation, -1.]:
+                    for (level, dim) in [('sub', 0), ('sub', 1), ('sup', 0), ('sup', 1)]:
+                        match = scores['match'][(scores['level'] == level) & (scores['dim'] == dim) & (scores['deviation'] >= min_deviation)]
+                        rates.append(match.mean() if len(match) > 0 else -1.)
 
-    # Print the results
-    print '%d, %f, %d, %d, %d, %d, %d, %d, %d, %d, %d' % (index, deviation, lifespan, sub0_dev, sub1_dev, sup0_dev, sup1_dev, sub0, sub1, sup0, sup1)
+                print('%d, %f, %d, %f, %f, %f, %f, %f, %f, %f, %f' % tuple([index, deviation, lifespan] + rates))
 
+                if output is not None:
+                    scores.to_csv(output, header=(output.tell() == 0), index=False)
 
+        pool.close()
+        pool.join()
 
+        if output is not None:
+            output.close()
 
 
+if __name__ == '__main__':
+    main()
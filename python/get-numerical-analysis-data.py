@@ -10,47 +10,152 @@ from scipy import misc
 import numpy as np
 import math
 import os
+import multiprocessing
 import numerical_analysis as na
+import data_access as da
+import packed_store as ps
+import instrumentation
 
 
-parser = OptionParser('usage: -d dir -i image.bmp -r radius --outf output_orientation_field.bmp --outsp output_singular_points.txt --outwn output_local_wavenumber.bmp '  )
+parser = OptionParser('usage: -d dir -i image.bmp -r radius --outf output_orientation_field.bmp --outsp output_singular_points.txt [--outwn output_local_wavenumber.npy -w method] [--start first_frame --end last_frame -p processes -c chunk]'  )
 
 parser.add_option("-d", dest="dir",
                   help="parent directory")
 parser.add_option("-i", dest="image",
-                  help="bitmap image")
+                  help="bitmap image (image pattern or packed frame stack in range mode)")
 parser.add_option("-r", dest="radius",
                   help="radius to use for orientation field computation")
 parser.add_option("--outf", dest="output_orientation_field",
-                  help="output file for orientation field")
+                  help="output file for orientation field (pattern or packed frame stack in range mode)")
 parser.add_option("--outsp", dest="output_singular_points",
-                  help="output file for poincare index singular points")
+                  help="output file for poincare index singular points (pattern in range mode)")
 parser.add_option("--outwn", dest="output_local_wavenumber",
-                  help="output file for local wavenumber")
+                  help="optional output file for local wavenumber, as .npy (pattern or packed stack in range mode)")
+parser.add_option("-w", dest="wavenumber_method",
+                  default="difference",
+                  help="local wavenumber method: difference or fourier")
+parser.add_option("--start", dest="start",
+                  help="range mode: index of the first frame")
+parser.add_option("--end", dest="end",
+                  help="range mode: index of the last frame")
+parser.add_option("-p", dest="processes",
+                  default=multiprocessing.cpu_count(),
+                  help="range mode: number of worker processes")
+parser.add_option("-c", dest="chunk",
+                  default=16,
+                  help="range mode: largest number of consecutive frames whose orientation fields are computed at once")
+instrumentation.addTraceOption(parser)
 
 (options, args) = parser.parse_args()
+instrumentation.startTrace(options, sys.argv[0])
+
+if (options.start is None) != (options.end is None):
+  parser.error("range mode requires both --start and --end")
 
 # Parse input args
 radius = float(options.radius)
+wavenumber_method = options.wavenumber_method if options.output_local_wavenumber else None
+
+
+def main():
+
+  if options.start is None:
+
+    # Load the image
+    with instrumentation.Stage('image load') as stage:
+      bmp = misc.imread(options.dir + "/" + options.image)
+      stage.items = bmp.size
+
+    # Get the orientation field of the image, the locations of the singular points of the
+    # orientation field and the local wavenumber
+    (index, OF, locations, WN) = na.analyze_frame(None, bmp, radius, wavenumber_method)
+
+    with instrumentation.Stage('write') as stage:
+      # Output the orientation field with [-pi/2, -pi/2] normalized to [0,255]
+      OF = 255*(OF + math.pi/2.0)/math.pi
+      misc.imsave(options.dir + "/" + options.output_orientation_field, OF.astype(np.uint8))
+
+      # Output the locations of the singular points
+      np.savetxt(options.dir + "/" + options.output_singular_points, locations, fmt='%d', delimiter=' ')
+
+      # Output the local wavenumber
+      if WN is not None:
+        np.save(options.dir + "/" + options.output_local_wavenumber, WN)
+      stage.items = len(locations)
+
+  else:
+
+    # RANGE MODE
+    # The frames of [start, end] are analyzed in chunks of consecutive frames, whose orientation
+    # fields are computed at once (see numerical_analysis.analyze_frames), in a pool of worker
+    # processes with at most two chunks per worker waiting. Chunks are small enough to keep every
+    # worker busy. Orientation fields and wavenumbers go to one file per frame, or to one packed
+    # (T, H, W) stack for the whole range if the output is a packed file.
+    start = int(options.start)
+    end = int(options.end)
+    processes = int(options.processes)
+    frames = range(start, end + 1)
+    chunk = max(1, min(int(options.chunk), -(-len(frames)//processes)))
+
+    def loadFrames(_start, _stop):
+      with instrumentation.Stage('image load', frame=_start, frames=_stop - _start) as stage:
+        if ps.isPacked(options.image):
+          stack = np.array(da.loadTemperatureFields(options.dir + "/" + options.image, _start, _stop))
+        else:
+          stack = np.asarray([da.loadTemperatureField(options.dir + "/" + options.image % i) for i in range(_start, _stop)])
+        stage.items = stack.shape[0]
+      return stack
+
+    shape = np.asarray(loadFrames(start, start + 1)).shape[1:]
+    orientation_stack = None
+    wavenumber_stack = None
+    if ps.isPacked(options.output_orientation_field):
+      out = ps.createPacked(options.dir + "/" + options.output_orientation_field, [('stack', np.uint8, (len(frames),) + shape), ('frames', np.int64, (len(frames),))], {'kind': 'frames'})
+      out['frames'][:] = frames
+      orientation_stack = out['stack']
+    if (wavenumber_method is not None) and ps.isPacked(options.output_local_wavenumber):
+      out = ps.createPacked(options.dir + "/" + options.output_local_wavenumber, [('stack', np.float32, (len(frames),) + shape), ('frames', np.int64, (len(frames),))], {'kind': 'frames'})
+      out['frames'][:] = frames
+      wavenumber_stack = out['stack']
+
+    pool = multiprocessing.Pool(processes, instrumentation.enable, instrumentation.state())
+    pending = []
+
+    for i in range(start, end + 1, chunk):
+
+      stop = min(i + chunk, end + 1)
+      pending.append(pool.apply_async(na.analyze_frames, (list(range(i, stop)), loadFrames(i, stop), radius, wavenumber_method)))
+
+      while (len(pending) >= 2*processes) or ((stop == end + 1) and (len(pending) > 0)):
+        for (index, OF, locations, WN) in pending.pop(0).get():
+
+          with instrumentation.Stage('write', frame=index) as stage:
+            # Output the orientation field with [-pi/2, -pi/2] normalized to [0,255]
+            OF = (255*(OF + math.pi/2.0)/math.pi).astype(np.uint8)
+            if orientation_stack is not None:
+              orientation_stack[index - start] = OF
+            else:
+              misc.imsave(options.dir + "/" + options.output_orientation_field % index, OF)
 
-# Load the image
-bmp = misc.imread(options.dir + "/" + options.image)
-u = bmp.astype(float)
+            # Output the locations of the singular points
+            np.savetxt(options.dir + "/" + options.output_singular_points % index, locations, fmt='%d', delimiter=' ')
 
-# Get the gradient of the image
-du = np.gradient(u)
+            # Output the local wavenumber
+            if wavenumber_stack is not None:
+              wavenumber_stack[index - start] = WN
+            elif WN is not None:
+              np.save(options.dir + "/" + options.output_local_wavenumber % index, WN)
+            stage.items = len(locations)
 
-# Get the orientation field of the image with [-pi/2, -pi/2] normalized to [0,255]
-OF = na.orientation_field(du, radius)
+          print("Frame %d: %d singular points" % (index, len(locations)))
 
-# Get the locations of the singular points of the orientation field
-SP = na.singular_points(OF)
-locations = np.asarray([ (i,j,SP[i,j]) for (i,j) in np.argwhere(SP)])
+    pool.close()
+    pool.join()
 
-# Output the orientation field 
-OF = 255*(OF + math.pi/2.0)/math.pi
-misc.imsave(options.dir + "/" + options.output_orientation_field, OF.astype(np.uint8))
+    for stack in [orientation_stack, wavenumber_stack]:
+      if stack is not None:
+        stack.flush()
 
-# Output the locations of the singular points
-np.savetxt(options.dir + "/" + options.output_singular_points, locations, fmt='%d', delimiter=' ')
 
+if __name__ == '__main__':
+  main()
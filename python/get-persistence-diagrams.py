@@ -0,0 +1,128 @@
+
+
+
+import sys
+from optparse import OptionParser
+import numpy as np
+import os
+import multiprocessing
+import pandas as pd
+import cubical_persistence as cp
+import data_access as da
+import packed_store as ps
+import instrumentation
+
+
+
+parser = OptionParser('usage: -d dir -i image.bmp (--osub pd_sub.csv --osup pd_sup.csv | --csub reference_sub.csv --csup reference_sup.csv) [--essential] [--start first_frame --end last_frame -p processes]'  )
+
+parser.add_option("-d", dest="dir",
+                  help="parent directory")
+parser.add_option("-i", dest="image",
+                  help="bitmap image, e.g. temperature or Lyapunov field (image pattern or packed frame stack in range mode)")
+parser.add_option("--osub", dest="output_sub",
+                  help="output sublevel persistence diagram (pattern in range mode)")
+parser.add_option("--osup", dest="output_sup",
+                  help="output superlevel persistence diagram (pattern in range mode)")
+parser.add_option("--csub", dest="compare_sub",
+                  help="validation: reference sublevel persistence diagram, e.g. from diamorse (pattern in range mode)")
+parser.add_option("--csup", dest="compare_sup",
+                  help="validation: reference superlevel persistence diagram (pattern in range mode)")
+parser.add_option("--essential", dest="essential", action="store_true", default=False,
+                  help="include the essential class (infinite death)")
+parser.add_option("--start", dest="start",
+                  help="range mode: index of the first frame")
+parser.add_option("--end", dest="end",
+                  help="range mode: index of the last frame")
+parser.add_option("-p", dest="processes",
+                  default=multiprocessing.cpu_count(),
+                  help="range mode: number of worker processes")
+instrumentation.addTraceOption(parser)
+
+(options, args) = parser.parse_args()
+instrumentation.startTrace(options, sys.argv[0])
+
+if (options.start is None) != (options.end is None):
+  parser.error("range mode requires both --start and --end")
+
+## Computes the sublevel and superlevel persistence diagrams of images in process (see
+## cubical_persistence) and writes them as diamorse-format CSV files, or compares them to
+## reference diagrams: per dimension the number of points of each, the points with equal birth
+## and death, and those with equal generator coordinates too.
+
+def output(_frame, _sub, _sup, _index=None):
+  """
+  Writes the diagrams of a frame, or returns their comparison to the reference diagrams.
+  """
+  pattern = lambda _file: options.dir + "/" + (_file if _index is None else _file % _index)
+  if options.compare_sub:
+    comparisons = []
+    for (level, diagram, reference) in [('sub', _sub, options.compare_sub), ('sup', _sup, options.compare_sup)]:
+      comparison = cp.compareDiagrams(diagram, pd.read_csv(pattern(reference)))
+      comparison.insert(0, 'level', level)
+      if _frame is not None:
+        comparison.insert(0, 'frame', _frame)
+      comparisons.append(comparison)
+    return pd.concat(comparisons, ignore_index=True)
+  with instrumentation.Stage('csv write', frame=_frame) as stage:
+    _sub.to_csv(pattern(options.output_sub), index=False)
+    _sup.to_csv(pattern(options.output_sup), index=False)
+    stage.items = len(_sub) + len(_sup)
+
+
+def main():
+
+  if options.start is None:
+
+    with instrumentation.Stage('image load') as stage:
+      bmp = da.loadTemperatureField(options.dir + "/" + options.image)
+      stage.items = bmp.size
+
+    (frame, sub, sup) = cp.frameDiagrams(None, bmp, options.essential)
+    comparison = output(None, sub, sup)
+    if comparison is not None:
+      print(comparison.to_string(index=False))
+
+  else:
+
+    # RANGE MODE
+    # The frames of [start, end] are processed in a pool of worker processes, with at most two
+    # frames per worker waiting.
+    start = int(options.start)
+    end = int(options.end)
+    processes = int(options.processes)
+
+    def loadFrame(_index):
+      with instrumentation.Stage('image load', frame=_index):
+        if ps.isPacked(options.image):
+          return np.array(da.loadTemperatureFields(options.dir + "/" + options.image, _index))
+        return da.loadTemperatureField(options.dir + "/" + options.image % _index)
+
+    pool = multiprocessing.Pool(processes, instrumentation.enable, instrumentation.state())
+    pending = []
+    comparisons = []
+
+    for i in range(start, end + 1):
+
+      pending.append(pool.apply_async(cp.frameDiagrams, (i, loadFrame(i), options.essential)))
+
+      while (len(pending) >= 2*processes) or ((i == end) and (len(pending) > 0)):
+        (index, sub, sup) = pending.pop(0).get()
+        comparison = output(index, sub, sup, index)
+        if comparison is not None:
+          comparisons.append(comparison)
+        else:
+          print("Frame %d: %d sublevel, %d superlevel points" % (index, len(sub), len(sup)))
+
+    pool.close()
+    pool.join()
+
+    # Comparison of every frame, then the totals per diagram and dimension
+    if comparisons:
+      comparisons = pd.concat(comparisons, ignore_index=True)
+      print(comparisons.to_string(index=False))
+      print(comparisons.drop(columns='frame').groupby(['level', 'dim']).sum().to_string())
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,121 @@
+
+
+
+import json
+import os
+import sys
+import time
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+
+# Trace output: the file the records are appended to (None while tracing is off) and the name
+# of the script, copied into every record. Worker processes inherit it when forked; otherwise
+# pass enable and state() as the initializer of the pool.
+_trace = {'file': None, 'script': None}
+
+
+def enable(_file, _script=None):
+  """
+  Turns tracing on: every stage appends one JSON line to _file.
+  """
+  _trace['file'] = _file
+  _trace['script'] = _script
+
+
+def state():
+  """
+  Arguments of enable reproducing the current trace, e.g. as initargs of a worker pool.
+  """
+  return (_trace['file'], _trace['script'])
+
+
+def enabled():
+  return _trace['file'] is not None
+
+
+def peakMemory():
+  """
+  Peak resident memory of the process so far in bytes, None where it is not available.
+  """
+  if resource is None:
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Linux reports kilobytes, macOS bytes
+  return peak if sys.platform == 'darwin' else 1024*peak
+
+
+def cpuTime():
+  """
+  User and system CPU time of the process in seconds.
+  """
+  times = os.times()
+  return times[0] + times[1]
+
+
+def record(_stage, **_fields):
+  """
+  Appends one record for _stage with the given fields. Each record is written with a single
+  append, so the records of worker processes sharing the file do not interleave.
+  """
+  if _trace['file'] is None:
+    return
+  entry = {'script': _trace['script'], 'stage': _stage, 'pid': os.getpid(), 'time': time.time()}
+  entry.update(_fields)
+  with open(_trace['file'], 'a') as f:
+    f.write(json.dumps(entry, default=float) + '\n')
+
+
+class Stage(object):
+  """
+  Times the block of a with statement as one stage of a script: wall time, CPU time of the
+  process, peak memory of the process when the stage ends, and the number of items processed
+  (set .items inside the block). Extra keyword fields, e.g. frame or radius, go into the record
+  as given; more can be added to .fields inside the block. Does nothing while tracing is off.
+
+    with instrumentation.Stage('orientation field', frame=i) as stage:
+      ...
+      stage.items = len(points)
+  """
+
+  def __init__(self, _name, **_fields):
+    self.name = _name
+    self.fields = _fields
+    self.items = None
+
+  def __enter__(self):
+    if _trace['file'] is not None:
+      self.wall = time.time()
+      self.cpu = cpuTime()
+    return self
+
+  def __exit__(self, type, value, traceback):
+    if _trace['file'] is None:
+      return
+    fields = dict(self.fields)
+    fields['wall'] = time.time() - self.wall
+    fields['cpu'] = cpuTime() - self.cpu
+    fields['peak_memory'] = peakMemory()
+    fields['items'] = self.items
+    if type is not None:
+      fields['error'] = type.__name__
+    record(self.name, **fields)
+
+
+def addTraceOption(_parser):
+  """
+  Adds the --trace option to the OptionParser of a script.
+  """
+  _parser.add_option("--trace", dest="trace",
+                     help="optional file to append per-stage timing records to (JSON lines)")
+
+
+def startTrace(_options, _script):
+  """
+  Turns tracing on if the --trace option of a script was given.
+  """
+  if getattr(_options, 'trace', None):
+    enable(os.path.abspath(_options.trace), os.path.basename(_script))
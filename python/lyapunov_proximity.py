@@ -0,0 +1,114 @@
+
+
+
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+import data_access as da
+import packed_store as ps
+import instrumentation
+
+
+# Critical cell coordinates of the birth and death generators
+GENERATORS = {'birth': ['b_x', 'b_y'], 'death': ['d_x', 'd_y']}
+
+
+def extremeDistance(_bmp, _lval, _uval):
+  """
+  Chessboard distance from every pixel of a Lyapunov image to the nearest extreme pixel
+  (<= _lval or >= _uval), inf everywhere if there is none. The last row and the first column
+  never count as extreme, as they are never inside the windows of the original sampling script.
+  """
+  extreme = (_bmp <= _lval) | (_bmp >= _uval)
+  extreme[-1,:] = False
+  extreme[:,0] = False
+  if not np.any(extreme):
+    return np.full(_bmp.shape, np.inf)
+  return ndimage.distance_transform_cdt(~extreme, metric='chessboard').astype(float)
+
+
+def proximityMatch(_distance, _x, _y, _radius):
+  """
+  Whether there is an extreme Lyapunov value within _radius of each generator (_x, _y) of a
+  persistence diagram, given the extremeDistance of the frame. The window is that of the
+  original sampling script, rows x-radius..x+radius-1 and columns W-y-radius..W-y+radius-1,
+  i.e. the pixels within chessboard distance radius-1 of one of the four pixels around
+  (x-.5, W-y-.5); out of range corners are clipped, which never lowers the distance.
+  """
+  [H, W] = _distance.shape
+  x = np.asarray(_x, dtype=int)
+  c = W - np.asarray(_y, dtype=int)
+  rows = [np.clip(x - 1, 0, H - 1), np.clip(x, 0, H - 1)]
+  cols = [np.clip(c - 1, 0, W - 1), np.clip(c, 0, W - 1)]
+  nearest = np.min([_distance[r, k] for r in rows for k in cols], axis=0)
+  return nearest <= (_radius - 1)
+
+
+def scoreDiagram(_df, _distance, _radius):
+  """
+  Lyapunov match of every point of a persistence diagram: 1 if either the birth or the death
+  generator has an extreme Lyapunov value within _radius, else 0.
+  """
+  match = np.zeros(len(_df), dtype=bool)
+  for generator in ['birth', 'death']:
+    [x, y] = GENERATORS[generator]
+    match |= proximityMatch(_distance, _df[x].values, _df[y].values, _radius)
+  return match.astype(int)
+
+
+def eligible(_df, _dim, _deviation, _lifespan):
+  """
+  Rows of a persistence diagram of dimension _dim passing the deviation and lifespan filters.
+  """
+  return (_df['dim'] == _dim) & (_df['deviation'] >= _deviation) & (abs(_df['death'] - _df['birth']) >= _lifespan)
+
+
+class ProximityIndex(object):
+  """
+  Extreme value distance transforms of the frames of a Lyapunov image pattern (or packed frame
+  stack), computed once per frame and cached, so every generator check is a single lookup.
+  """
+
+  def __init__(self, _pattern, _lval, _uval, _cache_size=64):
+    self.pattern = _pattern
+    self.lval = _lval
+    self.uval = _uval
+    self.cache_size = _cache_size
+    self.cache = {}
+    self.order = []
+
+  def distance(self, _frame):
+    if _frame not in self.cache:
+      if ps.isPacked(self.pattern):
+        bmp = da.loadTemperatureFields(self.pattern, _frame)
+      else:
+        bmp = da.loadTemperatureField(self.pattern % _frame)
+      with instrumentation.Stage('distance transform', frame=_frame) as stage:
+        self.cache[_frame] = extremeDistance(np.asarray(bmp), self.lval, self.uval)
+        stage.items = bmp.size
+      self.order.append(_frame)
+      if len(self.order) > self.cache_size:
+        del self.cache[self.order.pop(0)]
+    return self.cache[_frame]
+
+  def hasMatch(self, _frame, _df, _radius):
+    return scoreDiagram(_df, self.distance(_frame), _radius)
+
+
+def scoreFrame(_frame, _sub_pattern, _sup_pattern, _bmp_pattern, _radius, _lval, _uval, _lifespan):
+  """
+  Lyapunov match of every point of the sublevel and superlevel diagrams of a frame that passes
+  the lifespan filter, as a DataFrame with columns frame, level, idx, dim, deviation, lifespan,
+  match, returned with the frame index for scoring the frames of a run in a pool of workers.
+  """
+  distance = ProximityIndex(_bmp_pattern, _lval, _uval, 1).distance(_frame)
+  scores = []
+  for (level, pattern) in [('sub', _sub_pattern), ('sup', _sup_pattern)]:
+    df = da.loadPersistenceDiagram(pattern, _frame)
+    df = df[abs(df['death'] - df['birth']) >= _lifespan]
+    instrumentation.record('scoring', frame=_frame, level=level, items=len(df))
+    scores.append(pd.DataFrame({'frame': _frame, 'level': level, 'idx': df.index.values, 'dim': df['dim'].values,
+                                'deviation': df['deviation'].values, 'lifespan': abs(df['death'] - df['birth']).values,
+                                'match': scoreDiagram(df, distance, _radius)},
+                               columns=['frame', 'level', 'idx', 'dim', 'deviation', 'lifespan', 'match']))
+  return (_frame, pd.concat(scores, ignore_index=True))
@@ -3,50 +3,42 @@
 
 import sys
 from optparse import OptionParser
-from PIL import Image
 import numpy as np
 import os
-from scipy import spatial
 
 import pandas as pd
+import singular_point_tracking as spt
+import instrumentation
 
 
-parser = OptionParser('usage: -d dir --sp1 singular_points_1 --sp2 singular_points_2 -o output'  )
+parser = OptionParser('usage: -d dir --sp1 singular_points_1 --sp2 singular_points_2 -o output [-r max_distance -a pair_distance] [--start first_frame --end last_frame]'  )
 
 parser.add_option("-d", dest="dir",
                   help="parent directory")
 parser.add_option("--sp1", dest="singular_points_1",
-                  help="first singular points")
+                  help="first singular points (pattern in sequence mode)")
 parser.add_option("--sp2", dest="singular_points_2",
                   help="second singular points")
 parser.add_option("-o", dest="output",
-                  help="output matches")
+                  help="output matches (track table in sequence mode)")
+parser.add_option("-r", dest="max_distance",
+                  help="maximum distance of a match (default: none, 5 in sequence mode)")
+parser.add_option("-a", dest="pair_distance",
+                  default=5,
+                  help="maximum distance of a +1/-1 pair flagged as annihilation or creation")
+parser.add_option("--start", dest="start",
+                  help="sequence mode: index of the first frame")
+parser.add_option("--end", dest="end",
+                  help="sequence mode: index of the last frame")
+instrumentation.addTraceOption(parser)
 
 (options, args) = parser.parse_args()
+instrumentation.startTrace(options, sys.argv[0])
 
+if (options.start is None) != (options.end is None):
+  parser.error("sequence mode requires both --start and --end")
 
-print("########## Matching %s ###########" % options.singular_points_1)
-
-print("Loading data...")
-
-# Load the singular point data
-sp1 = pd.read_csv(options.dir + "/" + options.singular_points_1, sep=' ', names=['x', 'y', 'type']).astype(np.int)
-sp2 = pd.read_csv(options.dir + "/" + options.singular_points_2, sep=' ', names=['x', 'y', 'type']).astype(np.int)
-
-for df in [sp1, sp2]: 
-  # Add a column of -1 for matchedidx
-  df['matchedidx'] = -1
-  # Add a column of -1 for distance
-  df['matcheddist'] = -1
-  # Add -1s for matched birth/death values
-  df['matchedx'] = -1
-  df['matchedy'] = -1
-
-types = sp1['type'].unique()
-
-print types
-
-print("...data loaded.")
+pair_distance = float(options.pair_distance)
 
 
 ########################################
@@ -62,50 +54,54 @@ print("...data loaded.")
 # +1/-1 points annihilate each other
 # +1/-1 points are created in pairs
 
-# - For each point in sp1, compute nearest neighbor to same type of point in sp2
-# - If two points have same nearest neighbor, tie-break with closest match
-# - Flag points for potential cancellations that have opposite signed point closer than
-#   the matched point
+# - For each type, query the nearest neighbors in sp2 of all points of sp1 at once
+# - If two points have same nearest neighbor, tie-break with closest match; the other
+#   point falls back to its next nearest neighbor
+# - Flag unmatched +1/-1 points that are mutual nearest neighbors as annihilations
+#   (creations in sequence mode, for points without a predecessor)
 
-def buildKDTrees(_sp2, _types):
-  data = {}
-  trees = {}
-  for t in _types:
-    tmp = _sp2.loc[(_sp2['type']==t), ['x', 'y']]
-    tmp = tmp.reset_index()
-    data.update({t: tmp})
-    trees.update({t: spatial.KDTree(tmp[['x','y']]) })
-  return data, trees
+if options.start is None:
 
-def matchSingularPointsForward(_sp1, _data, _trees):
-  print "Performing matching"  
+  max_distance = float(options.max_distance) if options.max_distance is not None else np.inf
 
-  for i in range(0,len(_sp1)):
+  print("########## Matching %s ###########" % options.singular_points_1)
 
-    point = _sp1.loc[i,['x','y']]
-    t = _sp1.loc[i,['type']][0]
+  print("Loading data...")
 
-    nn = _trees[t].query(point)
+  # Load the singular point data
+  sp1 = spt.loadSingularPoints(options.dir + "/" + options.singular_points_1)
+  sp2 = spt.loadSingularPoints(options.dir + "/" + options.singular_points_2)
 
-    matched_data = _data[t].loc[nn[1]]
+  print("...data loaded.")
 
-    if nn[0] > 5:
+  print("Performing matching")
 
-      print "MATCHING: %d, type=%d" % (i, t)
-      print point
-      print nn
-      print _data[t].loc[nn[1], ['index','x','y']]
+  with instrumentation.Stage('matching') as stage:
+    sp1 = spt.matchSingularPoints(sp1, sp2, max_distance, pair_distance)
+    stage.items = int(np.sum(sp1['matchedidx'] >= 0))
 
-    _sp1.loc[i,['matchedidx', 'matcheddist', 'matchedx', 'matchedy']] = [matched_data['index'], nn[0], matched_data['x'], matched_data['y']]
+  for i in np.nonzero(sp1['matcheddist'].values > 5)[0]:
+    print("MATCHING: %d, type=%d, distance=%f" % (i, sp1['type'].values[i], sp1['matcheddist'].values[i]))
 
-data, trees = buildKDTrees(sp2, types)
+  print("%d of %d points matched, %d annihilations" % (np.sum(sp1['matchedidx'] >= 0), len(sp1), np.sum(sp1['event'] == 'annihilation')//2))
 
-matchSingularPointsForward(sp1, data, trees)
+  sp1.to_csv(options.dir + "/" + options.output, index_label='idx')
 
-sp1 = sp1.sort_values(['type', 'matcheddist'])
+else:
 
-print sp1.loc[sp1.duplicated(['matchedidx'])]
+  # SEQUENCE MODE
+  # The singular point files of frames [start, end] (--sp1 is a file pattern) are matched frame
+  # to frame and written as one track table with velocities and pair events.
+  start = int(options.start)
+  end = int(options.end)
+  max_distance = float(options.max_distance) if options.max_distance is not None else 5.
 
-print pd.concat(g for _, g in sp1.groupby("matchedidx") if len(g) > 1)
+  tracker = spt.SingularPointTracker(max_distance, pair_distance)
 
+  for i in range(start, end + 1):
+    with instrumentation.Stage('tracking', frame=i) as stage:
+      table = tracker.step(i, spt.loadSingularPoints(options.dir + "/" + options.singular_points_1 % i))
+      stage.items = len(table)
+    print("Frame %d: %d points, %d new tracks, %d creations" % (i, len(table), np.sum(table['matchedid'] < 0), np.sum(table['event'] == 'creation')//2))
 
+  tracker.trackTable().to_csv(options.dir + "/" + options.output, index=False)
@@ -0,0 +1,167 @@
+
+
+
+import numpy as np
+import data_access as da
+import instrumentation
+
+
+class MatchGraph(object):
+  """
+  Matchings of consecutive frames of a run, kept as one int32 "next index" array per frame (the
+  row of the matched point in the next frame, -1 if unmatched) plus the columns needed from every
+  frame as plain arrays. Following the matches of a frame over k steps is k array lookups
+  instead of k DataFrame merges.
+
+  Frames are appended in order and can be dropped from the front, so the graph can slide along a
+  run while every file is read only once.
+  """
+
+  def __init__(self, _pointer='matchedidx', _columns=('birth', 'death')):
+    self.pointer = _pointer
+    self.names = list(_columns)
+    self.start = None
+    self.next = []
+    self.columns = []
+    self.tables = []
+
+  def __len__(self):
+    return len(self.next)
+
+  def stop(self):
+    """
+    One past the last frame held by the graph.
+    """
+    return self.start + len(self.next)
+
+  def append(self, _frame, _table, _keep_table=False):
+    """
+    Adds the matching table of the frame following the last frame of the graph. The table itself
+    is only kept if _keep_table is set.
+    """
+    if self.start is None:
+      self.start = _frame
+    elif _frame != self.stop():
+      raise ValueError('MatchGraph: frame %d does not follow frame %d' % (_frame, self.stop() - 1))
+    self.next.append(np.asarray(_table[self.pointer]).astype(np.int32))
+    self.columns.append(dict((c, np.asarray(_table[c])) for c in self.names))
+    self.tables.append(_table if _keep_table else None)
+
+  def popFront(self):
+    """
+    Drops the first frame of the graph.
+    """
+    self.next.pop(0)
+    self.columns.pop(0)
+    self.tables.pop(0)
+    self.start += 1
+
+  def size(self, _frame):
+    return len(self.next[_frame - self.start])
+
+  def table(self, _frame):
+    return self.tables[_frame - self.start]
+
+  def paths(self, _frame, _steps):
+    """
+    Positions of the points of frame _frame along their chains of matches: row k of the
+    (_steps + 1, n) result holds the row in frame _frame + k, or -1 once the chain is broken
+    (unmatched point, or a pointer past the end of the next frame).
+    """
+    paths = -np.ones((_steps + 1, self.size(_frame)), dtype=np.int64)
+    paths[0] = np.arange(self.size(_frame))
+
+    for k in range(1, _steps + 1):
+      alive = paths[k-1] >= 0
+      pointers = self.next[_frame + k - 1 - self.start][paths[k-1][alive]]
+      pointers[pointers >= self.size(_frame + k)] = -1
+      paths[k][alive] = pointers
+
+    return paths
+
+  def values(self, _frame, _positions, _column, _fill=-1):
+    """
+    Column values of frame _frame at the given rows, _fill where the row is -1.
+    """
+    column = self.columns[_frame - self.start][_column]
+    return np.where(_positions >= 0, column[np.maximum(_positions, 0)], _fill) if len(column) > 0 else np.full(len(_positions), _fill)
+
+
+def _loadTable(_pattern, _frame):
+  with instrumentation.Stage('csv load', frame=_frame) as stage:
+    table = da.loadPersistenceDiagram(_pattern, _frame)
+    stage.items = len(table)
+  return table
+
+
+def loadMatchGraph(_pattern, _start, _stop, _pointer='matchedidx', _columns=('birth', 'death'), _keep_tables=()):
+  """
+  Reads the matching files of frames _start to _stop (inclusive) into a MatchGraph. _pattern is a
+  file pattern or a packed store (see data_access.loadPersistenceDiagram). The tables of the
+  frames in _keep_tables are kept for output.
+  """
+  graph = MatchGraph(_pointer, _columns)
+  for i in range(_start, _stop + 1):
+    graph.append(i, _loadTable(_pattern, i), i in _keep_tables)
+  return graph
+
+
+def linearDeviation(_graph, _frame, _steps, _paths=None):
+  """
+  Deviation of the chains of matches starting at frame _frame from the linear interpolation in
+  the persistence plane, over _steps steps. Returns the mask of the points matched through and
+  their largest deviation. _paths may hold at least _steps + 1 rows of precomputed paths.
+  """
+  paths = _graph.paths(_frame, _steps) if _paths is None else _paths
+  matched = paths[_steps] != -1
+
+  birth = _graph.values(_frame, paths[0][matched], 'birth')
+  death = _graph.values(_frame, paths[0][matched], 'death')
+  deviation = -np.ones(len(birth))
+
+  for i in range(1, _steps + 1):
+    L_birth = birth + (float(i)/float(_steps))*(_graph.values(_frame + i, paths[i][matched], 'birth') - birth)
+    L_death = death + (float(i)/float(_steps))*(_graph.values(_frame + i, paths[i][matched], 'death') - death)
+    deviation = np.fmax(np.sqrt((L_birth - birth)**2 + (L_death - death)**2), deviation)
+
+  return matched, deviation
+
+
+def actualDeviation(_graph1, _graph2, _frame, _steps, _paths1=None, _paths2=None):
+  """
+  Deviation between the chains of matches of two matchings of the same run starting at frame
+  _frame: the largest pointwise distance in the persistence plane over _steps steps. Returns the
+  mask of the points matched through in both and their largest deviation.
+  """
+  paths1 = _graph1.paths(_frame, _steps) if _paths1 is None else _paths1
+  paths2 = _graph2.paths(_frame, _steps) if _paths2 is None else _paths2
+  matched = (paths1[_steps] != -1) & (paths2[_steps] != -1)
+
+  deviation = -np.ones(np.sum(matched))
+  for i in range(1, _steps + 1):
+    birth1 = _graph1.values(_frame + i, paths1[i][matched], 'birth').astype(int)
+    death1 = _graph1.values(_frame + i, paths1[i][matched], 'death').astype(int)
+    birth2 = _graph2.values(_frame + i, paths2[i][matched], 'birth').astype(int)
+    death2 = _graph2.values(_frame + i, paths2[i][matched], 'death').astype(int)
+    deviation = np.fmax(np.sqrt((birth1 - birth2)**2 + (death1 - death2)**2), deviation)
+
+  return matched, deviation
+
+
+def slidingWindow(_graphs, _patterns, _start, _end, _horizon):
+  """
+  Streams a run through match graphs: yields every start frame t of [_start, _end) once the
+  graphs hold frames t to min(t + _horizon, _end). Each matching file is read exactly once and
+  at most _horizon + 1 frames are held at a time.
+  """
+  for i in range(_start, min(_start + _horizon, _end) + 1):
+    for graph, pattern in zip(_graphs, _patterns):
+      graph.append(i, _loadTable(pattern, i))
+
+  for t in range(_start, _end):
+    yield t
+    for graph in _graphs:
+      graph.popFront()
+    if t + _horizon + 1 <= _end:
+      for graph, pattern in zip(_graphs, _patterns):
+        graph.append(t + _horizon + 1, _loadTable(pattern, t + _horizon + 1))
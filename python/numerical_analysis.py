@@ -4,6 +4,8 @@ import scipy.signal
 import scipy.ndimage
 import numpy as np
 import math
+import time
+import instrumentation
 
 def plot(list_of_things_to_plot):
     plt.rcParams['figure.figsize'] = (20.0, 10.0)
@@ -20,21 +22,46 @@ class timer(object):
             print('[%s]' % self.name)
         print('Elapsed: %s seconds' % (time.time() - self.tstart))
 
+# Wavenumber factors by (shape, order)
+_spectral_grids = {}
+
+def spectral_grids(shape, order=1):
+    """
+    Factors (2 pi i k / N)^order along both axes for the rfft2 coefficients of a real field of the
+    given shape, with the Nyquist wavenumber zeroed for odd orders so derivatives stay real.
+    Returned as an (N, 1) and a (1, M//2 + 1) array so they broadcast; cached per shape and order.
+    """
+    key = (tuple(shape), order)
+    if key not in _spectral_grids:
+        [N, M] = shape
+        kx = np.arange(N, dtype=float)[:,None]
+        ky = np.arange(M//2 + 1, dtype=float)[None,:]
+        kx = kx - float(N) * ( kx > float(N)/2.0 )
+        if order % 2 == 1 and N % 2 == 0: kx[N//2,:] = 0.0
+        if order % 2 == 1 and M % 2 == 0: ky[:,M//2] = 0.0
+        kx = (kx * 2.0 * math.pi * 1j / float(N)) ** order
+        ky = (ky * 2.0 * math.pi * 1j / float(M)) ** order
+        _spectral_grids[key] = (kx, ky)
+    return _spectral_grids[key]
+
+def spectral_derivatives(u, orders):
+    """
+    Spectral derivatives of the real field u, all from a single rfft2: orders is a list of
+    (order along axis 0, order along axis 1) pairs, one derivative field is returned per pair.
+    """
+    u_fft = np.fft.rfft2(u)
+    derivatives = []
+    for (order_x, order_y) in orders:
+        d_fft = u_fft
+        if order_x > 0:
+            d_fft = d_fft * spectral_grids(u.shape, order_x)[0]
+        if order_y > 0:
+            d_fft = d_fft * spectral_grids(u.shape, order_y)[1]
+        derivatives.append(np.fft.irfft2(d_fft, s=u.shape))
+    return derivatives
+
 def fourier_diff(u, order=1):
-    [N, M] = u.shape
-    [kx, ky] = np.mgrid[0:N,0:M]
-    kx = kx - float(N) * ( kx > float(N)/2.0 )
-    ky = ky - float(M) * ( ky > float(M)/2.0 )    
-    if order % 2 == 1 and N % 2 == 0: kx[N//2,:] = 0.0
-    if order % 2 == 1 and M % 2 == 0: ky[:,M//2] = 0.0
-    kx = (kx * 2.0 * math.pi * 1j / float(N)) ** order
-    ky = (ky * 2.0 * math.pi * 1j / float(M)) ** order
-    u_fft = np.fft.fft2(u)
-    ux_fft = u_fft * kx
-    uy_fft = u_fft * ky
-    ux = np.real(np.fft.ifft2(ux_fft))
-    uy = np.real(np.fft.ifft2(uy_fft))
-    return [ux, uy]
+    return spectral_derivatives(u, [(order, 0), (0, order)])
 
 def orientation_field(du, radius=5):
     """
@@ -46,6 +73,62 @@ def orientation_field(du, radius=5):
     X = scipy.ndimage.filters.gaussian_filter(ux**2.0 - uy**2.0, sigma=radius)
     return .5 * np.arctan2(Y, X)
 
+def _gradient(u, axis, out):
+    """
+    np.gradient of u along one axis (unit spacing, first order edges), written into out.
+    """
+    n = u.shape[axis]
+    def s(start, stop):
+        index = [slice(None)] * u.ndim
+        index[axis] = slice(start, stop)
+        return tuple(index)
+    np.subtract(u[s(2, n)], u[s(0, n-2)], out=out[s(1, n-1)])
+    np.divide(out[s(1, n-1)], 2.0, out=out[s(1, n-1)])
+    np.subtract(u[s(1, 2)], u[s(0, 1)], out=out[s(0, 1)])
+    np.subtract(u[s(n-1, n)], u[s(n-2, n-1)], out=out[s(n-1, n)])
+    return out
+
+def orientation_field_stack(stack, radius=5, dtype=np.float64, out=None, chunk=16):
+    """
+    Computes the orientation field of every frame of a (T, H, W) stack (result everywhere between
+    -pi/2 and pi/2), as orientation_field(np.gradient(frame), radius) does for a single frame:
+    gradients and smoothing act on the spatial axes only. Frames are processed chunk at a time
+    with buffers allocated once, in float64 or float32 (dtype). The result goes to out if given,
+    e.g. a memory map of a packed file, so a whole run never has to be held in memory.
+    """
+    [T, H, W] = stack.shape
+    if out is None:
+        out = np.empty((T, H, W), dtype=dtype)
+    chunk = max(1, min(chunk, T))
+
+    u = np.empty((chunk, H, W), dtype=dtype)
+    ux = np.empty((chunk, H, W), dtype=dtype)
+    uy = np.empty((chunk, H, W), dtype=dtype)
+    tmp = np.empty((chunk, H, W), dtype=dtype)
+    Y = np.empty((chunk, H, W), dtype=dtype)
+    X = np.empty((chunk, H, W), dtype=dtype)
+
+    for start in range(0, T, chunk):
+        k = min(chunk, T - start)
+        u[:k] = stack[start:(start + k)]
+        _gradient(u[:k], 1, ux[:k])
+        _gradient(u[:k], 2, uy[:k])
+
+        # Structure tensor entries, smoothed over the spatial axes
+        np.multiply(ux[:k], uy[:k], out=tmp[:k])
+        tmp[:k] *= 2.0
+        scipy.ndimage.filters.gaussian_filter(tmp[:k], sigma=(0, radius, radius), output=Y[:k])
+        np.square(ux[:k], out=tmp[:k])
+        np.square(uy[:k], out=ux[:k])
+        tmp[:k] -= ux[:k]
+        scipy.ndimage.filters.gaussian_filter(tmp[:k], sigma=(0, radius, radius), output=X[:k])
+
+        np.arctan2(Y[:k], X[:k], out=tmp[:k])
+        tmp[:k] *= .5
+        out[start:(start + k)] = tmp[:k]
+
+    return out
+
 def singular_points(DF):
     JX = np.diff(DF, axis=0)
     JY = np.diff(DF, axis=1)
@@ -53,7 +136,51 @@ def singular_points(DF):
     JY += math.pi * (JY < -math.pi/2.0 ) - math.pi * (JY > math.pi/2.0)
     return np.rint((np.diff(JY, axis=0) - np.diff(JX, axis=1))/math.pi)
 
-def emb_wavenumber(u, method="difference"):
+def singular_point_list(DF):
+    """
+    Singular points of the orientation field as an (n, 3) int array of (row, col, charge), in the
+    order of np.argwhere(singular_points(DF)), without building a list per point.
+    """
+    SP = singular_points(DF)
+    [rows, cols] = np.nonzero(SP)
+    return np.column_stack((rows, cols, SP[rows, cols])).astype(int)
+
+def analyze_frame(index, u, radius, wavenumber_method=None):
+    """
+    Orientation field, singular points and (if wavenumber_method is given) local wavenumber of
+    one temperature field u, for processing the frames of a run in a pool of workers.
+    """
+    return analyze_frames([index], np.asarray(u)[None], radius, wavenumber_method)[0]
+
+def analyze_frames(indices, stack, radius, wavenumber_method=None):
+    """
+    analyze_frame for every frame of a (T, H, W) stack of temperature fields, with frame indices
+    indices: the orientation fields of all frames come from one orientation_field_stack call.
+    Returns the (index, OF, locations, WN) of every frame.
+    """
+    with instrumentation.Stage('orientation field', frame=indices[0], frames=len(indices)) as stage:
+        OFs = orientation_field_stack(stack, radius)
+        stage.items = OFs.size
+    results = []
+    for (index, u, OF) in zip(indices, stack, OFs):
+        with instrumentation.Stage('singular points', frame=index) as stage:
+            locations = singular_point_list(OF)
+            stage.items = len(locations)
+        WN = None
+        if wavenumber_method is not None:
+            with instrumentation.Stage('wavenumber', frame=index, method=wavenumber_method) as stage:
+                WN = emb_wavenumber(np.asarray(u).astype(float), wavenumber_method)
+                stage.items = WN.size
+        results.append((index, OF, locations, WN))
+    return results
+
+def emb_wavenumber(u, method="difference", block=64):
+    """
+    Local wavenumber of the pattern u. The derivatives come from finite differences or, for the
+    fourier method, from one rfft2 (spectral_derivatives). The four case formulas are then
+    evaluated block rows at a time, so the temporaries are bounded by the block size; the
+    results, including nan where an unused case overflows, are those of the full-size formulas.
+    """
     u = scipy.ndimage.filters.gaussian_filter(u, sigma=2)
     u = u - np.sum(u)/np.size(u)
     u = u / np.max(np.absolute(u))
@@ -64,12 +191,18 @@ def emb_wavenumber(u, method="difference"):
         uxxx = np.gradient(uxx)[0]
         uyyy = np.gradient(uyy)[1]
     elif method == "fourier":
-        [ux, uy] = fourier_diff(u, order=1)
-        [uxx, uyy] = fourier_diff(u, order=2)
-        [uxxx, uyyy] = fourier_diff(u, order=3)
-        uxy = fourier_diff(ux)[1]
+        [ux, uy, uxx, uyy, uxxx, uyyy, uxy] = spectral_derivatives(u, [(1, 0), (0, 1), (2, 0), (0, 2), (3, 0), (0, 3), (1, 1)])
     else:
         raise ValueError('EMB_Wavenumber: Unrecognized method "' + method + '"')
+
+    wavenumber = np.empty(u.shape)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for start in range(0, u.shape[0], block):
+            rows = slice(start, start + block)
+            wavenumber[rows] = _emb_wavenumber_block(u[rows], ux[rows], uy[rows], uxx[rows], uyy[rows], uxy[rows], uxxx[rows], uyyy[rows])
+    return wavenumber
+
+def _emb_wavenumber_block(u, ux, uy, uxx, uyy, uxy, uxxx, uyyy):
     Test1 = np.absolute(u) > np.maximum(np.absolute(ux),np.absolute(uy))
     Test2 = np.absolute(uxx) > np.absolute(uyy)
     Test3 = np.absolute(ux) > np.absolute(uy)
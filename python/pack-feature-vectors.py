@@ -0,0 +1,57 @@
+import sys
+from optparse import OptionParser
+import os
+import numpy as np
+import packed_store as ps
+import instrumentation
+
+
+parser = OptionParser('usage: -d dir -i input_pattern --start first_frame --end last_frame -o output.fstore [--frame-descriptors]'  )
+
+parser.add_option("-d", dest="dir",
+                  help="parent directory")
+parser.add_option("-i", dest="input_pattern",
+                  help="feature vector text file pattern relative to directory")
+parser.add_option("--start", dest="start",
+                  help="index of the first frame")
+parser.add_option("--end", dest="end",
+                  help="index of the last frame")
+parser.add_option("-o", dest="output_file",
+                  help="output feature store relative to directory (appended to if it exists)")
+parser.add_option("--frame-descriptors", dest="frame_descriptors", action="store_true", default=False,
+                  help="the feature files hold frame engine descriptors (get-keypoint-descriptors.py --frame-descriptors)")
+instrumentation.addTraceOption(parser)
+
+(options, args) = parser.parse_args()
+instrumentation.startTrace(options, sys.argv[0])
+
+# Parse the inputs
+start = int(options.start)
+end = int(options.end)
+
+if not ps.isFeatureStore(options.output_file):
+  parser.error("output file must have the %s extension" % ps.FEATURE_EXTENSION)
+
+# Append the feature vectors of every frame of the range to the store
+frames = range(start, end + 1)
+
+print("Packing %d feature files..." % len(frames))
+# The width of the rows (and so the columns of the store) comes from the first frame with rows
+store = None
+empty = []
+for i in frames:
+  with instrumentation.Stage('load', frame=i) as stage:
+    rows = np.loadtxt(options.dir + "/" + options.input_pattern % i, delimiter=' ', ndmin=2)
+    stage.items = rows.shape[0]
+  if rows.size == 0:
+    empty.append(i)
+    continue
+  if store is None:
+    store = ps.FeatureStore(options.dir + "/" + options.output_file, ps.featureColumns(rows.shape[1]), 'frame' if options.frame_descriptors else 'legacy')
+  for j in empty:
+    store.append(j, np.zeros((0, len(store.columns))))
+  empty = []
+  store.append(i, rows)
+if empty:
+  print("Frames without rows after the last frame with rows were not packed: %s" % empty)
+print("...done.")
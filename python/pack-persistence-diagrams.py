@@ -0,0 +1,40 @@
+import sys
+from optparse import OptionParser
+import os
+import packed_store as ps
+import instrumentation
+
+
+parser = OptionParser('usage: -d dir -i input_pattern --start first_frame --end last_frame -o output.pack'  )
+
+parser.add_option("-d", dest="dir",
+                  help="parent directory")
+parser.add_option("-i", dest="input_pattern",
+                  help="persistence diagram file pattern relative to directory")
+parser.add_option("--start", dest="start",
+                  help="index of the first frame")
+parser.add_option("--end", dest="end",
+                  help="index of the last frame")
+parser.add_option("-o", dest="output_file",
+                  help="output packed store relative to directory")
+instrumentation.addTraceOption(parser)
+
+(options, args) = parser.parse_args()
+instrumentation.startTrace(options, sys.argv[0])
+
+# Parse the inputs
+start = int(options.start)
+end = int(options.end)
+
+if not ps.isPacked(options.output_file):
+  parser.error("output file must have the %s extension" % ps.EXTENSION)
+
+# Pack every diagram of the range into one columnar store
+frames = range(start, end + 1)
+files = [options.dir + "/" + options.input_pattern % i for i in frames]
+
+print("Packing %d diagrams..." % len(files))
+with instrumentation.Stage('pack') as stage:
+  ps.packDiagrams(files, frames, options.dir + "/" + options.output_file)
+  stage.items = len(files)
+print("...done.")
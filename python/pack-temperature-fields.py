@@ -0,0 +1,42 @@
+import sys
+from optparse import OptionParser
+import os
+import data_access as da
+import packed_store as ps
+import instrumentation
+
+
+parser = OptionParser('usage: -d dir -i image_pattern --start first_frame --end last_frame -o output.pack'  )
+
+parser.add_option("-d", dest="dir",
+                  help="parent directory")
+parser.add_option("-i", dest="image_pattern",
+                  help="bitmap image pattern relative to directory")
+parser.add_option("--start", dest="start",
+                  help="index of the first frame")
+parser.add_option("--end", dest="end",
+                  help="index of the last frame")
+parser.add_option("-o", dest="output_file",
+                  help="output packed frame stack relative to directory")
+instrumentation.addTraceOption(parser)
+
+(options, args) = parser.parse_args()
+instrumentation.startTrace(options, sys.argv[0])
+
+# Parse the inputs
+start = int(options.start)
+end = int(options.end)
+
+if not ps.isPacked(options.output_file):
+  parser.error("output file must have the %s extension" % ps.EXTENSION)
+if end < start:
+  parser.error("the frame range is empty (--end before --start)")
+
+# Pack every image of the range into one (T, H, W) uint8 stack
+frames = range(start, end + 1)
+
+print("Packing %d images..." % len(frames))
+with instrumentation.Stage('pack') as stage:
+  ps.packFrames(lambda i: da.loadTemperatureField(options.dir + "/" + options.image_pattern % i), frames, options.dir + "/" + options.output_file)
+  stage.items = len(frames)
+print("...done.")
@@ -0,0 +1,452 @@
+
+
+
+import contextlib
+import fcntl
+import json
+import os
+import struct
+import numpy as np
+import pandas as pd
+
+
+# Packed files hold a set of named arrays in one file: a magic string, the length of a JSON
+# header, the header itself, then the raw arrays, each aligned to ALIGNMENT bytes. The header
+# gives dtype, shape and offset of every array plus free-form attributes, so any array can be
+# opened as a read-only memory map without reading the rest of the file.
+MAGIC = b'RBCPACK1'
+ALIGNMENT = 64
+EXTENSION = '.pack'
+
+
+def isPacked(_file):
+  """
+  True if the file name refers to a packed file.
+  """
+  return str(_file).endswith(EXTENSION)
+
+
+def _align(_n):
+  return ((_n + ALIGNMENT - 1)//ALIGNMENT)*ALIGNMENT
+
+
+def _layout(_specs, _attrs):
+  """
+  Computes the header and the file offset of every array given (name, dtype, shape) specs.
+  """
+  arrays = {}
+  offset = 0
+  for (name, dtype, shape) in _specs:
+    dtype = np.dtype(dtype)
+    arrays[name] = {'dtype': dtype.str, 'shape': [int(s) for s in shape], 'offset': offset}
+    offset = _align(offset + dtype.itemsize*int(np.prod(shape)))
+
+  header = json.dumps({'arrays': arrays, 'attrs': _attrs}).encode('utf-8')
+  start = _align(len(MAGIC) + 8 + len(header))
+  return header, start, start + offset
+
+
+def createPacked(_file, _specs, _attrs=None):
+  """
+  Creates a packed file for arrays given as (name, dtype, shape) specs and returns the arrays as
+  writable memory maps, so large arrays (e.g. frame stacks) can be filled one slice at a time.
+  """
+  header, start, size = _layout(_specs, _attrs or {})
+
+  with open(_file, 'wb') as f:
+    f.write(MAGIC)
+    f.write(struct.pack('<Q', len(header)))
+    f.write(header)
+    f.seek(size - 1)
+    f.write(b'\0')
+
+  return openPacked(_file, 'r+')[0]
+
+
+def writePacked(_file, _arrays, _attrs=None):
+  """
+  Writes a dict of arrays to a packed file.
+  """
+  names = sorted(_arrays.keys())
+  arrays = dict((name, np.ascontiguousarray(_arrays[name])) for name in names)
+  out = createPacked(_file, [(name, arrays[name].dtype, arrays[name].shape) for name in names], _attrs)
+  for name in names:
+    out[name][...] = arrays[name]
+    out[name].flush()
+
+
+def openPacked(_file, _mode='r'):
+  """
+  Opens a packed file. Returns a dict of memory-mapped arrays and the dict of attributes.
+  """
+  with open(_file, 'rb') as f:
+    if f.read(len(MAGIC)) != MAGIC:
+      raise ValueError('openPacked: "' + str(_file) + '" is not a packed file')
+    length = struct.unpack('<Q', f.read(8))[0]
+    header = json.loads(f.read(length).decode('utf-8'))
+
+  start = _align(len(MAGIC) + 8 + length)
+  arrays = {}
+  for name, spec in header['arrays'].items():
+    shape = tuple(spec['shape'])
+    if int(np.prod(shape)) == 0:
+      arrays[name] = np.zeros(shape, dtype=np.dtype(spec['dtype']))
+    else:
+      arrays[name] = np.memmap(_file, dtype=np.dtype(spec['dtype']), mode=_mode, offset=start + spec['offset'], shape=shape)
+
+  return arrays, header['attrs']
+
+
+def columnType(_values):
+  """
+  Smallest dtype that holds a column exactly: int16/int32/int64 for integer values, otherwise
+  float32 or float64.
+  """
+  values = np.asarray(_values)
+  if values.dtype.kind in 'iub' or ((values.dtype.kind == 'f') and np.all(np.isfinite(values)) and np.all(values == np.round(values))):
+    if len(values) == 0:
+      return np.dtype(np.int16)
+    for dtype in [np.int16, np.int32]:
+      info = np.iinfo(dtype)
+      if (values.min() >= info.min) and (values.max() <= info.max):
+        return np.dtype(dtype)
+    return np.dtype(np.int64)
+  values = values.astype(np.float64)
+  roundtrip = values.astype(np.float32).astype(np.float64)
+  if np.all((roundtrip == values) | (np.isnan(roundtrip) & np.isnan(values))):
+    return np.dtype(np.float32)
+  return np.dtype(np.float64)
+
+
+def packDiagrams(_files, _frames, _output):
+  """
+  Packs a run of persistence diagram CSVs (diamorse output, or any per-frame table with the same
+  numeric columns, such as the matching and deviation outputs) into one columnar packed file.
+
+  Each column is stored once for the whole run with the smallest dtype that holds it exactly.
+  'frames' holds the frame indices and 'offsets' the row range of every frame, so the rows of
+  frame _frames[k] are offsets[k]:offsets[k+1].
+  """
+  columns = None
+  values = []
+  counts = []
+
+  for f in _files:
+    data = pd.read_csv(f)
+    if columns is None:
+      columns = list(data.columns)
+    elif list(data.columns) != columns:
+      raise ValueError('packDiagrams: columns of "' + str(f) + '" differ from the first diagram')
+    values.append(data)
+    counts.append(len(data))
+
+  arrays = {}
+  arrays['frames'] = np.asarray(_frames, dtype=np.int64)
+  arrays['offsets'] = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+  for i, c in enumerate(columns):
+    column = np.concatenate([np.asarray(v[c]) for v in values]) if len(values) > 0 else np.zeros(0)
+    arrays['column%d' % i] = column.astype(columnType(column))
+
+  writePacked(_output, arrays, {'kind': 'diagrams', 'columns': columns})
+
+
+class DiagramStore(object):
+  """
+  Read access to a packed run of persistence diagrams. Frames are read lazily from the memory
+  map: reading frame i only touches the pages holding its rows.
+  """
+
+  def __init__(self, _file):
+    arrays, attrs = openPacked(_file)
+    if attrs.get('kind') != 'diagrams':
+      raise ValueError('DiagramStore: "' + str(_file) + '" is not a packed diagram file')
+    self.columns = attrs['columns']
+    self.frames = np.asarray(arrays['frames'])
+    self.offsets = np.asarray(arrays['offsets'])
+    self.data = [arrays['column%d' % i] for i in range(len(self.columns))]
+    self.positions = dict((int(f), k) for k, f in enumerate(self.frames))
+
+  def __contains__(self, _frame):
+    return int(_frame) in self.positions
+
+  def __len__(self):
+    return len(self.frames)
+
+  def rows(self, _frame):
+    """
+    Row range of a frame in the columns.
+    """
+    k = self.positions[int(_frame)]
+    return self.offsets[k], self.offsets[k+1]
+
+  def frameArrays(self, _frame):
+    """
+    Zero-copy views on the typed columns of a frame, keyed by column name.
+    """
+    start, stop = self.rows(_frame)
+    return dict((c, d[start:stop]) for c, d in zip(self.columns, self.data))
+
+  def frame(self, _frame):
+    """
+    Frame as a DataFrame, with the columns widened to int64/float64 as pd.read_csv reads them.
+    """
+    start, stop = self.rows(_frame)
+    data = pd.DataFrame()
+    for c, d in zip(self.columns, self.data):
+      if d.dtype.kind == 'f':
+        data[c] = np.asarray(d[start:stop], dtype=np.float64)
+      else:
+        data[c] = np.asarray(d[start:stop], dtype=np.int64)
+    return data
+
+
+def packFrames(_load, _frames, _output):
+  """
+  Packs a run of temperature fields into one contiguous uint8 (T, H, W) array. _load(i) returns
+  the image of frame i; frames are written one at a time so the run never has to fit in memory.
+  'frames' holds the frame index of every slice of the stack.
+  """
+  _frames = list(_frames)
+  if len(_frames) == 0:
+    raise ValueError('packFrames: no frames to pack')
+  first = np.asarray(_load(_frames[0]))
+
+  out = createPacked(_output, [('stack', np.uint8, (len(_frames),) + first.shape), ('frames', np.int64, (len(_frames),))], {'kind': 'frames'})
+  out['frames'][:] = _frames
+
+  for k, i in enumerate(_frames):
+    image = first if k == 0 else np.asarray(_load(i))
+    if image.shape != first.shape:
+      raise ValueError('packFrames: frame %d has shape %s, expected %s' % (i, image.shape, first.shape))
+    if (image.dtype != np.uint8) and ((image.min() < 0) or (image.max() > 255)):
+      raise ValueError('packFrames: frame %d does not fit in uint8' % i)
+    out['stack'][k] = image
+
+  out['stack'].flush()
+  out['frames'].flush()
+
+
+class FrameStack(object):
+  """
+  Read access to a packed stack of temperature fields. Frames and ranges of consecutive frames
+  are returned as zero-copy views on the memory map.
+  """
+
+  def __init__(self, _file):
+    arrays, attrs = openPacked(_file)
+    if attrs.get('kind') != 'frames':
+      raise ValueError('FrameStack: "' + str(_file) + '" is not a packed frame stack')
+    self.stack = arrays['stack']
+    self.frames = np.asarray(arrays['frames'])
+    self.positions = dict((int(f), k) for k, f in enumerate(self.frames))
+
+  def __contains__(self, _frame):
+    return int(_frame) in self.positions
+
+  def __len__(self):
+    return len(self.frames)
+
+  def frame(self, _frame):
+    """
+    (H, W) view of one frame.
+    """
+    return self.stack[self.positions[int(_frame)]]
+
+  def range(self, _start, _stop):
+    """
+    (T, H, W) view of frames _start to _stop (exclusive). Views require the frames to be stored
+    consecutively; otherwise the frames are gathered into a copy.
+    """
+    positions = [self.positions[i] for i in range(int(_start), int(_stop))]
+    if (len(positions) > 0) and (positions == list(range(positions[0], positions[0] + len(positions)))):
+      return self.stack[positions[0]:(positions[-1] + 1)]
+    return self.stack[positions]
+
+
+# Feature stores are directories holding a JSON schema, the records (fixed-width rows of int32,
+# the rows of the text feature files of get-keypoint-descriptors.py) and an index of (frame,
+# first row, end row) int64 triples. Records and index are only ever appended to, records first,
+# so the index never refers to rows that are not on disk.
+FEATURE_EXTENSION = '.fstore'
+FEATURE_DTYPE = np.int32
+
+# Descriptor engines of the feature vectors: 'legacy' (computer_vision.getFeatureVector, per
+# keypoint) or 'frame' (computer_vision.getFeatureVectors, from the orientation field of the
+# whole frame). The two are not comparable, so stores keep the engine in their schema; stores
+# without it are legacy.
+DESCRIPTOR_ENGINES = ['legacy', 'frame']
+
+
+def isFeatureStore(_file):
+  """
+  True if the file name refers to a feature store.
+  """
+  return str(_file).rstrip('/').endswith(FEATURE_EXTENSION)
+
+
+def featureColumns(_width):
+  """
+  Column names of feature rows of the given width: idx, match_idx, match_dist, the keypoint
+  coordinates and type flags and, for rows with feature vectors, orientation, peak, value and
+  the feature vector entries f0, f1, ...
+  """
+  columns = ['idx', 'match_idx', 'match_dist', 'x', 'y', 'ph_sub_0', 'ph_sub_1', 'ph_sup_0', 'ph_sup_1', 'td_p1', 'td_m1', 'td_p2', 'td_m2']
+  if _width > len(columns):
+    columns += ['orientation', 'peak', 'value']
+    columns += ['f%d' % i for i in range(_width - len(columns))]
+  return columns
+
+
+class FeatureStore(object):
+  """
+  Appendable store of keypoint feature vectors. Frames are appended one at a time; reads are
+  zero-copy views on a memory map of the records, selected by frame, frame range or keypoint
+  type without parsing any text.
+
+  Several processes may append to the same store (e.g. parallel runs of
+  get-keypoint-descriptors.py with a .fstore output): creation and appends hold an exclusive
+  lock on the index file and reread the index under it.
+  """
+
+  def __init__(self, _path, _columns=None, _descriptors=None):
+    """
+    Opens the store at _path, creating it with the given column names and descriptor engine
+    (see DESCRIPTOR_ENGINES, 'legacy' by default) if it does not exist. Opening an existing store
+    with other columns or another engine is an error.
+    """
+    self.path = str(_path)
+    schema = os.path.join(self.path, 'schema.json')
+
+    if not os.path.exists(schema):
+      if _columns is None:
+        raise ValueError('FeatureStore: "' + self.path + '" does not exist and no columns were given')
+      try:
+        os.makedirs(self.path)
+      except OSError:
+        if not os.path.isdir(self.path):
+          raise
+      with self._lock():
+        # Another process may have created the store meanwhile
+        if not os.path.exists(schema):
+          open(os.path.join(self.path, 'records.bin'), 'ab').close()
+          with open(schema + '.tmp', 'w') as f:
+            json.dump({'kind': 'features', 'dtype': np.dtype(FEATURE_DTYPE).str, 'columns': list(_columns),
+                       'descriptors': _descriptors or 'legacy'}, f)
+          os.rename(schema + '.tmp', schema)
+
+    with open(schema) as f:
+      attrs = json.load(f)
+    if (_columns is not None) and (list(_columns) != attrs['columns']):
+      raise ValueError('FeatureStore: columns of "' + self.path + '" differ from the given columns')
+    if (_descriptors is not None) and (_descriptors != attrs.get('descriptors', 'legacy')):
+      raise ValueError('FeatureStore: "' + self.path + '" holds ' + attrs.get('descriptors', 'legacy') + ' descriptors, not ' + _descriptors)
+
+    self.columns = attrs['columns']
+    self.descriptors = attrs.get('descriptors', 'legacy')
+    self.dtype = np.dtype(attrs['dtype'])
+    self.records = None
+    self._readIndex()
+
+  @contextlib.contextmanager
+  def _lock(self):
+    """
+    Exclusive lock on the index file (created if missing), held by appends.
+    """
+    with open(os.path.join(self.path, 'index.bin'), 'ab') as f:
+      fcntl.flock(f, fcntl.LOCK_EX)
+      try:
+        yield f
+      finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+  def _readIndex(self):
+    index = np.fromfile(os.path.join(self.path, 'index.bin'), dtype=np.int64).reshape((-1, 3))
+    self.frames = index[:,0]
+    self.offsets = index[:,1:]
+    self.positions = dict((int(f), k) for k, f in enumerate(self.frames))
+    self.size = int(self.offsets[-1,1]) if len(index) > 0 else 0
+
+  def _data(self):
+    """
+    Memory map of all records, reopened when records were appended since the last read.
+    """
+    if (self.records is None) or (len(self.records) != self.size):
+      if self.size == 0:
+        self.records = np.zeros((0, len(self.columns)), dtype=self.dtype)
+      else:
+        self.records = np.memmap(os.path.join(self.path, 'records.bin'), dtype=self.dtype, mode='r', shape=(self.size, len(self.columns)))
+    return self.records
+
+  def __contains__(self, _frame):
+    return int(_frame) in self.positions
+
+  def __len__(self):
+    return len(self.frames)
+
+  def append(self, _frame, _rows):
+    """
+    Appends the rows of a frame, as a (n, columns) array. The index is reread under the lock,
+    so frames appended by other processes since it was last read are kept.
+    """
+    rows = np.reshape(np.asarray(_rows), (-1, len(self.columns)))
+    rows = np.trunc(rows).astype(self.dtype) if rows.dtype.kind == 'f' else rows.astype(self.dtype)
+
+    with self._lock() as index:
+      self._readIndex()
+      if int(_frame) in self.positions:
+        raise ValueError('FeatureStore: frame %d is already stored' % _frame)
+
+      with open(os.path.join(self.path, 'records.bin'), 'r+b') as f:
+        # Drop rows of an interrupted append that never made it to the index
+        f.seek(self.size*len(self.columns)*self.dtype.itemsize)
+        f.truncate()
+        f.write(np.ascontiguousarray(rows).tobytes())
+      index.write(np.asarray([_frame, self.size, self.size + len(rows)], dtype=np.int64).tobytes())
+      index.flush()
+
+      self._readIndex()
+
+  def frame(self, _frame):
+    """
+    (n, columns) view of the rows of one frame.
+    """
+    [start, stop] = self.offsets[self.positions[int(_frame)]]
+    return self._data()[start:stop]
+
+  def select(self, _start=None, _stop=None, _type=None):
+    """
+    Rows of the frames in [_start, _stop) (all frames by default), optionally only the
+    keypoints of one type (a type flag column, e.g. 'td_p1'). Returns the frame of every row and
+    the rows, a view on the memory map if they are consecutive records.
+    """
+    keep = np.ones(len(self.frames), dtype=bool)
+    if _start is not None:
+      keep &= self.frames >= _start
+    if _stop is not None:
+      keep &= self.frames < _stop
+    positions = np.nonzero(keep)[0]
+    positions = positions[np.argsort(self.frames[positions], kind='stable')]
+
+    lengths = self.offsets[positions,1] - self.offsets[positions,0]
+    rows = np.concatenate([np.arange(self.offsets[k,0], self.offsets[k,1]) for k in positions]) if len(positions) > 0 else np.zeros(0, dtype=int)
+    frames = np.repeat(self.frames[positions], lengths)
+
+    data = self._data()
+    if _type is not None:
+      selected = data[rows, self.columns.index(_type)] == 1
+      rows = rows[selected]
+      frames = frames[selected]
+    if (len(rows) > 0) and (rows[-1] - rows[0] + 1 == len(rows)) and np.all(np.diff(rows) == 1):
+      # Consecutive records, e.g. a whole run: a view on the memory map instead of a copy
+      return frames, data[rows[0]:rows[-1] + 1]
+    return frames, data[rows]
+
+  def table(self, _start=None, _stop=None, _type=None):
+    """
+    Selected rows (see select) as a DataFrame with a leading frame column.
+    """
+    frames, rows = self.select(_start, _stop, _type)
+    data = pd.DataFrame(np.asarray(rows, dtype=np.int64), columns=self.columns)
+    data.insert(0, 'frame', frames)
+    return data
@@ -0,0 +1,47 @@
+
+
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+
+
+# Definitions of mask types
+MASK_IDS = {0: 'Unassigned', 255: 'Parallel rolls'}
+
+
+def defectIndicator(_shape, _singular_points, _ph_defects):
+  """
+  Indicator of the topological defects (singular points, given as row x, column y) and the
+  p.h. defects (pattern match centers, given as column center_x, row center_y) of a frame.
+  """
+  defects = np.zeros(_shape, dtype=bool)
+  defects[_singular_points['x'].values.astype(int), _singular_points['y'].values.astype(int)] = True
+  defects[_ph_defects['center_y'].values.astype(int), _ph_defects['center_x'].values.astype(int)] = True
+  return defects
+
+
+def parallelRollMask(_defects, _roll_width):
+  """
+  Candidate parallel roll regions: the pixels farther than _roll_width from every defect. This
+  is the complement of morphology.binary_dilation(_defects, morphology.disk(_roll_width)), as the
+  disk holds the offsets of length at most _roll_width, but comes from a single Euclidean
+  distance transform whose cost does not depend on the roll width.
+  """
+  if not np.any(_defects):
+    return np.ones(_defects.shape, dtype=bool)
+  return ndimage.distance_transform_edt(~_defects) > _roll_width
+
+
+def classifyFrame(_shape, _singular_points, _ph_defects, _roll_width):
+  """
+  Elementary pattern mask of a frame as a uint8 image with the values of MASK_IDS.
+  """
+  mask = np.zeros(_shape, dtype=np.uint8)
+
+  ## GET PARALLEL ROLL REGIONS
+  # Pixels more than 1 roll_width away from the topological and p.h. defects are the candidate
+  # parallel roll regions
+  defects = defectIndicator(_shape, _singular_points, _ph_defects)
+  mask[parallelRollMask(defects, _roll_width)] = 255
+
+  return mask
@@ -0,0 +1,447 @@
+
+
+
+import numpy as np
+from scipy import spatial, sparse, optimize
+from scipy.sparse import csgraph
+import instrumentation
+
+
+# Columns of a diamorse persistence diagram used by the matching passes
+COLUMNS = ['dim', 'birth', 'death', 'b_x', 'b_y', 'd_x', 'd_y']
+
+# Critical cell coordinates of the birth and death generators
+GENERATORS = {'birth': ['b_x', 'b_y'], 'death': ['d_x', 'd_y']}
+
+# Death value separating the pinch-off and roll generators
+PINCH_OFF_LEVEL = 170
+
+# Radius sweep of the greedy matching: radius 1, then steps of RADIUS_FACTOR up to
+# (RADIUS_ITERATIONS-1)*RADIUS_FACTOR pixels
+RADIUS_FACTOR = 5
+RADIUS_ITERATIONS = 4
+MAX_RADIUS = (RADIUS_ITERATIONS-1)*RADIUS_FACTOR
+
+# Matching engines
+ENGINES = ['greedy', 'assignment']
+
+
+class DiagramMatcher(object):
+  """
+  Matches the points of one persistence diagram (sublevel or superlevel) to the points of the
+  diagram of the next frame.
+
+  Every matching pass looks for points of the second diagram in the same dimension whose birth
+  and death values are within max_error (the sup norm between the two images) and, depending
+  on the pass, whose birth and/or death generators are within a radius in pixels. A point is
+  matched only if exactly one unmatched candidate is found.
+
+  The second diagram is indexed once per dimension and set of generator columns with a KD tree
+  over the sup norm, so all candidates of a pass are found in one batched query. Candidates are
+  then resolved in row order against the points still unmatched, which gives exactly the same
+  matches as scanning the second diagram point by point.
+  """
+
+  def __init__(self, _pd1, _pd2, _max_error):
+
+    self.max_error = float(_max_error)
+
+    self.pd1 = dict((c, np.asarray(_pd1[c], dtype=float)) for c in COLUMNS)
+    self.pd2 = dict((c, np.asarray(_pd2[c], dtype=float)) for c in COLUMNS)
+
+    # Index labels of the second diagram, reported in matchedidx
+    self.labels2 = np.asarray(_pd2.index)
+
+    # Source columns for the matched birth/death values
+    self.birth2 = np.asarray(_pd2['birth'])
+    self.death2 = np.asarray(_pd2['death'])
+
+    n1 = len(_pd1)
+    n2 = len(_pd2)
+
+    self.matchedidx = -np.ones(n1, dtype=np.int64)
+    self.radius = np.zeros(n1, dtype=np.int64)
+    self.matchedpos = -np.ones(n1, dtype=np.int64)
+    self.taken = np.zeros(n2, dtype=bool)
+
+    # KD trees over the second diagram, keyed by (dim, generators)
+    self.indexes = {}
+
+
+  def unmatched(self):
+    """
+    Number of unmatched points in the first diagram.
+    """
+    return int(np.sum(self.matchedidx == -1))
+
+
+  def unmatchedRows(self, _min_persistence=None):
+    """
+    Positions of the unmatched points in the first diagram, optionally restricted to points with
+    persistence larger than _min_persistence.
+    """
+    rows = (self.matchedidx == -1)
+    if _min_persistence is not None:
+      rows &= (abs(self.pd1['birth'] - self.pd1['death']) > _min_persistence)
+    return np.flatnonzero(rows)
+
+
+  def getIndex(self, _dim, _generators):
+    """
+    Returns the KD tree over (birth, death, generator coordinates) for the points of the second
+    diagram in dimension _dim, together with the positions of the indexed points. Points with
+    non-finite values can never be matched and are left out of the index.
+    """
+    key = (_dim, _generators)
+    if key not in self.indexes:
+      columns = self.indexColumns(_generators)
+      values = np.column_stack([self.pd2[c] for c in columns])
+      positions = np.flatnonzero((self.pd2['dim'] == _dim) & np.all(np.isfinite(values), axis=1))
+      if len(positions) > 0:
+        tree = spatial.cKDTree(values[positions])
+      else:
+        tree = None
+      self.indexes[key] = (tree, positions)
+    return self.indexes[key]
+
+
+  def indexColumns(self, _generators):
+    columns = ['birth', 'death']
+    for g in _generators:
+      columns = columns + GENERATORS[g]
+    return columns
+
+
+  def findCandidates(self, _rows, _generators, _radius):
+    """
+    Finds, for each of the _rows of the first diagram, every point of the second diagram (matched
+    or not) that satisfies the stability criteria of the pass. Returns the candidates as a
+    compressed row list: candidates for _rows[i] are candidates[offsets[i]:offsets[i+1]].
+    """
+    columns = self.indexColumns(_generators)
+    tolerances = np.asarray([self.max_error]*2 + [float(_radius)]*(len(columns) - 2))
+
+    query_rows = []
+    query_candidates = []
+
+    for dim in np.unique(self.pd1['dim'][_rows]):
+
+      rows = _rows[self.pd1['dim'][_rows] == dim]
+      values = np.column_stack([self.pd1[c][rows] for c in columns])
+      rows = rows[np.all(np.isfinite(values), axis=1)]
+      values = values[np.all(np.isfinite(values), axis=1)]
+
+      tree, positions = self.getIndex(dim, _generators)
+      if (tree is None) or (len(rows) == 0):
+        continue
+
+      # The sup-norm ball of the largest tolerance contains every candidate
+      neighbours = tree.query_ball_point(values, r=tolerances.max(), p=np.inf)
+      counts = np.asarray([len(n) for n in neighbours], dtype=np.int64)
+      if counts.sum() == 0:
+        continue
+
+      pairs_row = np.repeat(np.arange(len(rows)), counts)
+      pairs_candidate = positions[np.concatenate([np.asarray(n, dtype=np.int64) for n in neighbours if len(n) > 0])]
+
+      # Apply the per-column tolerances
+      within = np.ones(len(pairs_row), dtype=bool)
+      for c, t in zip(columns, tolerances):
+        within &= (abs(self.pd2[c][pairs_candidate] - self.pd1[c][rows][pairs_row]) <= t)
+
+      query_rows.append(rows[pairs_row[within]])
+      query_candidates.append(pairs_candidate[within])
+
+    # Group the candidates by position of the row in _rows
+    order = np.full(len(self.matchedidx), -1, dtype=np.int64)
+    order[_rows] = np.arange(len(_rows))
+
+    if len(query_rows) > 0:
+      pair_rows = order[np.concatenate(query_rows)]
+      pair_candidates = np.concatenate(query_candidates)
+    else:
+      pair_rows = np.zeros(0, dtype=np.int64)
+      pair_candidates = np.zeros(0, dtype=np.int64)
+
+    sort = np.lexsort((pair_candidates, pair_rows))
+    candidates = pair_candidates[sort]
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(pair_rows, minlength=len(_rows)))))
+
+    return candidates, offsets
+
+
+  def matchRows(self, _rows, _generators, _radius):
+    """
+    Matches each of the _rows of the first diagram, in order, to its candidate in the second
+    diagram if exactly one candidate is still unmatched.
+    """
+    _rows = np.asarray(_rows, dtype=np.int64)
+    if len(_rows) == 0:
+      return
+
+    candidates, offsets = self.findCandidates(_rows, _generators, _radius)
+
+    taken = self.taken
+    candidates = candidates.tolist()
+    offsets = offsets.tolist()
+
+    for k in range(len(_rows)):
+      start = offsets[k]
+      stop = offsets[k+1]
+      if start == stop:
+        continue
+      available = [j for j in candidates[start:stop] if not taken[j]]
+      if len(available) == 1:
+        match = available[0]
+        i = _rows[k]
+        self.matchedidx[i] = self.labels2[match]
+        self.matchedpos[i] = match
+        self.radius[i] = _radius
+        taken[match] = True
+
+
+  def assignRows(self, _rows, _generators, _radius):
+    """
+    Matches the _rows of the first diagram to the unmatched points of the second diagram by a
+    minimum-cost assignment over the candidate graph of the pass, instead of accepting only
+    unique candidates. The assignment first maximizes the number of matches and then minimizes
+    the total cost, where the cost of a pair is the sup-norm distance between the two points in
+    the persistence plane plus the sup-norm displacement of the generators used by the pass.
+
+    The candidate graph is split into connected components and every component is solved on its
+    own, so a pass takes one sparse solve regardless of how crowded the persistence plane is.
+    Each match records the smallest radius of the greedy sweep that admits its generator
+    displacement, or _radius for a pass without generators (the bottleneck pass).
+    """
+    _rows = np.asarray(_rows, dtype=np.int64)
+    if len(_rows) == 0:
+      return
+
+    candidates, offsets = self.findCandidates(_rows, _generators, _radius)
+    rows = np.repeat(_rows, np.diff(offsets))
+    available = ~self.taken[candidates]
+    rows = rows[available]
+    candidates = candidates[available]
+    if len(rows) == 0:
+      return
+
+    # Edge costs and generator displacements
+    cost = np.maximum(abs(self.pd1['birth'][rows] - self.pd2['birth'][candidates]), abs(self.pd1['death'][rows] - self.pd2['death'][candidates]))
+    displacement = np.zeros(len(rows))
+    for g in _generators:
+      for c in GENERATORS[g]:
+        displacement = np.maximum(displacement, abs(self.pd1[c][rows] - self.pd2[c][candidates]))
+    cost = cost + displacement
+
+    # Connected components of the bipartite candidate graph
+    row_nodes, row_ids = np.unique(rows, return_inverse=True)
+    col_nodes, col_ids = np.unique(candidates, return_inverse=True)
+    n_nodes = len(row_nodes) + len(col_nodes)
+    graph = sparse.coo_matrix((np.ones(len(rows)), (row_ids, len(row_nodes) + col_ids)), shape=(n_nodes, n_nodes))
+    n_components, components = csgraph.connected_components(graph, directed=False)
+    edge_components = components[row_ids]
+
+    matched_edges = []
+
+    # Components made of a single edge need no solve
+    edges_per_component = np.bincount(edge_components, minlength=n_components)
+    single = (edges_per_component[edge_components] == 1)
+    matched_edges.append(np.flatnonzero(single))
+
+    order = np.flatnonzero(~single)
+    order = order[np.argsort(edge_components[order], kind='mergesort')]
+    bounds = np.flatnonzero(np.diff(edge_components[order])) + 1
+
+    for edges in np.split(order, bounds):
+      if len(edges) == 0:
+        continue
+      local_rows, r = np.unique(row_ids[edges], return_inverse=True)
+      local_cols, c = np.unique(col_ids[edges], return_inverse=True)
+
+      # Missing edges cost more than all edges together, so the number of matches comes first
+      missing = cost[edges].sum() + 1.
+      matrix = np.full((len(local_rows), len(local_cols)), missing)
+      matrix[r, c] = cost[edges]
+
+      assigned_r, assigned_c = optimize.linear_sum_assignment(matrix)
+      assigned = (matrix[assigned_r, assigned_c] < missing)
+      lookup = np.full((len(local_rows), len(local_cols)), -1, dtype=np.int64)
+      lookup[r, c] = edges
+      matched_edges.append(lookup[assigned_r[assigned], assigned_c[assigned]])
+
+    matched_edges = np.concatenate(matched_edges)
+
+    # Radius of the greedy sweep at which the generators would have been close enough
+    radii = np.asarray([1] + list(range(RADIUS_FACTOR, MAX_RADIUS + 1, RADIUS_FACTOR)))
+    steps = np.minimum(np.searchsorted(radii, displacement[matched_edges]), len(radii) - 1)
+
+    i = rows[matched_edges]
+    j = candidates[matched_edges]
+    self.matchedidx[i] = self.labels2[j]
+    self.matchedpos[i] = j
+    self.radius[i] = radii[steps] if len(_generators) else _radius
+    self.taken[j] = True
+
+
+  def selectRows(self, _rows, _dim, _death_below):
+    """
+    Restricts _rows to dimension _dim and to death values below (or at and above) the pinch-off level.
+    """
+    rows = _rows[self.pd1['dim'][_rows] == _dim]
+    if _death_below:
+      return rows[self.pd1['death'][rows] < PINCH_OFF_LEVEL]
+    else:
+      return rows[self.pd1['death'][rows] >= PINCH_OFF_LEVEL]
+
+
+  # BOTTLENECK MATCHES
+  # Points with persistence above 2*max_error that have a single candidate within max_error.
+  def bottleneckMatches(self, _radius):
+    self.matchRows(self.unmatchedRows(2*self.max_error), (), _radius)
+
+
+  # STABLE GENERATOR MATCHES
+  # Both generators within +-radius pixels.
+  def stableGeneratorMatches(self, _radius):
+    self.matchRows(self.unmatchedRows(), ('birth', 'death'), _radius)
+
+
+  # PINCH-OFF GENERATOR MATCHES
+  # Match the pinch-off generator to within +-radius pixels: death generators in dimension 0,
+  # birth generators in dimension 1.
+  def stablePinchOffMatches(self, _type, _radius):
+    rows = self.unmatchedRows(2*self.max_error)
+    if _type == 'sub':
+      self.matchRows(self.selectRows(rows, 0, True), ('death',), _radius)
+      self.matchRows(self.selectRows(self.unmatchedRows(2*self.max_error), 1, False), ('birth',), _radius)
+    else:
+      self.matchRows(self.selectRows(rows, 1, True), ('birth',), _radius)
+      self.matchRows(self.selectRows(self.unmatchedRows(2*self.max_error), 0, False), ('death',), _radius)
+
+
+  # STABLE ROLL MATCHES
+  # Match birth generators of death above the pinch-off level to within +-radius pixels.
+  def stableRollMatches(self, _type, _radius):
+    rows = self.unmatchedRows()
+    if _type == 'sub':
+      self.matchRows(self.selectRows(rows, 0, False), ('birth',), _radius)
+    else:
+      self.matchRows(self.selectRows(rows, 0, True), ('death',), _radius)
+
+
+  def matchedFrame(self, _pd1):
+    """
+    Returns a copy of the first diagram with the matchedidx, radius, matchedbirth and matcheddeath
+    columns of the matching.
+    """
+    result = _pd1.copy()
+    result['matchedidx'] = self.matchedidx
+    result['radius'] = self.radius
+
+    matched = (self.matchedpos > -1)
+    for column, source in [('matchedbirth', self.birth2), ('matcheddeath', self.death2)]:
+      if matched.any():
+        values = np.zeros(len(result), dtype=source.dtype)
+        values[matched] = source[self.matchedpos[matched]]
+      else:
+        values = np.zeros(len(result), dtype=np.int64)
+      result[column] = values
+
+    return result
+
+
+def matchDiagrams(_sub1, _sup1, _sub2, _sup2, _max_error, _verbose=True, _engine='greedy'):
+  """
+  Runs the matching procedure between the sublevel and superlevel diagrams of two frames and
+  returns copies of _sub1 and _sup1 with the matching columns.
+
+  The greedy engine runs stable generator and bottleneck passes at radius 1, then at increasing
+  radii for as long as new points get matched, accepting only unique candidates. The assignment
+  engine runs each of the two passes once at the largest radius of the sweep and solves it as a
+  minimum-cost assignment (see DiagramMatcher.assignRows).
+  """
+
+  sub = DiagramMatcher(_sub1, _sub2, _max_error)
+  sup = DiagramMatcher(_sup1, _sup2, _max_error)
+
+  def log(_message):
+    if _verbose:
+      print(_message)
+
+  def matchingPass(_name, _radius, _match):
+    # Runs one pass on both diagrams, traced with the points it matched and those left
+    with instrumentation.Stage('matching ' + _name, radius=_radius, engine=_engine) as stage:
+      unmatched = sub.unmatched() + sup.unmatched()
+      _match()
+      stage.items = unmatched - (sub.unmatched() + sup.unmatched())
+      stage.fields['unmatched'] = [sub.unmatched(), sup.unmatched()]
+
+  if _engine == 'assignment':
+    log("\nRadius %d...(%d,%d)" % (MAX_RADIUS, sub.unmatched(), sup.unmatched()))
+    matchingPass('stable generators', MAX_RADIUS, lambda: [m.assignRows(m.unmatchedRows(), ('birth', 'death'), MAX_RADIUS) for m in [sub, sup]])
+    log("Stable Generators..." + "(%d,%d)" % (sub.unmatched(), sup.unmatched()))
+    matchingPass('bottleneck', MAX_RADIUS, lambda: [m.assignRows(m.unmatchedRows(2*m.max_error), (), MAX_RADIUS) for m in [sub, sup]])
+    log("Bottleneck..." + "(%d,%d)" % (sub.unmatched(), sup.unmatched()))
+    return sub.matchedFrame(_sub1), sup.matchedFrame(_sup1)
+  elif _engine != 'greedy':
+    raise ValueError('matchDiagrams: Unrecognized engine "' + _engine + '"')
+
+  def getMatches(radius):
+    log("\nRadius %d...(%d,%d)" % (radius, sub.unmatched(), sup.unmatched()))
+    # Find the stable generator matches
+    matchingPass('stable generators', radius, lambda: (sub.stableGeneratorMatches(radius), sup.stableGeneratorMatches(radius)))
+    log("Stable Generators..." + "(%d,%d)" % (sub.unmatched(), sup.unmatched()))
+    # Run bottleneck match first
+    matchingPass('bottleneck', radius, lambda: (sub.bottleneckMatches(radius), sup.bottleneckMatches(radius)))
+    log("Bottleneck..." + "(%d,%d)" % (sub.unmatched(), sup.unmatched()))
+
+  tmpSub = sub.unmatched()
+  tmpSup = sup.unmatched()
+  getMatches(1)
+
+  factor=RADIUS_FACTOR
+  radius=0
+  iterations=RADIUS_ITERATIONS
+  while ( (sub.unmatched() < tmpSub) | (tmpSup > sup.unmatched()) ):
+    tmpSub = sub.unmatched()
+    tmpSup = sup.unmatched()
+    radius = radius + factor
+    getMatches(radius)
+    if radius == (iterations-1)*factor:
+      break
+
+  return sub.matchedFrame(_sub1), sup.matchedFrame(_sup1)
+
+
+def supNorm(_bmp1, _bmp2):
+  """
+  Sup norm between two images, used as the stability bound for the matching.
+  """
+  return np.absolute(np.subtract(_bmp1, _bmp2)).max()
+
+
+def writeMatches(_matches, _file):
+  """
+  Writes a matched diagram, dropping the rows without a finite dimension.
+  """
+  _matches = _matches[np.isfinite(_matches['dim'])]
+  _matches.to_csv(_file, index_label="idx")
+
+
+def matchFramePair(_frame, _data1, _data2, _osub, _osup, _engine='greedy'):
+  """
+  Matches the diagrams of two consecutive frames, each given as (bmp, sub, sup), and writes the
+  sublevel and superlevel matches. Used as the worker of the range mode of match-pd-forward.py.
+  """
+  (bmp1, sub1, sup1) = _data1
+  (bmp2, sub2, sup2) = _data2
+
+  max_error = supNorm(bmp1, bmp2)
+  sub1, sup1 = matchDiagrams(sub1, sup1, sub2, sup2, max_error, _verbose=False, _engine=_engine)
+
+  with instrumentation.Stage('csv write', frame=_frame) as stage:
+    writeMatches(sub1, _osub)
+    writeMatches(sup1, _osup)
+    stage.items = len(sub1) + len(sup1)
+
+  return (_frame, max_error, int(np.sum(sub1['matchedidx'] == -1)), int(np.sum(sup1['matchedidx'] == -1)))
@@ -0,0 +1,119 @@
+
+
+
+import numpy as np
+import data_access as da
+
+
+# Quadrants of the persistence plane counted for every region, in order
+QUADRANTS = ['top_left', 'top', 'left', 'center']
+
+
+class RegionCounter(object):
+  """
+  Counts the points of persistence diagrams in the quadrants of the persistence plane around the
+  region keys (region, _max_level - region) of every region: top_left (birth <= key_x, death >=
+  key_y), top (birth > key_x, death >= key_y), left and center (the same with _noise_level <=
+  death < key_y).
+
+  The births and deaths of a diagram are binned once into a 2D histogram over the thresholds of
+  all regions; its summed-area table then answers every count of every region, exactly as the
+  four boolean filters per region would.
+  """
+
+  def __init__(self, _regions, _max_level, _noise_level):
+    self.regions = np.asarray(_regions)
+    self.noise_level = _noise_level
+    self.key_x = self.regions.astype(float)
+    self.key_y = float(_max_level) - self.regions
+
+    self.birth_thresholds = np.unique(self.key_x)
+    lower = np.maximum(self.key_y, _noise_level)
+    self.death_thresholds = np.unique(np.concatenate((self.key_y, lower, [_noise_level])))
+
+    self.bx = np.searchsorted(self.birth_thresholds, self.key_x)
+    self.dy = np.searchsorted(self.death_thresholds, self.key_y)
+    self.dlower = np.searchsorted(self.death_thresholds, lower)
+    self.dnoise = np.searchsorted(self.death_thresholds, _noise_level)
+
+  def table(self, _birth, _death):
+    """
+    Summed-area table T[j, k] = #(birth <= birth_thresholds[j], death >= death_thresholds[k]),
+    with j = len(birth_thresholds) counting all births.
+    """
+    nx = len(self.birth_thresholds)
+    nd = len(self.death_thresholds)
+    # Number of thresholds below each birth, number of thresholds at or below each death
+    b = np.searchsorted(self.birth_thresholds, _birth, side='left')
+    d = np.searchsorted(self.death_thresholds, _death, side='right')
+
+    histogram = np.bincount(b*(nd + 1) + d, minlength=(nx + 1)*(nd + 1)).reshape((nx + 1, nd + 1))
+    counts = np.cumsum(histogram, axis=0)
+    counts = np.cumsum(counts[:,::-1], axis=1)[:,::-1]
+    # Shift so column k counts deaths >= death_thresholds[k]
+    return counts[:,1:]
+
+  def count(self, _birth, _death):
+    """
+    Quadrant counts of one diagram as a (regions, 4) array, columns in the order of QUADRANTS.
+    """
+    counts = self.table(np.asarray(_birth), np.asarray(_death))
+    every = len(self.birth_thresholds)
+
+    top_left = counts[self.bx, self.dy]
+    top = counts[every, self.dy] - top_left
+    left = counts[self.bx, self.dnoise] - counts[self.bx, self.dlower]
+    center = (counts[every, self.dnoise] - counts[every, self.dlower]) - left
+
+    return np.column_stack((top_left, top, left, center))
+
+
+def regionCounts(_pattern, _frames, _dim, _regions, _max_level, _noise_level):
+  """
+  Quadrant counts of the points of dimension _dim of the persistence diagrams of _frames
+  (file pattern or packed diagram store) as a (regions, frames, 4) array.
+  """
+  counter = RegionCounter(_regions, _max_level, _noise_level)
+  _frames = list(_frames)
+  counts = np.zeros((len(counter.regions), len(_frames), len(QUADRANTS)), dtype=int)
+
+  for k, i in enumerate(_frames):
+    data = da.loadPersistenceDiagram(_pattern, i)
+    data = data.loc[data['dim'] == _dim]
+    counts[:,k,:] = counter.count(data['birth'].values, data['death'].values)
+
+  return counts
+
+
+def laggedCovariance(_series, _lags, _axis=-1):
+  """
+  Covariance of every series with itself shifted by each lag: np.cov of _series[0:T-lag] and
+  _series[lag:T] (ddof 1) along _axis, for all series and lags at once. The lagged products
+  come from one FFT autocorrelation and the window means from cumulative sums. Returns the
+  lags along the first axis followed by the other axes of _series; nan for lags leaving fewer
+  than two samples.
+  """
+  x = np.moveaxis(np.asarray(_series, dtype=float), _axis, -1)
+  T = x.shape[-1]
+  lags = np.asarray(_lags, dtype=int)
+
+  # Covariances do not depend on the mean; removing it keeps the sums well conditioned
+  x = x - np.mean(x, axis=-1, keepdims=True)
+
+  n = 1
+  while n < 2*T:
+    n *= 2
+  spectrum = np.fft.rfft(x, n=n)
+  products = np.fft.irfft(spectrum*np.conj(spectrum), n=n)[...,:T]
+
+  prefix = np.concatenate((np.zeros(x.shape[:-1] + (1,)), np.cumsum(x, axis=-1)), axis=-1)
+
+  covariances = np.full(x.shape[:-1] + (len(lags),), np.nan)
+  valid = (lags >= 0) & (lags < T - 1)
+  lag = lags[valid]
+  m = (T - lag).astype(float)
+  base = prefix[...,T - lag]
+  shifted = prefix[...,[T]] - prefix[...,lag]
+  covariances[...,valid] = (products[...,lag] - base*shifted/m)/(m - 1)
+
+  return np.moveaxis(covariances, -1, 0)
@@ -0,0 +1,306 @@
+
+
+
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+import multiprocessing
+import instrumentation
+
+
+# Directory of the scripts and modules; the scripts are run from here
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Name of the manifest of a pipeline, in its output directory
+MANIFEST = 'pipeline.json'
+
+
+def fileDigest(_path):
+  """
+  SHA-1 of the content of a file, or of a directory (packed stores) as the names and contents
+  of all its files. None if _path does not exist.
+  """
+  digest = hashlib.sha1()
+  if os.path.isdir(_path):
+    for root, dirs, files in sorted(os.walk(_path)):
+      dirs.sort()
+      for name in sorted(files):
+        path = os.path.join(root, name)
+        digest.update(os.path.relpath(path, _path).encode('utf-8'))
+        digest.update(fileDigest(path).encode('utf-8'))
+  elif os.path.isfile(_path):
+    with open(_path, 'rb') as f:
+      for block in iter(lambda: f.read(1 << 20), b''):
+        digest.update(block)
+  else:
+    return None
+  return digest.hexdigest()
+
+
+def codeFiles(_script):
+  """
+  Files whose content a script's outputs depend on: the script and the library modules of the
+  repository (the .py files without a hyphen). Any change to a module reruns every script.
+  """
+  modules = [name for name in os.listdir(SCRIPT_DIR) if name.endswith('.py') and '-' not in name]
+  return [os.path.join(SCRIPT_DIR, _script)] + [os.path.join(SCRIPT_DIR, name) for name in sorted(modules)]
+
+
+class Manifest(object):
+  """
+  State of a pipeline between runs, stored as JSON: for every task that completed, the
+  fingerprint it ran with and the digests of its outputs, and a digest cache keyed by path,
+  size and modification time, so unchanged files are not read again. Saved after every task,
+  through a temporary file, so an interrupted run keeps the tasks it finished.
+  """
+
+  def __init__(self, _path):
+    self.path = _path
+    self.tasks = {}
+    self.digests = {}
+    if os.path.exists(_path):
+      with open(_path) as f:
+        state = json.load(f)
+      self.tasks = state['tasks']
+      self.digests = state['digests']
+
+  def save(self):
+    with open(self.path + '.tmp', 'w') as f:
+      json.dump({'tasks': self.tasks, 'digests': self.digests}, f, indent=1, sort_keys=True)
+    os.rename(self.path + '.tmp', self.path)
+
+  def digest(self, _path):
+    """
+    Content digest of a file or directory, reusing the cached digest while its size and
+    modification time are unchanged. None if _path does not exist.
+    """
+    if not os.path.exists(_path):
+      self.digests.pop(_path, None)
+      return None
+    if os.path.isdir(_path):
+      return fileDigest(_path)
+    stat = os.stat(_path)
+    cached = self.digests.get(_path)
+    if (cached is None) or (cached[0] != stat.st_size) or (cached[1] != stat.st_mtime):
+      cached = [stat.st_size, stat.st_mtime, fileDigest(_path)]
+      self.digests[_path] = cached
+    return cached[2]
+
+  def upToDate(self, _task, _fingerprint):
+    """
+    Whether _task last completed with _fingerprint and its outputs are still as it wrote them.
+    """
+    entry = self.tasks.get(_task.key)
+    if (entry is None) or (entry['fingerprint'] != _fingerprint):
+      return False
+    return all(self.digest(path) == digest for (path, digest) in entry['outputs'].items())
+
+  def complete(self, _task, _fingerprint):
+    self.tasks[_task.key] = {'fingerprint': _fingerprint, 'outputs': dict((path, self.digest(path)) for path in _task.outputs)}
+    self.save()
+
+  def invalidate(self, _task):
+    if self.tasks.pop(_task.key, None) is not None:
+      self.save()
+
+
+class Task(object):
+  """
+  One run of a script: the stage and frame it belongs to (frame None for run-wide stages), the
+  script arguments, the files it reads and writes (absolute paths) and the keys of the tasks
+  it depends on. Its fingerprint covers the code, the arguments and the contents of its inputs,
+  so it changes with a parameter, a modified input or a rerun upstream task whose outputs differ.
+  """
+
+  def __init__(self, _stage, _frame, _script, _args, _inputs, _outputs, _deps=()):
+    self.stage = _stage
+    self.frame = _frame
+    self.key = _stage if _frame is None else '%s:%d' % (_stage, _frame)
+    self.script = _script
+    self.args = [str(a) for a in _args]
+    self.inputs = list(_inputs)
+    self.outputs = list(_outputs)
+    self.deps = list(_deps)
+
+  def fingerprint(self, _manifest):
+    state = {'code': [(os.path.basename(path), _manifest.digest(path)) for path in codeFiles(self.script)],
+             'args': self.args,
+             'inputs': [(path, _manifest.digest(path)) for path in self.inputs]}
+    return hashlib.sha1(json.dumps(state, sort_keys=True).encode('utf-8')).hexdigest()
+
+  def command(self):
+    command = [sys.executable, os.path.join(SCRIPT_DIR, self.script)] + self.args
+    if instrumentation.enabled():
+      command += ['--trace', instrumentation.state()[0]]
+    return command
+
+
+def runCommand(_key, _command, _log):
+  """
+  Runs the command of a task with its output going to _log. Used as the worker of runTasks.
+  """
+  tstart = time.time()
+  with open(_log, 'w') as f:
+    code = subprocess.call(_command, stdout=f, stderr=subprocess.STDOUT, cwd=SCRIPT_DIR)
+  return (_key, code, time.time() - tstart)
+
+
+def runTasks(_tasks, _manifest, _log_dir, _processes, _force=False, _dry_run=False, _verbose=True):
+  """
+  Runs the tasks of a pipeline in dependency order, up to _processes at a time, skipping those
+  that are up to date in _manifest (all of them are rerun with _force). A task is started once
+  all its dependencies have completed, so the tasks of different frames run concurrently; the
+  dependencies of a task must come before it in _tasks. Tasks depending on a failed task are not
+  run. With _dry_run nothing is run: the tasks that would run are reported, together with those
+  depending on them. Returns the status of every task by key: 'up to date', 'ran', 'failed',
+  'blocked' or 'would run'.
+  """
+  def log(_message):
+    if _verbose:
+      print(_message)
+
+  seen = set()
+  for task in _tasks:
+    if any(key not in seen for key in task.deps):
+      raise ValueError('runTasks: dependencies of "' + task.key + '" must come before it')
+    seen.add(task.key)
+
+  waiting = list(_tasks)
+  status = {}
+  pending = {}
+  pool = None if _dry_run else multiprocessing.Pool(_processes, instrumentation.enable, instrumentation.state())
+
+  while waiting or pending:
+
+    # Start (or skip) every task whose dependencies are done, keeping at most 2*processes queued
+    for task in list(waiting):
+      deps = [status.get(key) for key in task.deps]
+      if any(s in ['failed', 'blocked'] for s in deps):
+        status[task.key] = 'blocked'
+      elif any(s is None for s in deps):
+        continue
+      elif len(pending) >= 2*_processes:
+        break
+      else:
+        fingerprint = task.fingerprint(_manifest)
+        if (not _force) and ('would run' not in deps) and _manifest.upToDate(task, fingerprint):
+          status[task.key] = 'up to date'
+        elif _dry_run:
+          status[task.key] = 'would run'
+        else:
+          for path in task.outputs:
+            if not os.path.isdir(os.path.dirname(path)):
+              os.makedirs(os.path.dirname(path))
+          log_file = os.path.join(_log_dir, task.key.replace(' ', '_').replace(':', '_') + '.log')
+          pending[task.key] = (task, fingerprint, pool.apply_async(runCommand, (task.key, task.command(), log_file)))
+          waiting.remove(task)
+          continue
+      waiting.remove(task)
+      instrumentation.record('task', task=task.key, status=status[task.key])
+      log("%s: %s" % (task.key, status[task.key]))
+
+    # Collect the finished tasks, waiting briefly for one if none is
+    finished = [key for (key, (task, fingerprint, result)) in pending.items() if result.ready()]
+    if pending and not finished:
+      list(pending.values())[0][2].wait(0.05)
+    for key in finished:
+      (task, fingerprint, result) = pending.pop(key)
+      (key, code, wall) = result.get()
+      if (code == 0) and all(os.path.exists(path) for path in task.outputs):
+        _manifest.complete(task, fingerprint)
+        status[key] = 'ran'
+      else:
+        _manifest.invalidate(task)
+        status[key] = 'failed'
+      instrumentation.record('task', task=key, status=status[key], wall=wall, code=code)
+      log("%s: %s (%.2fs)" % (key, status[key], wall))
+
+  if pool is not None:
+    pool.close()
+    pool.join()
+  return status
+
+
+def projectTasks(_config, _start, _end):
+  """
+  The processing chain of a run of frames [_start, _end] as tasks, from a config dict: the
+  directory 'dir', the input patterns 'image', 'sub' and 'sup' and the output subdirectory
+  'output' (all relative to 'dir'), and the parameters 'radius' (orientation field of the
+  numerical analysis), 'wavenumber' (method, or None for no wavenumber), 'blur' (orientation
+  blur radius of the descriptors), 'vectors' (1 to generate feature vectors), 'descriptors'
+  (descriptor engine, 'legacy' or 'frame'), 'engines'
+  (matching engines), 'horizons' (for the deviations, or None) and 'linear' (matching pattern
+  for the linear deviation, or None). Per frame:
+
+    numerical analysis:i   get-numerical-analysis-data.py on image i
+    descriptors:i          get-keypoint-descriptors.py on frame i, matched to the features of
+                           frame i-1 (depends on descriptors:i-1)
+    matching <engine>:i    match-pd-forward.py on frames i and i+1, for i < _end
+
+  and run-wide, given horizons: the actual deviation between the first two engines for each of
+  the sublevel and superlevel matches (depending on all their matchings), and the linear
+  deviation of the 'linear' matchings (depending on the matchings writing them, e.g. for
+  'output/match_greedy_sub_%06d.csv').
+  """
+  d = _config['dir']
+  out = _config['output']
+  path = lambda _file: os.path.join(d, _file)
+  tasks = []
+
+  for i in range(_start, _end + 1):
+    image = _config['image'] % i
+    outputs = [out + '/of_%06d.bmp' % i, out + '/sp_%06d.txt' % i]
+    args = ['-d', d, '-i', image, '-r', _config['radius'], '--outf', outputs[0], '--outsp', outputs[1]]
+    if _config['wavenumber']:
+      outputs.append(out + '/wn_%06d.npy' % i)
+      args += ['--outwn', outputs[2], '-w', _config['wavenumber']]
+    tasks.append(Task('numerical analysis', i, 'get-numerical-analysis-data.py', args, [path(image)], [path(o) for o in outputs]))
+
+  for i in range(_start, _end + 1):
+    features = out + '/features_%06d.txt' % i
+    args = ['-d', d, '-i', _config['image'] % i, '-r', _config['blur'], '--psub', _config['sub'], '--psup', _config['sup'],
+            '-n', i, '-v', _config['vectors'], '--out', features]
+    if _config.get('descriptors') == 'frame':
+      args.append('--frame-descriptors')
+    inputs = [path(_config['image'] % i), path(_config['sub'] % i), path(_config['sup'] % i)]
+    deps = []
+    if i > _start:
+      args += ['-m', out + '/features_%06d.txt' % (i - 1)]
+      inputs.append(path(out + '/features_%06d.txt' % (i - 1)))
+      deps.append('descriptors:%d' % (i - 1))
+    tasks.append(Task('descriptors', i, 'get-keypoint-descriptors.py', args, inputs, [path(features)], deps))
+
+  for engine in _config['engines']:
+    for i in range(_start, _end):
+      osub = out + '/match_%s_sub_%06d.csv' % (engine, i)
+      osup = out + '/match_%s_sup_%06d.csv' % (engine, i)
+      args = ['-d', d, '-e', engine, '--osub', osub, '--osup', osup]
+      inputs = []
+      for (k, j) in [('1', i), ('2', i + 1)]:
+        args += ['--img' + k, _config['image'] % j, '--sub' + k, _config['sub'] % j, '--sup' + k, _config['sup'] % j]
+        inputs += [path(_config['image'] % j), path(_config['sub'] % j), path(_config['sup'] % j)]
+      tasks.append(Task('matching ' + engine, i, 'match-pd-forward.py', args, inputs, [path(osub), path(osup)]))
+
+  if _config['horizons']:
+    horizons = ','.join(str(h) for h in _config['horizons'])
+    if len(_config['engines']) > 1:
+      (engine1, engine2) = _config['engines'][:2]
+      for level in ['sub', 'sup']:
+        patterns = [out + '/match_%s_%s_%%06d.csv' % (engine, level) for engine in [engine1, engine2]]
+        output = out + '/deviation_actual_%s.csv' % level
+        args = ['-d', d, '--i1', patterns[0], '--i2', patterns[1], '--start', _start, '--end', _end - 1,
+                '--horizons', horizons, '-o', output]
+        tasks.append(Task('actual deviation ' + level, None, 'get-deviation-from-actual.py', args,
+                          [path(p % i) for p in patterns for i in range(_start, _end)], [path(output)],
+                          ['matching %s:%d' % (engine, i) for engine in [engine1, engine2] for i in range(_start, _end)]))
+    if _config['linear']:
+      output = out + '/deviation_linear.csv'
+      args = ['-d', d, '-i', _config['linear'], '--start', _start, '--end', _end - 1, '--horizons', horizons, '-o', output]
+      inputs = [path(_config['linear'] % i) for i in range(_start, _end)]
+      tasks.append(Task('linear deviation', None, 'get-deviation-from-linear.py', args, inputs, [path(output)],
+                        [t.key for t in tasks if set(t.outputs) & set(inputs)]))
+
+  return tasks
@@ -0,0 +1,107 @@
+
+
+
+import sys
+from optparse import OptionParser
+import os
+import multiprocessing
+import pipeline
+import instrumentation
+
+
+
+parser = OptionParser('usage: -d dir -i image_pattern --psub pd_sub_pattern --psup pd_sup_pattern --start first_frame --end last_frame [-o output_subdir -p processes --frame-descriptors --horizons h1,h2,... --force --dry-run]'  )
+
+parser.add_option("-d", dest="dir",
+                  help="parent directory")
+parser.add_option("-i", dest="image",
+                  help="bitmap image pattern")
+parser.add_option("--psub", dest="pd_sub",
+                  help="sublevel persistence pattern")
+parser.add_option("--psup", dest="pd_sup",
+                  help="superlevel persistence pattern")
+parser.add_option("--start", dest="start",
+                  help="index of the first frame")
+parser.add_option("--end", dest="end",
+                  help="index of the last frame")
+parser.add_option("-o", dest="output",
+                  default="pipeline",
+                  help="output subdirectory of the directory, holding all outputs and the manifest")
+parser.add_option("-r", dest="radius",
+                  default=5,
+                  help="radius of the orientation field of the numerical analysis")
+parser.add_option("-w", dest="wavenumber_method",
+                  help="optional local wavenumber method of the numerical analysis: difference or fourier")
+parser.add_option("-b", dest="orientation_blur_radius",
+                  default=3,
+                  help="orientation blur radius of the keypoint descriptors")
+parser.add_option("-v", dest="generate_feature_vectors",
+                  default=1,
+                  help="generate vectors = 1, else =0")
+parser.add_option("--frame-descriptors", dest="frame_descriptors", action="store_true", default=False,
+                  help="compute the feature vectors with the faster frame descriptor engine, not comparable with the default legacy engine")
+parser.add_option("-e", dest="engines",
+                  default="greedy,assignment",
+                  help="comma-separated persistence matching engines")
+parser.add_option("--horizons", dest="horizons",
+                  help="optional comma-separated numbers of steps of the run-wide deviations")
+parser.add_option("--linear", dest="linear",
+                  help="optional matching file pattern for the linear deviation (with --horizons)")
+parser.add_option("-p", dest="processes",
+                  default=multiprocessing.cpu_count(),
+                  help="number of tasks run at a time")
+parser.add_option("--force", dest="force", action="store_true", default=False,
+                  help="rerun every task, even if up to date")
+parser.add_option("--dry-run", dest="dry_run", action="store_true", default=False,
+                  help="only report the tasks that would run")
+instrumentation.addTraceOption(parser)
+
+(options, args) = parser.parse_args()
+instrumentation.startTrace(options, sys.argv[0])
+
+## Runs the processing chain of a run of frames as a per-frame graph of script runs (see
+## pipeline.projectTasks). Every task is fingerprinted from the code, its arguments and the
+## contents of its inputs; a task whose fingerprint and outputs are unchanged since it last
+## completed is skipped, so after a parameter change or the arrival of new frames only the
+## affected tasks run. Independent tasks run concurrently. The manifest and the logs of the
+## tasks are kept in the output subdirectory.
+
+def main():
+
+  d = os.path.abspath(options.dir)
+  output_dir = os.path.join(d, options.output)
+  log_dir = os.path.join(output_dir, 'logs')
+  if not os.path.isdir(log_dir):
+    os.makedirs(log_dir)
+
+  config = {'dir': d,
+            'output': options.output,
+            'image': options.image,
+            'sub': options.pd_sub,
+            'sup': options.pd_sup,
+            'radius': options.radius,
+            'wavenumber': options.wavenumber_method,
+            'blur': options.orientation_blur_radius,
+            'vectors': options.generate_feature_vectors,
+            'descriptors': 'frame' if options.frame_descriptors else 'legacy',
+            'engines': options.engines.split(','),
+            'horizons': [int(h) for h in options.horizons.split(',')] if options.horizons else None,
+            'linear': options.linear}
+
+  tasks = pipeline.projectTasks(config, int(options.start), int(options.end))
+  manifest = pipeline.Manifest(os.path.join(output_dir, pipeline.MANIFEST))
+
+  status = pipeline.runTasks(tasks, manifest, log_dir, int(options.processes), options.force, options.dry_run)
+
+  # Summary: number of tasks of each status
+  counts = {}
+  for s in status.values():
+    counts[s] = counts.get(s, 0) + 1
+  print(', '.join('%d %s' % (counts[s], s) for s in sorted(counts)))
+
+  if counts.get('failed', 0):
+    sys.exit("Failed: " + ', '.join(t.key for t in tasks if status[t.key] == 'failed') + " (logs in " + log_dir + ")")
+
+
+if __name__ == '__main__':
+  main()
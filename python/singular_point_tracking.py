@@ -0,0 +1,223 @@
+
+
+
+import numpy as np
+import pandas as pd
+from scipy import spatial
+
+
+# Number of nearest candidates queried per point; contested points fall back to their next
+# candidate
+CANDIDATES = 4
+
+# Columns of the track table
+TRACK_COLUMNS = ['track_id', 'frame', 'idx', 'x', 'y', 'type', 'matchedid', 'velocity', 'vx', 'vy', 'event', 'partneridx']
+
+
+def loadSingularPoints(_file):
+  """
+  Loads a singular point file (row, col, charge per line, as written by
+  get-numerical-analysis-data.py) as a DataFrame with columns x, y, type.
+  """
+  try:
+    return pd.read_csv(_file, sep=' ', names=['x', 'y', 'type']).astype(int)
+  except pd.errors.EmptyDataError:
+    return pd.DataFrame({'x': np.zeros(0, dtype=int), 'y': np.zeros(0, dtype=int), 'type': np.zeros(0, dtype=int)}, columns=['x', 'y', 'type'])
+
+
+def resolveMatches(_distances, _candidates, _n_targets):
+  """
+  Resolves contested nearest neighbor matches. _distances and _candidates are the (n, k) results
+  of a k nearest neighbor query (missing neighbors at infinite distance). Every point proposes
+  its nearest candidate that is still free; each target keeps the closest proposer (lowest index
+  on ties) and the other proposers move on to their next candidate, until no proposals are left.
+  Returns the matched target of every point (-1 if none) and the distance.
+  """
+  n, k = _distances.shape
+  matches = -np.ones(n, dtype=int)
+  distances = np.full(n, np.inf)
+  taken = np.zeros(_n_targets + 1, dtype=bool)
+  position = np.zeros(n, dtype=int)
+
+  while True:
+    # Advance every unmatched point past candidates that are taken
+    active = (matches < 0) & (position < k)
+    rows = np.nonzero(active)[0]
+    while len(rows) > 0:
+      blocked = np.isinf(_distances[rows, position[rows]]) | taken[np.minimum(_candidates[rows, position[rows]], _n_targets)]
+      position[rows[blocked]] += 1
+      rows = rows[blocked & (position[rows] < k)]
+
+    proposers = np.nonzero((matches < 0) & (position < k))[0]
+    proposers = proposers[~np.isinf(_distances[proposers, position[proposers]])]
+    if len(proposers) == 0:
+      break
+
+    targets = _candidates[proposers, position[proposers]]
+    order = np.lexsort((proposers, _distances[proposers, position[proposers]], targets))
+    winners = order[np.concatenate(([True], targets[order][1:] != targets[order][:-1]))]
+
+    matches[proposers[winners]] = targets[winners]
+    distances[proposers[winners]] = _distances[proposers[winners], position[proposers[winners]]]
+    taken[targets[winners]] = True
+
+  return matches, distances
+
+
+def matchPoints(_points1, _points2, _max_distance=np.inf):
+  """
+  Matches two sets of points of one type with a single batched query of the nearest candidates,
+  resolving contested matches (see resolveMatches). Returns the matched index into _points2 of
+  every point of _points1 (-1 if none within _max_distance) and the distance.
+  """
+  n1 = len(_points1)
+  n2 = len(_points2)
+  if (n1 == 0) or (n2 == 0):
+    return -np.ones(n1, dtype=int), np.full(n1, np.inf)
+
+  k = min(CANDIDATES, n2)
+  distances, candidates = spatial.cKDTree(_points2).query(_points1, k=k, distance_upper_bound=_max_distance)
+  distances = np.reshape(distances, (n1, k))
+  candidates = np.reshape(candidates, (n1, k))
+
+  return resolveMatches(distances, candidates, n2)
+
+
+def pairEvents(_points, _types, _free, _pair_distance):
+  """
+  Pairs the free (unmatched) +1 and -1 points that are mutual nearest neighbors within
+  _pair_distance: such pairs are annihilations when the points have no successor, creations when
+  they have no predecessor. Returns the partner index of every point (-1 if not paired).
+  """
+  partners = -np.ones(len(_points), dtype=int)
+  plus = np.nonzero(_free & (_types == 1))[0]
+  minus = np.nonzero(_free & (_types == -1))[0]
+  if (len(plus) == 0) or (len(minus) == 0):
+    return partners
+
+  d_pm, i_pm = spatial.cKDTree(_points[minus]).query(_points[plus], distance_upper_bound=_pair_distance)
+  d_mp, i_mp = spatial.cKDTree(_points[plus]).query(_points[minus], distance_upper_bound=_pair_distance)
+
+  found = ~np.isinf(d_pm)
+  mutual = np.zeros(len(plus), dtype=bool)
+  mutual[found] = i_mp[i_pm[found]] == np.arange(len(plus))[found]
+
+  partners[plus[mutual]] = minus[i_pm[mutual]]
+  partners[minus[i_pm[mutual]]] = plus[mutual]
+  return partners
+
+
+def matchFrames(_sp1, _sp2, _max_distance=np.inf):
+  """
+  Matches the singular points of two frames type by type. Returns the matched index into _sp2 of
+  every point of _sp1 (-1 if none) and the distance.
+  """
+  matches = -np.ones(len(_sp1), dtype=int)
+  distances = np.full(len(_sp1), np.inf)
+  points1 = _sp1[['x', 'y']].values.astype(float)
+  points2 = _sp2[['x', 'y']].values.astype(float)
+
+  for t in np.unique(_sp1['type']):
+    rows1 = np.nonzero(_sp1['type'].values == t)[0]
+    rows2 = np.nonzero(_sp2['type'].values == t)[0]
+    type_matches, type_distances = matchPoints(points1[rows1], points2[rows2], _max_distance)
+    matched = type_matches >= 0
+    matches[rows1[matched]] = rows2[type_matches[matched]]
+    distances[rows1] = type_distances
+
+  return matches, distances
+
+
+def matchSingularPoints(_sp1, _sp2, _max_distance=np.inf, _pair_distance=5):
+  """
+  Matches the singular points of a frame to those of the next frame and returns the first frame
+  with the columns matchedidx, matcheddist, matchedx, matchedy (-1 if unmatched). Unmatched +1/-1
+  pairs are flagged in event ('annihilation') with the index of the partner in partneridx.
+  """
+  sp1 = _sp1.copy()
+  matches, distances = matchFrames(_sp1, _sp2, _max_distance)
+  matched = matches >= 0
+
+  sp1['matchedidx'] = matches
+  sp1['matcheddist'] = np.where(matched, distances, -1)
+  sp1['matchedx'] = np.where(matched, _sp2['x'].values[np.maximum(matches, 0)] if len(_sp2) > 0 else -1, -1)
+  sp1['matchedy'] = np.where(matched, _sp2['y'].values[np.maximum(matches, 0)] if len(_sp2) > 0 else -1, -1)
+
+  partners = pairEvents(_sp1[['x', 'y']].values.astype(float), _sp1['type'].values, ~matched, _pair_distance)
+  sp1['event'] = np.where(partners >= 0, 'annihilation', '')
+  sp1['partneridx'] = partners
+
+  return sp1
+
+
+class SingularPointTracker(object):
+  """
+  Tracks singular points through a sequence of frames. Each frame is matched to the prior frame;
+  matched points continue the track of their predecessor, unmatched points start a track.
+
+  The track table has one row per point and frame with the displacement from the predecessor
+  (vx, vy) and its length (velocity, _max_distance for points without predecessor) and the
+  index of the predecessor (matchedid, -1 if none), as the get_td_velocities helpers of the
+  notebooks. Points without predecessor that pair up with an opposite charge are marked
+  'creation', points without successor that pair up are marked 'annihilation' (partneridx is
+  the index of the partner in the same frame).
+  """
+
+  def __init__(self, _max_distance=5., _pair_distance=5.):
+    self.max_distance = _max_distance
+    self.pair_distance = _pair_distance
+    self.prior = None
+    self.next_track = 0
+    self.tracks = []
+
+  def step(self, _frame, _sp):
+    points = _sp[['x', 'y']].values.astype(float)
+    types = _sp['type'].values
+    n = len(_sp)
+
+    predecessors = -np.ones(n, dtype=int)
+    velocity = np.full(n, float(self.max_distance))
+    vx = np.zeros(n)
+    vy = np.zeros(n)
+    track_ids = np.zeros(n, dtype=int)
+
+    if self.prior is not None:
+      prior_sp, prior_table = self.prior
+      matches, distances = matchFrames(prior_sp, _sp, self.max_distance)
+      matched = matches >= 0
+
+      predecessors[matches[matched]] = np.nonzero(matched)[0]
+      velocity[matches[matched]] = distances[matched]
+      vx[matches[matched]] = points[matches[matched], 0] - prior_sp['x'].values[matched]
+      vy[matches[matched]] = points[matches[matched], 1] - prior_sp['y'].values[matched]
+      track_ids[matches[matched]] = prior_table['track_id'].values[matched]
+
+      # Prior points without successor
+      partners = pairEvents(prior_sp[['x', 'y']].values.astype(float), prior_sp['type'].values, ~matched, self.pair_distance)
+      annihilated = partners >= 0
+      prior_table.loc[annihilated, 'event'] = 'annihilation'
+      prior_table.loc[annihilated, 'partneridx'] = partners[annihilated]
+
+    new = predecessors < 0
+    track_ids[new] = self.next_track + np.arange(np.sum(new))
+    self.next_track += np.sum(new)
+
+    # Points without predecessor
+    partners = pairEvents(points, types, new, self.pair_distance) if self.prior is not None else -np.ones(n, dtype=int)
+
+    table = pd.DataFrame({'track_id': track_ids, 'frame': _frame, 'idx': np.arange(n), 'x': _sp['x'].values, 'y': _sp['y'].values, 'type': types,
+                          'matchedid': predecessors, 'velocity': velocity, 'vx': vx, 'vy': vy,
+                          'event': np.where(partners >= 0, 'creation', ''), 'partneridx': partners}, columns=TRACK_COLUMNS)
+
+    self.tracks.append(table)
+    self.prior = (_sp, table)
+
+    return table
+
+  def trackTable(self):
+    """
+    Track table of all frames so far.
+    """
+    if len(self.tracks) == 0:
+      return pd.DataFrame(columns=TRACK_COLUMNS)
+    return pd.concat(self.tracks, ignore_index=True)
@@ -0,0 +1,116 @@
+
+
+
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+from PIL import Image
+
+
+# Columns of a diamorse persistence diagram
+COLUMNS = ['dim', 'birth', 'death', 'b_x', 'b_y', 'd_x', 'd_y']
+
+
+def defectSeeds(_shape, _defects, _seed):
+  """
+  Positions (row, col), charges (alternating +1/-1) and velocities (pixels per frame) of the
+  seeded defects, all inside the central half of the field.
+  """
+  rng = np.random.RandomState(_seed)
+  [H, W] = _shape
+  positions = np.column_stack((rng.uniform(0.25*H, 0.75*H, _defects), rng.uniform(0.25*W, 0.75*W, _defects)))
+  charges = np.where(np.arange(_defects) % 2 == 0, 1., -1.)
+  velocities = rng.uniform(-0.5, 0.5, (_defects, 2))
+  return positions, charges, velocities
+
+
+def stripeField(_shape, _time=0, _wavelength=16., _defects=4, _seed=0):
+  """
+  Synthetic Rayleigh-Benard-like temperature field as a uint8 image: straight rolls of the given
+  wavelength at a seeded angle, with _defects dislocations (phase windings of alternating sign)
+  and a slow drift of the rolls and the defects with _time, so consecutive frames can be matched.
+  """
+  [H, W] = _shape
+  rng = np.random.RandomState(_seed)
+  angle = rng.uniform(0, np.pi)
+  positions, charges, velocities = defectSeeds(_shape, _defects, _seed)
+  positions = positions + _time*velocities
+
+  [rows, cols] = np.mgrid[0:H, 0:W].astype(float)
+  phase = (2*np.pi/_wavelength)*(cols*np.cos(angle) + rows*np.sin(angle)) + 0.2*_time
+  for (p, charge) in zip(positions, charges):
+    phase += charge*np.arctan2(rows - p[0], cols - p[1])
+
+  field = 127.5*(1 + np.cos(phase))
+  return np.clip(np.rint(field), 0, 255).astype(np.uint8)
+
+
+def plateauPoints(_mask):
+  """
+  One pixel (row, col) per connected component of _mask, the first in row-major order, so each
+  extremal plateau of a quantized field gives one generator.
+  """
+  labels, n = ndimage.label(_mask)
+  first = np.unique(labels.ravel(), return_index=True)[1][1:]
+  return np.column_stack(np.unravel_index(first, _mask.shape))
+
+
+def syntheticDiagrams(_bmp, _wavelength=16., _max_points=None):
+  """
+  Synthetic sublevel and superlevel persistence diagrams of a field, in the diamorse format
+  (x = column, y = row). Local minima and maxima (one per plateau) are the generators of the
+  classes; their partners are the opposite extreme level within half a wavelength, placed a
+  quarter wavelength away. This is not the persistence of the field, but it has its size and moves with the field,
+  which is what the matching and deviation passes depend on. At most _max_points points per
+  diagram, the most persistent first.
+  """
+  u = _bmp.astype(int)
+  [H, W] = u.shape
+  window = max(3, int(_wavelength/2))
+  offset = max(1, int(_wavelength/4))
+  lows = ndimage.minimum_filter(u, size=window)
+  highs = ndimage.maximum_filter(u, size=window)
+  minima = plateauPoints((u == ndimage.minimum_filter(u, size=3)) & (u < highs))
+  maxima = plateauPoints((u == ndimage.maximum_filter(u, size=3)) & (u > lows))
+
+  diagrams = []
+  for level in ['sub', 'sup']:
+    tables = []
+    for dim in [0, 1]:
+      # Sublevel: dim 0 born at minima, dim 1 dying at maxima; superlevel the other way around
+      points = minima if (level == 'sub') == (dim == 0) else maxima
+      [r, c] = [points[:,0], points[:,1]]
+      partner_r = np.clip(r + offset, 0, H - 1)
+      partner_c = np.clip(c + offset, 0, W - 1)
+      if level == 'sub':
+        birth, death = (u[r, c], highs[r, c]) if dim == 0 else (lows[r, c], u[r, c])
+      else:
+        birth, death = (u[r, c], lows[r, c]) if dim == 0 else (highs[r, c], u[r, c])
+      if (level == 'sub') == (dim == 0):
+        b_x, b_y, d_x, d_y = c, r, partner_c, partner_r
+      else:
+        b_x, b_y, d_x, d_y = partner_c, partner_r, c, r
+      tables.append(pd.DataFrame({'dim': dim, 'birth': birth, 'death': death, 'b_x': b_x, 'b_y': b_y, 'd_x': d_x, 'd_y': d_y}, columns=COLUMNS))
+
+    table = pd.concat(tables, ignore_index=True)
+    if (_max_points is not None) and (len(table) > _max_points):
+      order = np.argsort(-np.abs(table['death'].values - table['birth'].values), kind='stable')
+      table = table.iloc[np.sort(order[:_max_points])].reset_index(drop=True)
+    diagrams.append(table)
+
+  return diagrams[0], diagrams[1]
+
+
+def writeRun(_dir, _frames, _shape, _wavelength=16., _defects=4, _seed=0, _max_points=None):
+  """
+  Writes a synthetic run to _dir: images img_%06d.bmp and diagrams sub_%06d.csv, sup_%06d.csv
+  of every frame. Returns the three file patterns.
+  """
+  patterns = ('img_%06d.bmp', 'sub_%06d.csv', 'sup_%06d.csv')
+  for i in _frames:
+    bmp = stripeField(_shape, i, _wavelength, _defects, _seed)
+    Image.fromarray(bmp).save(_dir + "/" + patterns[0] % i)
+    sub, sup = syntheticDiagrams(bmp, _wavelength, _max_points)
+    sub.to_csv(_dir + "/" + patterns[1] % i, index=False)
+    sup.to_csv(_dir + "/" + patterns[2] % i, index=False)
+  return patterns